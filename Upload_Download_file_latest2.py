@@ -1,538 +1,3976 @@
-from flask import Flask, request, send_from_directory, redirect, url_for, render_template_string
-import os
-import mimetypes
-
-app = Flask(__name__)
-UPLOAD_FOLDER = os.path.abspath("uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-def get_file_type(filename):
-    mime_type, _ = mimetypes.guess_type(filename)
-    if mime_type:
-        if mime_type.startswith('image/'):
-            return 'image'
-        elif mime_type == 'application/pdf':
-            return 'pdf'
-        elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-            return 'word'
-        elif mime_type in ['application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']:
-            return 'excel'
-        elif mime_type in ['application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation']:
-            return 'powerpoint'
-        elif mime_type.startswith('video/'):
-            return 'video'
-        elif mime_type.startswith('audio/'):
-            return 'audio'
-        elif mime_type.startswith('text/'):
-            return 'text'
-    return 'other'
-
-HTML_PAGE = """
-<!doctype html>
-<html lang="en">
-<head>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <title>📂 File Transfer Hub</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet">
-  <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-  <style>
-    * {
-      margin: 0;
-      padding: 0;
-      box-sizing: border-box;
-    }
-    
-    body {
-      background: linear-gradient(135deg, #0f0c29 0%, #302b63 50%, #24243e 100%);
-      min-height: 100vh;
-      padding: 40px 20px;
-      font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-      color: #e0e0e0;
-    }
-    
-    .container {
-      max-width: 800px;
-      margin: auto;
-    }
-    
-    .header {
-      text-align: center;
-      margin-bottom: 40px;
-      animation: fadeInDown 0.8s ease;
-    }
-    
-    .header h1 {
-      font-size: 2.5rem;
-      font-weight: 700;
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      -webkit-background-clip: text;
-      -webkit-text-fill-color: transparent;
-      background-clip: text;
-      margin-bottom: 10px;
-    }
-    
-    .header p {
-      color: #a0a0a0;
-      font-size: 1.1rem;
-    }
-    
-    .glass-card {
-      background: rgba(255, 255, 255, 0.05);
-      backdrop-filter: blur(10px);
-      border-radius: 20px;
-      border: 1px solid rgba(255, 255, 255, 0.1);
-      padding: 30px;
-      margin-bottom: 30px;
-      box-shadow: 0 8px 32px 0 rgba(0, 0, 0, 0.37);
-      animation: fadeInUp 0.8s ease;
-      transition: transform 0.3s ease, box-shadow 0.3s ease;
-    }
-    
-    .glass-card:hover {
-      transform: translateY(-5px);
-      box-shadow: 0 12px 40px 0 rgba(0, 0, 0, 0.5);
-    }
-    
-    .card-title {
-      font-size: 1.5rem;
-      font-weight: 600;
-      margin-bottom: 20px;
-      display: flex;
-      align-items: center;
-      gap: 10px;
-      color: #ffffff;
-    }
-    
-    .card-title i {
-      color: #667eea;
-    }
-    
-    .upload-form {
-      display: flex;
-      gap: 12px;
-      flex-wrap: wrap;
-    }
-    
-    .form-control {
-      background: rgba(255, 255, 255, 0.08);
-      border: 2px solid rgba(255, 255, 255, 0.1);
-      border-radius: 12px;
-      color: #ffffff;
-      padding: 12px 16px;
-      transition: all 0.3s ease;
-      flex: 1;
-      min-width: 200px;
-    }
-    
-    .form-control:focus {
-      background: rgba(255, 255, 255, 0.12);
-      border-color: #667eea;
-      box-shadow: 0 0 0 0.25rem rgba(102, 126, 234, 0.25);
-      color: #ffffff;
-      outline: none;
-    }
-    
-    .form-control::file-selector-button {
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      border: none;
-      color: white;
-      padding: 8px 16px;
-      border-radius: 8px;
-      cursor: pointer;
-      transition: all 0.3s ease;
-      margin-right: 12px;
-    }
-    
-    .form-control::file-selector-button:hover {
-      transform: scale(1.05);
-      box-shadow: 0 4px 12px rgba(102, 126, 234, 0.4);
-    }
-    
-    .btn-upload {
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      border: none;
-      color: white;
-      padding: 12px 32px;
-      border-radius: 12px;
-      font-weight: 600;
-      cursor: pointer;
-      transition: all 0.3s ease;
-      display: inline-flex;
-      align-items: center;
-      gap: 8px;
-    }
-    
-    .btn-upload:hover {
-      transform: translateY(-2px);
-      box-shadow: 0 8px 20px rgba(102, 126, 234, 0.4);
-    }
-    
-    .file-list {
-      list-style: none;
-      padding: 0;
-      margin-top: 20px;
-    }
-    
-    .file-item {
-      background: rgba(255, 255, 255, 0.05);
-      border: 1px solid rgba(255, 255, 255, 0.1);
-      border-radius: 12px;
-      padding: 16px 20px;
-      margin-bottom: 12px;
-      transition: all 0.3s ease;
-      animation: slideIn 0.5s ease;
-    }
-    
-    .file-item:hover {
-      background: rgba(255, 255, 255, 0.08);
-      border-color: rgba(102, 126, 234, 0.5);
-    }
-    
-    .file-header {
-      display: flex;
-      justify-content: space-between;
-      align-items: center;
-      margin-bottom: 10px;
-    }
-    
-    .file-name {
-      display: flex;
-      align-items: center;
-      gap: 12px;
-      color: #ffffff;
-      font-weight: 500;
-      flex: 1;
-      word-break: break-word;
-    }
-    
-    .file-icon {
-      color: #667eea;
-      font-size: 1.2rem;
-    }
-    
-    .file-actions {
-      display: flex;
-      gap: 8px;
-    }
-    
-    .btn-preview, .btn-download {
-      border: none;
-      color: white;
-      padding: 8px 16px;
-      border-radius: 8px;
-      font-weight: 600;
-      text-decoration: none;
-      transition: all 0.3s ease;
-      display: inline-flex;
-      align-items: center;
-      gap: 8px;
-      cursor: pointer;
-      font-size: 0.9rem;
-    }
-    
-    .btn-preview {
-      background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-    }
-    
-    .btn-preview:hover {
-      transform: scale(1.05);
-      box-shadow: 0 4px 12px rgba(245, 87, 108, 0.4);
-    }
-    
-    .btn-download {
-      background: linear-gradient(135deg, #11998e 0%, #38ef7d 100%);
-    }
-    
-    .btn-download:hover {
-      transform: scale(1.05);
-      box-shadow: 0 4px 12px rgba(56, 239, 125, 0.4);
-      color: white;
-    }
-    
-    .preview-container {
-      margin-top: 15px;
-      padding: 15px;
-      background: rgba(0, 0, 0, 0.3);
-      border-radius: 10px;
-      display: none;
-      max-height: 500px;
-      overflow: auto;
-    }
-    
-    .preview-container.active {
-      display: block;
-      animation: slideDown 0.3s ease;
-    }
-    
-    .preview-container img {
-      max-width: 100%;
-      border-radius: 8px;
-      display: block;
-      margin: 0 auto;
-    }
-    
-    .preview-container iframe {
-      width: 100%;
-      min-height: 500px;
-      border: none;
-      border-radius: 8px;
-      background: white;
-    }
-    
-    .preview-text {
-      color: #e0e0e0;
-      font-family: 'Courier New', monospace;
-      white-space: pre-wrap;
-      word-wrap: break-word;
-    }
-    
-    .empty-state {
-      text-align: center;
-      padding: 40px 20px;
-      color: #a0a0a0;
-    }
-    
-    .empty-state i {
-      font-size: 4rem;
-      color: #667eea;
-      margin-bottom: 20px;
-      opacity: 0.5;
-    }
-    
-    @keyframes fadeInDown {
-      from {
-        opacity: 0;
-        transform: translateY(-30px);
-      }
-      to {
-        opacity: 1;
-        transform: translateY(0);
-      }
-    }
-    
-    @keyframes fadeInUp {
-      from {
-        opacity: 0;
-        transform: translateY(30px);
-      }
-      to {
-        opacity: 1;
-        transform: translateY(0);
-      }
-    }
-    
-    @keyframes slideIn {
-      from {
-        opacity: 0;
-        transform: translateX(-20px);
-      }
-      to {
-        opacity: 1;
-        transform: translateX(0);
-      }
-    }
-    
-    @keyframes slideDown {
-      from {
-        opacity: 0;
-        max-height: 0;
-      }
-      to {
-        opacity: 1;
-        max-height: 500px;
-      }
-    }
-    
-    @media (max-width: 768px) {
-      .upload-form {
-        flex-direction: column;
-      }
-      
-      .file-header {
-        flex-direction: column;
-        gap: 12px;
-        align-items: flex-start;
-      }
-      
-      .file-actions {
-        width: 100%;
-      }
-      
-      .btn-preview, .btn-download {
-        flex: 1;
-        justify-content: center;
-      }
-    }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <div class="header">
-      <h1><i class="fas fa-cloud-upload-alt"></i> File Transfer Hub</h1>
-      <p>Seamlessly share files across your network</p>
-    </div>
-
-    <div class="glass-card">
-      <div class="card-title">
-        <i class="fas fa-upload"></i>
-        Upload Files
-      </div>
-      <form method="post" enctype="multipart/form-data" action="/upload" class="upload-form">
-        <input class="form-control" type="file" name="file" required>
-        <button class="btn-upload" type="submit">
-          <i class="fas fa-paper-plane"></i>
-          Upload
-        </button>
-      </form>
-    </div>
-
-    <div class="glass-card">
-      <div class="card-title">
-        <i class="fas fa-folder-open"></i>
-        Your Files
-        {% if file_data %}
-          <span style="font-size: 0.9rem; color: #a0a0a0;">({{ file_data|length }})</span>
-        {% endif %}
-      </div>
-      {% if file_data %}
-        <ul class="file-list">
-          {% for file in file_data %}
-            <li class="file-item">
-              <div class="file-header">
-                <div class="file-name">
-                  {% if file.type == 'image' %}
-                    <i class="fas fa-image file-icon"></i>
-                  {% elif file.type == 'pdf' %}
-                    <i class="fas fa-file-pdf file-icon"></i>
-                  {% elif file.type == 'word' %}
-                    <i class="fas fa-file-word file-icon"></i>
-                  {% elif file.type == 'excel' %}
-                    <i class="fas fa-file-excel file-icon"></i>
-                  {% elif file.type == 'video' %}
-                    <i class="fas fa-file-video file-icon"></i>
-                  {% elif file.type == 'audio' %}
-                    <i class="fas fa-file-audio file-icon"></i>
-                  {% elif file.type == 'text' %}
-                    <i class="fas fa-file-alt file-icon"></i>
-                  {% else %}
-                    <i class="fas fa-file file-icon"></i>
-                  {% endif %}
-                  {{ file.name }}
-                </div>
-                <div class="file-actions">
-                  {% if file.type in ['image', 'pdf', 'text'] %}
-                    <button class="btn-preview" onclick="togglePreview('{{ file.name }}', '{{ file.type }}')">
-                      <i class="fas fa-eye"></i>
-                      Preview
-                    </button>
-                  {% endif %}
-                  <a class="btn-download" href="{{ url_for('download_file', filename=file.name) }}">
-                    <i class="fas fa-download"></i>
-                    Download
-                  </a>
-                </div>
-              </div>
-              <div class="preview-container" id="preview-{{ loop.index0 }}">
-                <!-- Preview content will be loaded here -->
-              </div>
-            </li>
-          {% endfor %}
-        </ul>
-      {% else %}
-        <div class="empty-state">
-          <i class="fas fa-inbox"></i>
-          <p>No files uploaded yet. Start by uploading your first file!</p>
-        </div>
-      {% endif %}
-    </div>
-  </div>
-
-  <script>
-    let activePreview = null;
-
-    function togglePreview(filename, type) {
-      const fileItems = document.querySelectorAll('.file-item');
-      let targetIndex = -1;
-      
-      fileItems.forEach((item, index) => {
-        const fileNameElement = item.querySelector('.file-name');
-        if (fileNameElement.textContent.trim().includes(filename)) {
-          targetIndex = index;
-        }
-      });
-
-      if (targetIndex === -1) return;
-
-      const previewContainer = document.getElementById(`preview-${targetIndex}`);
-      
-      if (activePreview === previewContainer && previewContainer.classList.contains('active')) {
-        previewContainer.classList.remove('active');
-        previewContainer.innerHTML = '';
-        activePreview = null;
-        return;
-      }
-
-      if (activePreview && activePreview !== previewContainer) {
-        activePreview.classList.remove('active');
-        activePreview.innerHTML = '';
-      }
-
-      if (!previewContainer.classList.contains('active')) {
-        const encodedFilename = encodeURIComponent(filename);
-        
-        if (type === 'image') {
-          previewContainer.innerHTML = `<img src="{{ url_for('view_file', filename='') }}${encodedFilename}" alt="${filename}">`;
-        } else if (type === 'pdf') {
-          previewContainer.innerHTML = `<iframe src="{{ url_for('view_file', filename='') }}${encodedFilename}"></iframe>`;
-        } else if (type === 'text') {
-          fetch(`{{ url_for('view_file', filename='') }}${encodedFilename}`)
-            .then(response => response.text())
-            .then(text => {
-              previewContainer.innerHTML = `<div class="preview-text">${text}</div>`;
-            })
-            .catch(error => {
-              previewContainer.innerHTML = `<p style="color: #ff6b6b;">Error loading preview</p>`;
-            });
-        }
-        
-        previewContainer.classList.add('active');
-        activePreview = previewContainer;
-      }
-    }
-  </script>
-</body>
-</html>
-"""
-
-@app.route("/")
-def index():
-    files = os.listdir(UPLOAD_FOLDER)
-    file_data = []
-    for filename in files:
-        file_data.append({
-            'name': filename,
-            'type': get_file_type(filename)
-        })
-    return render_template_string(HTML_PAGE, file_data=file_data)
-
-@app.route("/upload", methods=["POST"])
-def upload_file():
-    if "file" not in request.files:
-        return redirect(url_for("index"))
-    file = request.files["file"]
-    if file and file.filename.strip() != "":
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
-    return redirect(url_for("index"))
-
-@app.route("/files/<path:filename>")
-def download_file(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True)
-
-@app.route("/view/<path:filename>")
-def view_file(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+from flask import Flask, request, send_file, send_from_directory, redirect, url_for, jsonify, abort, make_response
+import os
+import sys
+import re
+import argparse
+import asyncio
+import uuid
+import fcntl
+import mimetypes
+import mmap
+import base64
+import bisect
+import io
+import json
+import threading
+import time
+import struct
+import stat
+import ctypes
+import ctypes.util
+import tempfile
+import hashlib
+import gzip
+import zlib
+import zipfile
+import tarfile
+import posixpath
+import urllib.error
+import urllib.parse
+import urllib.request
+import collections
+import functools
+import queue
+import shutil
+import sqlite3
+import subprocess
+import concurrent.futures
+import multiprocessing
+import derivatives
+from werkzeug.http import parse_options_header, is_resource_modified
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NeedData
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+from werkzeug.exceptions import ClientDisconnected, RequestedRangeNotSatisfiable, HTTPException
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import boto3
+    import boto3.s3.transfer
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+app = Flask(__name__, static_folder=None)
+STATIC_FOLDER = os.path.join(app.root_path, "static")
+UPLOAD_FOLDER = os.path.abspath(os.environ.get("UPLOAD_FOLDER", "uploads"))
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", "2.0"))
+API_PAGE_SIZE = int(os.environ.get("API_PAGE_SIZE", "100"))
+API_MAX_PAGE_SIZE = 500
+
+FILE_TYPES = ['image', 'pdf', 'word', 'excel', 'powerpoint', 'video', 'audio', 'text', 'other']
+FILE_ICONS = {
+    'image': 'fa-image',
+    'pdf': 'fa-file-pdf',
+    'word': 'fa-file-word',
+    'excel': 'fa-file-excel',
+    'powerpoint': 'fa-file-powerpoint',
+    'video': 'fa-file-video',
+    'audio': 'fa-file-audio',
+    'text': 'fa-file-alt',
+    'other': 'fa-file',
+    'folder': 'fa-folder',
+}
+PREVIEWABLE_TYPES = ['image', 'pdf', 'text']
+SORT_FIELDS = ['name', 'size', 'mtime']
+STREAM_UPLOADS = os.environ.get("STREAM_UPLOADS", "1") == "1"
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", "0"))
+TEMP_PREFIX = ".upload-"
+STATE_DIR_NAME = ".hub"
+STATE_FOLDER = os.path.join(UPLOAD_FOLDER, STATE_DIR_NAME)
+RESUMABLE_FOLDER = os.path.join(STATE_FOLDER, "resumable")
+RESUMABLE_EXPIRY = float(os.environ.get("RESUMABLE_EXPIRY", str(24 * 3600)))
+RESUMABLE_GC_INTERVAL = float(os.environ.get("RESUMABLE_GC_INTERVAL", "3600"))
+TUS_VERSION = "1.0.0"
+CHUNKED_FOLDER = os.path.join(STATE_FOLDER, "chunked")
+CHUNK_UPLOAD_SIZE = int(os.environ.get("CHUNK_UPLOAD_SIZE", str(8 * 1024 * 1024)))
+CHUNK_UPLOAD_CONCURRENCY = int(os.environ.get("CHUNK_UPLOAD_CONCURRENCY", "4"))
+MAX_BYTE_RANGES = 64
+UPLOAD_BATCH_BYTES = int(os.environ.get("UPLOAD_BATCH_BYTES", str(32 * 1024 * 1024)))
+UPLOAD_BATCH_FILES = int(os.environ.get("UPLOAD_BATCH_FILES", "500"))
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "plain")
+OBJECTS_FOLDER = os.path.join(STATE_FOLDER, "objects")
+PRECHECK_MIN_SIZE = int(os.environ.get("PRECHECK_MIN_SIZE", str(1024 * 1024)))
+ASSET_MAX_AGE = 365 * 24 * 3600
+DERIVATIVES_FOLDER = os.path.join(STATE_FOLDER, "derivatives")
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", "2"))
+DERIVATIVE_QUEUE_SIZE = int(os.environ.get("DERIVATIVE_QUEUE_SIZE", "256"))
+PREVIEW_CHUNK_SIZE = int(os.environ.get("PREVIEW_CHUNK_SIZE", str(64 * 1024)))
+PREVIEW_MAX_CHUNK_SIZE = 1024 * 1024
+PREVIEW_SNIFF_SIZE = 64 * 1024
+LINE_INDEX_STEP = 1024
+LINE_INDEX_CACHE_SIZE = 64
+PRECOMPRESSED_EXTENSIONS = {'.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.br', '.jar', '.apk',
+                            '.epub', '.odt', '.ods', '.odp', '.webp', '.avif', '.heic', '.woff', '.woff2'}
+UNCOMPRESSED_MEDIA_TYPES = ('image/bmp', 'image/x-ms-bmp', 'image/tiff', 'audio/x-wav', 'audio/wav')
+COMPRESS_DOWNLOADS = os.environ.get("COMPRESS_DOWNLOADS", "1") == "1"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESSED_FOLDER = os.path.join(STATE_FOLDER, "compressed")
+COMPRESSED_CACHE_SIZE = int(os.environ.get("COMPRESSED_CACHE_SIZE", str(512 * 1024 * 1024)))
+MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_SIZE", str(64 * 1024 * 1024)))
+MEMORY_CACHE_MAX_FILE = int(os.environ.get("MEMORY_CACHE_MAX_FILE", str(1024 * 1024)))
+CATALOG_DB = os.path.join(STATE_FOLDER, "catalog.db")
+CATALOG_RECONCILE_INTERVAL = float(os.environ.get("CATALOG_RECONCILE_INTERVAL", "3600"))
+CATALOG_BATCH_SIZE = 500
+CATALOG_ACCESS_RESOLUTION = 3600
+HASH_UPLOADS = os.environ.get("HASH_UPLOADS", "1") == "1"
+SEARCH_CONTENT = os.environ.get("SEARCH_CONTENT", "1") == "1"
+SEARCH_TEXT_BYTES = int(os.environ.get("SEARCH_TEXT_BYTES", str(256 * 1024)))
+PDFTOTEXT = shutil.which("pdftotext")
+COLD_STORAGE = os.environ.get("COLD_STORAGE", "")
+COLD_STORAGE_ENDPOINT = os.environ.get("COLD_STORAGE_ENDPOINT") or None
+COLD_AFTER = float(os.environ.get("COLD_AFTER", str(30 * 24 * 3600)))
+COLD_MIN_SIZE = int(os.environ.get("COLD_MIN_SIZE", str(1024 * 1024)))
+HOT_MIN_FREE_RATIO = float(os.environ.get("HOT_MIN_FREE_RATIO", "0.1"))
+TIERING_INTERVAL = float(os.environ.get("TIERING_INTERVAL", "300"))
+TIERING_LOCK = os.path.join(STATE_FOLDER, "tiering.lock")
+COLD_XATTR = "user.hub.sha256"
+S3_POOL_SIZE = int(os.environ.get("S3_POOL_SIZE", "32"))
+S3_MULTIPART_SIZE = int(os.environ.get("S3_MULTIPART_SIZE", str(64 * 1024 * 1024)))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", "4"))
+PEERS = [url.strip().rstrip("/") for url in os.environ.get("PEERS", "").split(",") if url.strip()]
+NODE_URL = os.environ.get("NODE_URL", "").rstrip("/")
+PEER_TIMEOUT = float(os.environ.get("PEER_TIMEOUT", "10"))
+PEER_STATUS_INTERVAL = float(os.environ.get("PEER_STATUS_INTERVAL", "5"))
+PEER_DOWNLOADS = os.environ.get("PEER_DOWNLOADS", "redirect")
+PEER_OFFLOAD_ABOVE = int(os.environ.get("PEER_OFFLOAD_ABOVE", "8"))
+REPLICATION_WORKERS = int(os.environ.get("REPLICATION_WORKERS", "2"))
+REPLICATION_STREAMS = int(os.environ.get("REPLICATION_STREAMS", "4"))
+REPLICATION_CHUNK_SIZE = int(os.environ.get("REPLICATION_CHUNK_SIZE", str(8 * 1024 * 1024)))
+REPLICATION_SYNC_INTERVAL = float(os.environ.get("REPLICATION_SYNC_INTERVAL", "600"))
+REPLICATION_LOCK = os.path.join(STATE_FOLDER, "replication.lock")
+METRICS_ENABLED = os.environ.get("METRICS", "1") == "1"
+METRICS_FOLDER = os.path.join(STATE_FOLDER, "metrics")
+METRICS_SLOTS = 8192
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PHASE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+os.makedirs(RESUMABLE_FOLDER, exist_ok=True)
+os.makedirs(CHUNKED_FOLDER, exist_ok=True)
+os.makedirs(COMPRESSED_FOLDER, exist_ok=True)
+os.makedirs(DERIVATIVES_FOLDER, exist_ok=True)
+
+class Metrics:
+    # Prometheus counters, histograms and summaries shared by all worker
+    # processes. Series get fixed slots in order of definition (the same in
+    # every process, since they are defined at import); each process adds
+    # into its own memory-mapped file of doubles, so updates never wait on
+    # another process, and /metrics sums the files. Nothing is wiped at
+    # import, since every worker of a multi-process server imports this.
+    def __init__(self, folder, enabled=True):
+        self.folder = folder
+        self.enabled = enabled
+        self.families = []
+        self.slots = {}
+        self.buckets = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.values = None
+        self.fd = None
+        self.layout = None
+        if enabled:
+            os.makedirs(folder, exist_ok=True)
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # A forked worker gets its own file, and a fresh lock in case
+        # another thread of the parent held it at the fork. The inherited
+        # descriptor would keep the parent's file locked after it exits.
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.values = None
+
+    def define(self, name, kind, description, series=((),), label_names=(), buckets=()):
+        # kind: counter (one slot per series), histogram (a count per bucket
+        # and +Inf, then the sum) or summary (count, sum).
+        width = {'counter': 1, 'histogram': len(buckets) + 2, 'summary': 2}[kind]
+        self.families.append((name, kind, description, label_names, list(series)))
+        self.buckets[name] = list(buckets)
+        for labels in series:
+            self.slots[name, labels] = self.size
+            self.size += width
+        if self.size > METRICS_SLOTS:
+            raise RuntimeError("METRICS_SLOTS is too small for %s" % name)
+
+    def _path(self, name):
+        # Files are tagged with the set of series, so counts written by a
+        # different version of the metrics are never summed into the wrong
+        # slots.
+        if self.layout is None:
+            families = repr((self.families, sorted(self.buckets.items()))).encode()
+            self.layout = hashlib.sha1(families).hexdigest()[:12]
+        return os.path.join(self.folder, "%s-%s.bin" % (name, self.layout))
+
+    def _values(self):
+        # The process holds a shared lock on its file for as long as it runs.
+        # A file left by an exited process with the same pid is continued,
+        # not truncated, so the sums never go backwards.
+        if self.values is None:
+            path = self._path(os.getpid())
+            while True:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                try:
+                    if os.path.samestat(os.fstat(fd), os.stat(path)):
+                        break
+                except FileNotFoundError:
+                    pass
+                # Retired by totals() while this process waited for the lock.
+                os.close(fd)
+            if os.fstat(fd).st_size < METRICS_SLOTS * 8:
+                os.ftruncate(fd, METRICS_SLOTS * 8)
+            self.fd = fd
+            self.values = memoryview(mmap.mmap(fd, METRICS_SLOTS * 8)).cast("d")
+        return self.values
+
+    def observe(self, name, value, labels=()):
+        self.update(observations=[(name, labels, value)])
+
+    def update(self, counters=(), observations=()):
+        # Counter increments (name, labels, amount) and observations (name,
+        # labels, value) under a single acquisition of the lock.
+        if not self.enabled:
+            return
+        with self.lock:
+            values = self.values if self.values is not None else self._values()
+            for name, labels, amount in counters:
+                values[self.slots[name, labels]] += amount
+            for name, labels, value in observations:
+                slot = self.slots[name, labels]
+                buckets = self.buckets[name]
+                if buckets:
+                    values[slot + bisect.bisect_left(buckets, value)] += 1
+                    values[slot + len(buckets) + 1] += value
+                else:
+                    values[slot] += 1
+                    values[slot + 1] += value
+
+    def timed(self, name, flush_every=256):
+        # Decorator for a summary of a function that takes microseconds:
+        # every call is added to a tally of this thread's, since a locked
+        # update per call would cost about as much as the function itself.
+        # The tally is flushed every flush_every calls and by flush() at the
+        # end of each request.
+        slot = self.slots[name, ()]
+        clock = time.perf_counter
+
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args):
+                if not self.enabled:
+                    return function(*args)
+                started = clock()
+                result = function(*args)
+                elapsed = clock() - started
+                tally = getattr(self.local, "tally", None)
+                if tally is None:
+                    tally = self.local.tally = {}
+                counts = tally.get(slot)
+                if counts is None:
+                    counts = tally[slot] = [0, 0.0]
+                counts[0] += 1
+                counts[1] += elapsed
+                if counts[0] >= flush_every:
+                    self.flush()
+                return result
+            return wrapper
+        return decorate
+
+    def flush(self):
+        # Adds this thread's timed() tallies to the process's file.
+        tally = getattr(self.local, "tally", None)
+        if not tally:
+            return
+        with self.lock:
+            values = self.values if self.values is not None else self._values()
+            for slot, (count, total) in tally.items():
+                values[slot] += count
+                values[slot + 1] += total
+        tally.clear()
+
+    def _read(self, fd):
+        data = os.pread(fd, self.size * 8, 0)
+        return memoryview(data).cast("d") if len(data) == self.size * 8 else None
+
+    def totals(self):
+        # Sums the file of every process. Files no live process holds are
+        # folded into the retired file and removed, so the folder does not
+        # grow with every worker ever started; files of another layout are
+        # dropped once their process is gone.
+        totals = [0.0] * self.size
+        retired_path = self._path("retired")
+        with open(os.path.join(self.folder, "retired.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with os.scandir(self.folder) as it:
+                paths = [entry.path for entry in it if entry.name.endswith(".bin")]
+            retired = None
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                except FileNotFoundError:
+                    continue
+                try:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        live = False
+                    except BlockingIOError:
+                        live = True
+                    data = self._read(fd) if path.endswith(self.layout + ".bin") else None
+                    if data is not None:
+                        for i, value in enumerate(data):
+                            totals[i] += value
+                    if live or path == retired_path:
+                        continue
+                    if data is not None:
+                        retired = retired or [0.0] * self.size
+                        for i, value in enumerate(data):
+                            retired[i] += value
+                    os.remove(path)
+                finally:
+                    os.close(fd)
+            if retired is not None:
+                try:
+                    with open(retired_path, "rb") as f:
+                        previous = self._read(f.fileno())
+                except FileNotFoundError:
+                    previous = None
+                if previous is not None:
+                    retired = [a + b for a, b in zip(retired, previous)]
+                with open(retired_path + ".tmp", "wb") as f:
+                    f.write(struct.pack("%dd" % self.size, *retired))
+                os.replace(retired_path + ".tmp", retired_path)
+        return totals
+
+    def render(self):
+        # The Prometheus text exposition format, version 0.0.4.
+        totals = self.totals()
+        lines = []
+        for name, kind, description, label_names, series in self.families:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            buckets = self.buckets[name]
+            for labels in series:
+                slot = self.slots[name, labels]
+                pairs = ['%s="%s"' % (key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                         for key, value in zip(label_names, labels)]
+                if kind == 'counter':
+                    lines.append("%s%s %r" % (name, metric_labels(pairs), totals[slot]))
+                    continue
+                if kind == 'histogram':
+                    count = 0
+                    for i, bound in enumerate(buckets + [float("inf")]):
+                        count += totals[slot + i]
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append('%s_bucket%s %r' % (name, metric_labels(pairs + ['le="%s"' % le]), count))
+                    total = totals[slot + len(buckets) + 1]
+                else:
+                    count, total = totals[slot], totals[slot + 1]
+                lines.append("%s_sum%s %r" % (name, metric_labels(pairs), total))
+                lines.append("%s_count%s %r" % (name, metric_labels(pairs), count))
+        return "\n".join(lines) + "\n"
+
+def metric_labels(pairs):
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+def gauge_lines(name, description, value):
+    return ["# HELP %s %s" % (name, description), "# TYPE %s gauge" % name, "%s %r" % (name, value)]
+
+METRICS = Metrics(METRICS_FOLDER, METRICS_ENABLED)
+METRICS.define("fth_get_file_type_seconds", "summary", "Time spent classifying file names in get_file_type().")
+METRICS.define("fth_listing_seconds", "histogram",
+               "Time to load a directory listing that was not in memory, by where it came from.",
+               [("scan",), ("catalog",)], ("source",), PHASE_BUCKETS)
+METRICS.define("fth_render_seconds", "histogram", "Time spent rendering the index page template.",
+               buckets=PHASE_BUCKETS)
+
+# Plain-text formats the platform's mime table misses; registering them lets
+# get_file_type() classify them as text (previewable and compressible).
+for extension in ('.log', '.yaml', '.yml', '.ini', '.conf'):
+    if mimetypes.guess_type('x' + extension)[0] is None:
+        mimetypes.add_type('text/plain', extension)
+
+@METRICS.timed("fth_get_file_type_seconds")
+def get_file_type(filename):
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type:
+        if mime_type.startswith('image/'):
+            return 'image'
+        elif mime_type == 'application/pdf':
+            return 'pdf'
+        elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
+            return 'word'
+        elif mime_type in ['application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet']:
+            return 'excel'
+        elif mime_type in ['application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation']:
+            return 'powerpoint'
+        elif mime_type.startswith('video/'):
+            return 'video'
+        elif mime_type.startswith('audio/'):
+            return 'audio'
+        elif mime_type.startswith('text/'):
+            return 'text'
+    return 'other'
+
+def is_internal_name(name):
+    return name == STATE_DIR_NAME or name.startswith(TEMP_PREFIX)
+
+def listing_key(entry, sort, order):
+    # Descending pages walk the view backwards, so folders sort last there.
+    return ((entry['type'] == 'folder') == (order == 'desc'), entry[sort], entry['name'])
+
+class FileIndex:
+    # Per-directory view of UPLOAD_FOLDER so index() never has to hit the
+    # disk. A directory is scanned the first time it is listed and then kept
+    # current by refresh() and the watcher; changes invalidate only the
+    # listings of the directories they touch.
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.directories = {}
+        self.generations = collections.Counter()
+        self.watch = None
+        self.changed = None
+        self.source = None
+        self._views = {}
+
+    def _make_entry(self, name, st, previous=None):
+        if stat.S_ISDIR(st.st_mode):
+            return {'name': name, 'size': 0, 'mtime': st.st_mtime, 'type': 'folder'}
+        if previous is not None and previous['name'] == name and previous['type'] != 'folder':
+            file_type = previous['type']
+        else:
+            file_type = get_file_type(name)
+        return {'name': name, 'size': st.st_size, 'mtime': st.st_mtime, 'type': file_type}
+
+    def _scan(self, directory, previous):
+        entries = {}
+        with os.scandir(os.path.join(self.folder, directory)) as it:
+            for entry in it:
+                if is_internal_name(entry.name):
+                    continue
+                name = directory + "/" + entry.name if directory else entry.name
+                try:
+                    st = entry.stat()
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                entries[name] = self._make_entry(name, st, previous.get(name))
+        return entries
+
+    def load(self, directory=""):
+        # Raises FileNotFoundError / NotADirectoryError for a bad directory.
+        with self.lock:
+            entries = self.directories.get(directory)
+            generation = self.generations[directory]
+        if entries is not None:
+            return entries
+        started = time.perf_counter()
+        if self.source is not None:
+            entries = self.source(directory)
+        if entries is None:
+            entries = self._scan(directory, {})
+            METRICS.observe("fth_listing_seconds", time.perf_counter() - started, ("scan",))
+        else:
+            METRICS.observe("fth_listing_seconds", time.perf_counter() - started, ("catalog",))
+        with self.lock:
+            if self.generations[directory] != generation:
+                # Changed while scanning; serve this scan but do not keep it.
+                return entries
+            entries = self.directories.setdefault(directory, entries)
+        if self.watch is not None:
+            self.watch(directory)
+        return entries
+
+    def _drop(self, directory):
+        prefix = directory + "/"
+        for key in [key for key in self.directories if key == directory or key.startswith(prefix)]:
+            del self.directories[key]
+            self._views.pop(key, None)
+            self.generations[key] += 1
+
+    def invalidate(self, directory):
+        with self.lock:
+            self._drop(directory)
+
+    def rebuild(self):
+        # Forget every listing; each directory is rescanned when next shown.
+        os.stat(self.folder)
+        with self.lock:
+            for key in self.directories:
+                self.generations[key] += 1
+            self.directories = {}
+            self._views = {}
+
+    def rescan_loaded(self):
+        with self.lock:
+            loaded = dict(self.directories)
+        for directory, previous in loaded.items():
+            try:
+                entries = self._scan(directory, previous)
+            except (FileNotFoundError, NotADirectoryError):
+                self.invalidate(directory)
+                continue
+            if entries == previous:
+                continue
+            with self.lock:
+                if self.directories.get(directory) is previous:
+                    self.directories[directory] = entries
+                    self._views.pop(directory, None)
+                    self.generations[directory] += 1
+            if self.changed is not None:
+                self.changed([name for name in entries.keys() | previous.keys()
+                              if entries.get(name) != previous.get(name)])
+
+    def refresh(self, name):
+        self.refresh_many([name])
+
+    def refresh_many(self, names):
+        # Updates each name's entry in its parent listing, adding folders
+        # created on the way; a name that is (or was) a directory also drops
+        # the cached listings below it.
+        changes = {}
+        explicit = set()
+        for name in names:
+            parts = name.split("/")
+            if any(is_internal_name(part) for part in parts):
+                continue
+            explicit.add(name)
+            for depth in range(1, len(parts) + 1):
+                path = "/".join(parts[:depth])
+                if path not in changes:
+                    try:
+                        changes[path] = os.stat(os.path.join(self.folder, path))
+                    except (FileNotFoundError, NotADirectoryError):
+                        changes[path] = None
+        with self.lock:
+            for path, st in changes.items():
+                parent = posixpath.dirname(path)
+                if path in explicit and (st is None or stat.S_ISDIR(st.st_mode)):
+                    self._drop(path)
+                self.generations[parent] += 1
+                entries = self.directories.get(parent)
+                if entries is None:
+                    continue
+                if st is None:
+                    if entries.pop(path, None) is None:
+                        continue
+                else:
+                    entry = self._make_entry(path, st, entries.get(path))
+                    if entries.get(path) == entry:
+                        continue
+                    entries[path] = entry
+                self._views.pop(parent, None)
+        if self.changed is not None and explicit:
+            self.changed(sorted(explicit))
+
+    def entry(self, name):
+        # Cached entry when the parent has been listed, else a fresh stat.
+        with self.lock:
+            cached = self.directories.get(posixpath.dirname(name), {}).get(name)
+        if cached is not None:
+            return cached
+        try:
+            return self._make_entry(name, os.stat(os.path.join(self.folder, name)))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def view(self, directory="", sort='name', file_type=None, order='asc'):
+        # Sorted (and optionally type-filtered) snapshot of one directory plus
+        # its sort keys, built once per change so paging is a bisect and a
+        # slice. Folders come first in either order.
+        self.load(directory)
+        with self.lock:
+            views = self._views.setdefault(directory, {})
+            cached = views.get((sort, file_type, order))
+            if cached is None:
+                entries = [e for e in self.directories.get(directory, {}).values()
+                           if file_type is None or e['type'] == file_type]
+                keys = sorted((listing_key(e, sort, order), e) for e in entries)
+                cached = ([e for _, e in keys], [key for key, _ in keys])
+                views[(sort, file_type, order)] = cached
+            return cached
+
+    def list(self, directory=""):
+        return self.view(directory)[0]
+
+    def page(self, directory="", sort='name', order='asc', file_type=None, after=None, limit=API_PAGE_SIZE):
+        entries, keys = self.view(directory, sort, file_type, order)
+        if order == 'asc':
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            items = entries[start:start + limit]
+            more = start + limit < len(entries)
+        else:
+            end = len(entries) if after is None else bisect.bisect_left(keys, after)
+            start = max(0, end - limit)
+            items = entries[start:end][::-1]
+            more = start > 0
+        return items, more, len(entries)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+def watch_inotify(index):
+    libc_name = ctypes.util.find_library("c")
+    if not libc_name:
+        return False
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return False
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        return False
+    directories = {}
+    watch_lock = threading.Lock()
+
+    def watch(directory):
+        # One watch per directory that has been listed; running out of
+        # watches only means that directory relies on explicit refreshes.
+        wd = libc.inotify_add_watch(fd, os.fsencode(os.path.join(index.folder, directory)), INOTIFY_MASK)
+        if wd >= 0:
+            with watch_lock:
+                directories[wd] = directory
+        return wd
+
+    if watch("") < 0:
+        os.close(fd)
+        return False
+
+    def run():
+        while True:
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            changed = set()
+            rebuild = False
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                with watch_lock:
+                    directory = directories.pop(wd, None) if mask & IN_IGNORED else directories.get(wd)
+                if mask & IN_Q_OVERFLOW:
+                    rebuild = True
+                elif directory is None:
+                    continue
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if directory == "":
+                        rebuild = True
+                    else:
+                        index.invalidate(directory)
+                elif name:
+                    changed.add(directory + "/" + os.fsdecode(name) if directory else os.fsdecode(name))
+            if rebuild:
+                try:
+                    index.rebuild()
+                except OSError:
+                    index.watch = None
+                    os.close(fd)
+                    return
+            elif changed:
+                index.refresh_many(sorted(changed))
+                METRICS.flush()
+
+    index.watch = watch
+    threading.Thread(target=run, name="file-index-inotify", daemon=True).start()
+    return True
+
+def watch_polling(index, interval):
+    # Only directories somebody has listed are rescanned.
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                index.rescan_loaded()
+            except OSError:
+                pass
+            METRICS.flush()
+
+    threading.Thread(target=run, name="file-index-poll", daemon=True).start()
+
+def start_watcher(index):
+    try:
+        if watch_inotify(index):
+            return "inotify"
+    except OSError:
+        pass
+    watch_polling(index, WATCH_POLL_INTERVAL)
+    return "polling"
+
+FILE_INDEX = FileIndex(UPLOAD_FOLDER)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open_upload(path) as f:
+        for block in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ContentStore:
+    # Content-addressed blobs under .hub/objects; every file in UPLOAD_FOLDER
+    # is a hardlink to its blob, so identical uploads share one copy on disk.
+    def __init__(self, folder):
+        self.folder = folder
+
+    def object_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def has(self, digest, size=None):
+        try:
+            st = os.stat(self.object_path(digest))
+        except (FileNotFoundError, ValueError):
+            return False
+        return size is None or st.st_size == size
+
+    def link(self, digest, dest_path):
+        link_path = os.path.join(os.path.dirname(dest_path), "%s%s.link" % (TEMP_PREFIX, uuid.uuid4().hex))
+        os.link(self.object_path(digest), link_path)
+        try:
+            os.replace(link_path, dest_path)
+        except BaseException:
+            # A leftover link would keep the blob referenced for good.
+            os.remove(link_path)
+            raise
+
+    def commit(self, temp_path, dest_path, digest):
+        # Returns True when the content was already stored.
+        try:
+            self.link(digest, dest_path)
+        except FileNotFoundError:
+            pass
+        else:
+            if temp_path != dest_path:
+                os.remove(temp_path)
+            return True
+        object_path = self.object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.chmod(temp_path, 0o444)
+        os.replace(temp_path, object_path)
+        self.link(digest, dest_path)
+        return False
+
+    def stats(self):
+        objects = references = physical = logical = 0
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                st = os.stat(os.path.join(root, name))
+                objects += 1
+                physical += st.st_size
+                references += st.st_nlink - 1
+                logical += st.st_size * (st.st_nlink - 1)
+        return {
+            'objects': objects,
+            'references': references,
+            'physical_bytes': physical,
+            'logical_bytes': logical,
+            'saved_bytes': max(logical - physical, 0),
+            'dedup_ratio': round(logical / physical, 3) if physical else 1.0,
+        }
+
+    def collect_garbage(self, min_age):
+        # Blobs whose only remaining link is the store itself.
+        cutoff = time.time() - min_age
+        removed = 0
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                if st.st_nlink == 1 and st.st_ctime < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+CONTENT_STORE = ContentStore(OBJECTS_FOLDER)
+
+def store_file(temp_path, dest_path, digest=None):
+    # Moves a finished upload into place, through the content store in
+    # dedup mode. Filesystems without hardlinks fall back to a plain rename.
+    # Returns the SHA-256 when it is known.
+    if STORAGE_MODE == "dedup":
+        digest = digest or hash_file(temp_path)
+        try:
+            CONTENT_STORE.commit(temp_path, dest_path, digest)
+            return digest
+        except PermissionError:
+            pass
+    if temp_path != dest_path:
+        os.replace(temp_path, dest_path)
+    return digest
+
+class DerivativeCache:
+    # Thumbnails and downscaled previews, made by a small process pool so
+    # image decoding never competes with request threads for the GIL. The
+    # queue is bounded; anything dropped is rescheduled when next listed.
+    # The pool forks from a forkserver that has only imported derivatives,
+    # never from this process and its watcher, catalog and GC threads.
+    def __init__(self, folder, workers, max_pending):
+        self.folder = folder
+        self.workers = workers
+        self.max_pending = max_pending
+        self.types = derivatives.supported_types() if workers > 0 else []
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.pending = set()
+        self.executor = None
+        self.executor_pid = None
+
+    def _key(self, entry):
+        return (entry['name'], entry['size'], entry['mtime'])
+
+    def schedule(self, entry, digest=None):
+        if entry['type'] not in self.types:
+            return
+        key = self._key(entry)
+        with self.lock:
+            if key in self.digests or key in self.pending or len(self.pending) >= self.max_pending:
+                return
+            if self.executor_pid != os.getpid():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["derivatives"])
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=context, initializer=derivatives.lower_priority)
+                self.executor_pid = os.getpid()
+            self.pending.add(key)
+        path = os.path.join(UPLOAD_FOLDER, entry['name'])
+        try:
+            demoted = demoted_digest(path)
+        except OSError:
+            demoted = None
+        if demoted is not None:
+            # Not worth fetching back from the cold tier for a thumbnail.
+            with self.lock:
+                self.pending.discard(key)
+                self.digests[key] = None
+            return
+        if digest is None:
+            # Hashed already by the catalog, unless the file changed since.
+            record = CATALOG.lookup(entry['name'])
+            if record is not None and (record[1], record[2]) == (entry['size'], entry['mtime']):
+                digest = record[3]
+        future = self.executor.submit(derivatives.make_derivatives, path, entry['type'], self.folder, digest)
+        future.add_done_callback(lambda f: self._finished(key, f))
+
+    def _finished(self, key, future):
+        try:
+            digest = future.result()
+        except Exception:
+            digest = None
+        with self.lock:
+            self.pending.discard(key)
+            self.digests[key] = digest
+
+    def urls(self, entry):
+        # Returns (thumbnail_url, preview_url); None until generated.
+        digest = self.digests.get(self._key(entry), False)
+        if digest is False:
+            self.schedule(entry)
+        if not digest:
+            return None, None
+        preview = url_for('derivative_file', digest=digest, kind='preview') if entry['type'] == 'image' else None
+        return url_for('derivative_file', digest=digest, kind='thumb'), preview
+
+DERIVATIVES = DerivativeCache(DERIVATIVES_FOLDER, DERIVATIVE_WORKERS, DERIVATIVE_QUEUE_SIZE)
+
+STORAGE_ERRORS = (OSError,) if boto3 is None else (
+    OSError, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+
+class LocalStorage:
+    # Cold tier in a local folder: a bigger, slower disk or a network mount.
+    # Backends take keys like "ab/abcd..." and implement has, put, open and
+    # delete; open returns a seekable binary file.
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, key):
+        return os.path.join(self.folder, key)
+
+    def has(self, key, size):
+        try:
+            return os.stat(self._path(key)).st_size == size
+        except FileNotFoundError:
+            return False
+
+    def put(self, key, source_path):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as target, open(source_path, "rb") as source:
+                shutil.copyfileobj(source, target, STREAM_CHUNK_SIZE)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def open(self, key, size):
+        return open(self._path(key), "rb")
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+class ObjectReader(io.RawIOBase):
+    # Seekable view of an object. Sequential reads share one ranged GET
+    # running to the end of the object; after a seek elsewhere the next read
+    # starts a new one, so a range request fetches only what it covers.
+    def __init__(self, storage, key, size):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.body = None
+        self.body_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        if self.body is None or self.body_position != self.position:
+            self._drop()
+            self.body = self.storage.read_range(self.key, self.position, self.size)
+            self.body_position = self.position
+        data = self.body.read(min(len(buffer), self.size - self.position))
+        if not data:
+            raise OSError("%s ended at byte %d of %d" % (self.key, self.position, self.size))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.body_position = self.position
+        return len(data)
+
+    def _drop(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self):
+        self._drop()
+        super().close()
+
+class S3Storage:
+    # Cold tier in an S3-compatible store (AWS, MinIO, Ceph) through one
+    # shared boto3 client: clients are thread-safe, and its connection pool
+    # is sized for the request threads rather than boto's default of ten.
+    # Objects over S3_MULTIPART_SIZE go up as parallel multipart uploads.
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        if boto3 is None:
+            raise SystemExit("S3 cold storage needs boto3: pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, config=botocore.config.Config(
+            max_pool_connections=S3_POOL_SIZE, retries={"max_attempts": 5, "mode": "standard"}))
+        self.transfer = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=S3_MULTIPART_SIZE, multipart_chunksize=S3_MULTIPART_SIZE,
+            max_concurrency=S3_UPLOAD_CONCURRENCY)
+
+    def has(self, key, size):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)["ContentLength"] == size
+        except botocore.exceptions.ClientError:
+            return False
+
+    def put(self, key, source_path):
+        self.client.upload_file(source_path, self.bucket, self.prefix + key, Config=self.transfer)
+
+    def read_range(self, key, start, stop):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key,
+                                      Range="bytes=%d-%d" % (start, stop - 1))["Body"]
+
+    def open(self, key, size):
+        return io.BufferedReader(ObjectReader(self, key, size), STREAM_CHUNK_SIZE)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+def open_storage(url):
+    # file:///path or s3://bucket/prefix; empty means no cold tier.
+    if not url:
+        return None
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme == "file":
+        return LocalStorage(parsed.path)
+    if parsed.scheme == "s3":
+        prefix = parsed.path.strip("/")
+        return S3Storage(parsed.netloc, prefix + "/" if prefix else "", COLD_STORAGE_ENDPOINT)
+    raise SystemExit("COLD_STORAGE must be a file:// or s3:// URL")
+
+COLD_TIER = open_storage(COLD_STORAGE)
+
+def cold_key(digest):
+    return "%s/%s" % (digest[:2], digest)
+
+def demoted_digest(path, st=None):
+    # A demoted file is a sparse placeholder naming its cold object in an
+    # xattr; returns that SHA-256, or None for a file held locally.
+    st = st or os.stat(path)
+    if not stat.S_ISREG(st.st_mode) or st.st_blocks * 512 >= st.st_size:
+        return None
+    try:
+        return os.getxattr(path, COLD_XATTR).decode()
+    except OSError:
+        return None
+
+def open_cold(digest, size):
+    if COLD_TIER is None:
+        raise FileNotFoundError("object %s is in cold storage, but COLD_STORAGE is not set" % digest)
+    return COLD_TIER.open(cold_key(digest), size)
+
+def open_upload(path):
+    # Like open(path, "rb"), streaming from the cold tier if it was demoted.
+    f = open(path, "rb")
+    st = os.fstat(f.fileno())
+    digest = demoted_digest(f.fileno(), st)
+    if digest is None:
+        return f
+    f.close()
+    return open_cold(digest, st.st_size)
+
+def demote(name, digest, size, mtime):
+    # Copies the file to the cold tier under its SHA-256 and swaps in a
+    # placeholder with the same size, mode and mtime, so listings, the
+    # catalog and ETags do not change. Returns False if the file no longer
+    # matches the catalog record.
+    path = os.path.join(UPLOAD_FOLDER, name)
+    before = os.stat(path)
+    if (before.st_size, before.st_mtime) != (size, mtime):
+        return False
+    if demoted_digest(path, before):
+        return True
+    key = cold_key(digest)
+    if not COLD_TIER.has(key, size):
+        COLD_TIER.put(key, path)
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as placeholder:
+            os.fchmod(fd, stat.S_IMODE(before.st_mode))
+            os.ftruncate(fd, size)
+            os.setxattr(fd, COLD_XATTR, digest.encode())
+            os.utime(fd, ns=(before.st_atime_ns, before.st_mtime_ns))
+        after = os.stat(path)
+        if (after.st_ino, after.st_size, after.st_mtime_ns) != (before.st_ino, before.st_size, before.st_mtime_ns):
+            return False
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
+def demote_cold_files(folder):
+    # Least recently used first (latest of download, upload and mtime):
+    # everything idle for COLD_AFTER, then more while free space on the hot
+    # tier is under HOT_MIN_FREE_RATIO. Returns the number demoted.
+    idle_since = time.time() - COLD_AFTER
+    demoted = 0
+    for name, size, mtime, digest, used in CATALOG.least_recently_used(COLD_MIN_SIZE):
+        usage = shutil.disk_usage(folder)
+        if used > idle_since and usage.free >= usage.total * HOT_MIN_FREE_RATIO:
+            break
+        try:
+            if demote(name, digest, size, mtime):
+                CATALOG.mark_cold(name)
+                demoted += 1
+        except STORAGE_ERRORS:
+            continue
+    return demoted
+
+def start_tiering(interval):
+    # One process at a time; the others skip the pass.
+    def run():
+        while True:
+            time.sleep(interval)
+            with open(TIERING_LOCK, "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    demote_cold_files(UPLOAD_FOLDER)
+                except STORAGE_ERRORS + (sqlite3.Error,):
+                    pass
+
+    threading.Thread(target=run, name="tiering", daemon=True).start()
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    directory TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT,
+    uploaded REAL,
+    accessed REAL,
+    cold INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_unhashed ON files (id) WHERE sha256 IS NULL AND type != 'folder';
+CREATE INDEX IF NOT EXISTS files_digest ON files (sha256) WHERE sha256 IS NOT NULL;
+CREATE INDEX IF NOT EXISTS files_uploaded ON files (uploaded, name) WHERE uploaded IS NOT NULL;
+CREATE TABLE IF NOT EXISTS folders (directory TEXT PRIMARY KEY, synced REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5 (name, tokenize = 'trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS contents USING fts5 (content);
+"""
+CATALOG_ADDED_COLUMNS = [("accessed", "REAL"), ("cold", "INTEGER NOT NULL DEFAULT 0")]
+
+def extract_text(path, file_type, limit):
+    # Leading text of a text file or PDF for the content index; None for
+    # anything else or anything that cannot be read.
+    try:
+        if file_type == 'text':
+            with open_upload(path) as f:
+                data = f.read(limit)
+            encoding, bom = detect_encoding(data[:PREVIEW_SNIFF_SIZE])
+            return data[bom:].decode(encoding, errors="ignore") if encoding else None
+        if file_type == 'pdf' and PDFTOTEXT and not demoted_digest(path):
+            result = subprocess.run([PDFTOTEXT, "-q", "-l", "20", "-enc", "UTF-8", path, "-"],
+                                    capture_output=True, timeout=60, preexec_fn=derivatives.lower_priority)
+            return result.stdout[:limit].decode("utf-8", errors="ignore") or None
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return None
+
+def fts_phrase(term, prefix=False):
+    return '"%s"%s' % (term.replace('"', '""'), "*" if prefix else "")
+
+class Catalog:
+    # Type, size, mtime, SHA-256 and upload time of everything under the
+    # folder in an SQLite database (WAL) in the state folder, plus FTS5
+    # tables over file names and the leading text of text files and PDFs
+    # for search. Uploads are recorded as they commit; other changes are
+    # queued and written in batches by one thread per process. folders
+    # keeps each directory's mtime as of its last sync: while it still
+    # matches, nothing in that directory was added, removed or renamed, so
+    # listings come straight from the catalog and the startup pass skips it.
+    def __init__(self, path, folder, index_content):
+        self.path = path
+        self.folder = folder
+        self.index_content = index_content
+        self.local = threading.local()
+        self.pending = None
+        self.touched = {}
+
+    def connect(self):
+        # One connection per thread (and per process after a fork).
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript(CATALOG_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+            for column, declaration in CATALOG_ADDED_COLUMNS:
+                if column not in columns:
+                    conn.execute("ALTER TABLE files ADD COLUMN %s %s" % (column, declaration))
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _record(self, name, st):
+        if stat.S_ISDIR(st.st_mode):
+            return ('folder', 0, st.st_mtime)
+        return (get_file_type(name), st.st_size, st.st_mtime)
+
+    def _synced(self, conn, directory):
+        row = conn.execute("SELECT synced FROM folders WHERE directory = ?", (directory,)).fetchone()
+        return row[0] if row else None
+
+    def _apply(self, conn, changes, rows, extract=True, uploads=None, uploaded=None):
+        # changes: [(name, stat or None)]; rows: name -> (id, type, size,
+        # mtime) as stored; uploads: name -> SHA-256 (or None) of files this
+        # process just committed, recorded as uploaded now unless uploaded
+        # is given. Returns the folders new to the catalog.
+        uploads = uploads or {}
+        writes = []
+        added = []
+        for name, st in changes:
+            row = rows.get(name)
+            if st is None:
+                if row is not None:
+                    writes.append((name, None, None))
+                continue
+            record = self._record(name, st)
+            if row is not None and row[1:] == record and name not in uploads:
+                continue
+            if record[0] == 'folder' and (row is None or row[1] != 'folder'):
+                added.append(name)
+            text = None
+            if extract and self.index_content and record[0] != 'folder':
+                text = extract_text(os.path.join(self.folder, name), record[0], SEARCH_TEXT_BYTES)
+            writes.append((name, record, text))
+        if not writes:
+            return added
+        uploaded = uploaded or time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name, record, text in writes:
+                # Read again under the write lock: another process may have
+                # recorded the same change since rows was fetched.
+                row = conn.execute("SELECT id, type, size, mtime FROM files WHERE name = ?", (name,)).fetchone()
+                if row is not None and (record is None or (row[1] == 'folder') != (record[0] == 'folder')):
+                    self._delete(conn, name)
+                    row = None
+                if record is None:
+                    continue
+                if row is None:
+                    rowid = conn.execute("INSERT INTO files (name, directory, type, size, mtime, sha256, uploaded) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (name, posixpath.dirname(name)) + record +
+                                         (uploads.get(name), uploaded if name in uploads else None)).lastrowid
+                    conn.execute("INSERT INTO names (rowid, name) VALUES (?, ?)", (rowid, posixpath.basename(name)))
+                elif name in uploads:
+                    rowid = row[0]
+                    conn.execute("UPDATE files SET type = ?, size = ?, mtime = ?, sha256 = ?, uploaded = ?, cold = 0 "
+                                 "WHERE id = ?",
+                                 record + (uploads[name], uploaded, rowid))
+                    conn.execute("DELETE FROM contents WHERE rowid = ?", (rowid,))
+                elif row[1:] != record:
+                    rowid = row[0]
+                    conn.execute("UPDATE files SET type = ?, size = ?, mtime = ?, sha256 = NULL, cold = 0 "
+                                 "WHERE id = ?",
+                                 record + (rowid,))
+                    conn.execute("DELETE FROM contents WHERE rowid = ?", (rowid,))
+                else:
+                    continue
+                if text:
+                    conn.execute("INSERT INTO contents (rowid, content) VALUES (?, ?)", (rowid, text))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def _delete(self, conn, name):
+        # The entry and, if it was a folder, everything that was under it.
+        ids = conn.execute("SELECT id FROM files WHERE name = ? OR (name >= ? AND name < ?)",
+                           (name, name + "/", name + "0")).fetchall()
+        for table, column in (("names", "rowid"), ("contents", "rowid"), ("files", "id")):
+            conn.executemany("DELETE FROM %s WHERE %s = ?" % (table, column), ids)
+        conn.execute("DELETE FROM folders WHERE directory = ? OR (directory >= ? AND directory < ?)",
+                     (name, name + "/", name + "0"))
+
+    def _walk(self, conn, directories, full=False, recurse=True):
+        # Breadth-first, one directory (one scandir and one query) at a
+        # time. Unless full, a directory whose mtime matches its last sync
+        # is not listed again; only its known subfolders are visited.
+        directories = collections.deque(directories)
+        while directories:
+            directory = directories.popleft()
+            try:
+                mtime = os.stat(os.path.join(self.folder, directory)).st_mtime
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if not full and self._synced(conn, directory) == mtime:
+                if recurse:
+                    directories.extend(row[0] for row in conn.execute(
+                        "SELECT name FROM files WHERE directory = ? AND type = 'folder'", (directory,)))
+                continue
+            changes = []
+            try:
+                with os.scandir(os.path.join(self.folder, directory)) as it:
+                    for entry in it:
+                        if is_internal_name(entry.name):
+                            continue
+                        try:
+                            st = entry.stat()
+                        except (FileNotFoundError, NotADirectoryError):
+                            continue
+                        name = directory + "/" + entry.name if directory else entry.name
+                        changes.append((name, st))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            rows = {row[0]: row[1:] for row in conn.execute(
+                "SELECT name, id, type, size, mtime FROM files WHERE directory = ?", (directory,))}
+            seen = {name for name, _ in changes}
+            changes.extend((name, None) for name in rows if name not in seen)
+            added = self._apply(conn, changes, rows)
+            conn.execute("INSERT OR REPLACE INTO folders (directory, synced) VALUES (?, ?)", (directory, mtime))
+            if recurse:
+                directories.extend(name for name, st in changes if st is not None and stat.S_ISDIR(st.st_mode))
+            else:
+                directories.extend(added)
+
+    def reconcile(self, full=False):
+        # One process at a time; a quick pass that another process started
+        # after this one asked for it is not repeated.
+        requested = time.time()
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            conn = self.connect()
+            row = conn.execute("SELECT value FROM meta WHERE key = 'reconciled'").fetchone()
+            if not full and row is not None and row[0] >= requested:
+                return
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled', ?)", (time.time(),))
+            self._walk(conn, [""], full)
+
+    def _stat_paths(self, conn, names):
+        # Each name and its parent folders, as changes and stored rows.
+        paths = set()
+        for name in names:
+            parts = name.split("/")
+            paths.update("/".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+        changes = []
+        rows = {}
+        for path in sorted(paths):
+            try:
+                changes.append((path, os.stat(os.path.join(self.folder, path))))
+            except (FileNotFoundError, NotADirectoryError):
+                changes.append((path, None))
+            row = conn.execute("SELECT id, type, size, mtime FROM files WHERE name = ?", (path,)).fetchone()
+            if row is not None:
+                rows[path] = row
+        return changes, rows
+
+    def sync(self, names):
+        # A folder that was not in the catalog yet (created, moved in) is
+        # walked.
+        conn = self.connect()
+        changes, rows = self._stat_paths(conn, names)
+        self._walk(conn, self._apply(conn, changes, rows))
+
+    def record(self, uploads, uploaded=None):
+        # uploads: name -> SHA-256 or None; uploaded: the upload time when
+        # it is not now (a copy pulled from a peer keeps the origin's).
+        # Runs in the upload request, so the rows exist before the response
+        # goes out; the text for search is extracted afterwards by the
+        # catalog thread.
+        try:
+            conn = self.connect()
+            changes, rows = self._stat_paths(conn, uploads)
+            self._apply(conn, changes, rows, extract=False, uploads=uploads, uploaded=uploaded)
+        except (OSError, sqlite3.Error):
+            pass
+        if self.index_content:
+            self._queue("text", list(uploads))
+
+    def index_text(self, names):
+        conn = self.connect()
+        texts = []
+        for name in names:
+            row = conn.execute("SELECT id, type FROM files WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                text = extract_text(os.path.join(self.folder, name), row[1], SEARCH_TEXT_BYTES)
+                if text:
+                    texts.append((row[0], text))
+        if not texts:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for rowid, text in texts:
+                conn.execute("DELETE FROM contents WHERE rowid = ?", (rowid,))
+                conn.execute("INSERT INTO contents (rowid, content) VALUES (?, ?)", (rowid, text))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def hash_missing(self):
+        # SHA-256 for files that were found on disk rather than uploaded,
+        # while this process has nothing else queued; one process at a time.
+        with open(self.path + ".hash.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            conn = self.connect()
+            last = 0
+            while True:
+                rows = conn.execute("SELECT id, name, size, mtime FROM files WHERE sha256 IS NULL "
+                                    "AND type != 'folder' AND id > ? ORDER BY id LIMIT 100", (last,)).fetchall()
+                if not rows:
+                    return
+                for rowid, name, size, mtime in rows:
+                    if self.pending is not None and not self.pending.empty():
+                        return
+                    path = os.path.join(self.folder, name)
+                    try:
+                        before = os.stat(path)
+                        digest = demoted_digest(path, before) or hash_file(path)
+                        after = os.stat(path)
+                    except STORAGE_ERRORS:
+                        continue
+                    if (before.st_size, before.st_mtime) == (after.st_size, after.st_mtime) == (size, mtime):
+                        conn.execute("UPDATE files SET sha256 = ? WHERE id = ? AND size = ? AND mtime = ?",
+                                     (digest, rowid, size, mtime))
+                last = rows[-1][0]
+
+    def listing(self, directory):
+        # The directory's entries from the catalog, or None (and a resync
+        # queued) when its mtime moved since it was last synced.
+        mtime = os.stat(os.path.join(self.folder, directory)).st_mtime
+        try:
+            conn = self.connect()
+            if self._synced(conn, directory) != mtime:
+                self._queue("walk", [directory])
+                return None
+            rows = conn.execute("SELECT name, type, size, mtime FROM files WHERE directory = ?", (directory,))
+            return {name: {'name': name, 'size': size, 'mtime': mtime, 'type': file_type}
+                    for name, file_type, size, mtime in rows}
+        except sqlite3.Error:
+            return None
+
+    def lookup(self, name):
+        # (type, size, mtime, sha256, uploaded, accessed, cold) as recorded,
+        # or None.
+        try:
+            return self.connect().execute("SELECT type, size, mtime, sha256, uploaded, accessed, cold "
+                                          "FROM files WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error:
+            return None
+
+    def touch(self, name):
+        # Last access, for tiering; written with the next batch, at most
+        # once per CATALOG_ACCESS_RESOLUTION per file, since every write
+        # costs the readers their page cache.
+        now = time.time()
+        if now - self.touched.get(name, 0) < CATALOG_ACCESS_RESOLUTION:
+            return
+        if len(self.touched) >= 100000:
+            self.touched.clear()
+        self.touched[name] = now
+        self._queue("accessed", [name])
+
+    def _mark_accessed(self, names):
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE files SET accessed = ? WHERE name = ?", [(now, name) for name in names])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def least_recently_used(self, min_size, limit=1000):
+        # Hashed local files of at least min_size as (name, size, mtime,
+        # sha256, last used), oldest first.
+        return self.connect().execute(
+            "SELECT name, size, mtime, sha256, MAX(mtime, COALESCE(uploaded, 0), COALESCE(accessed, 0)) AS used "
+            "FROM files WHERE cold = 0 AND type != 'folder' AND sha256 IS NOT NULL AND size >= ? "
+            "ORDER BY used LIMIT ?", (min_size, limit)).fetchall()
+
+    def mark_cold(self, name):
+        self.connect().execute("UPDATE files SET cold = 1 WHERE name = ?", (name,))
+
+    def tier_stats(self):
+        files, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files "
+                                             "WHERE cold = 1").fetchone()
+        return {'cold_files': files, 'cold_bytes': size}
+
+    def find_digest(self, digest):
+        # A local file with this SHA-256, or None.
+        row = self.connect().execute("SELECT name FROM files WHERE sha256 = ? AND type != 'folder' LIMIT 1",
+                                     (digest,)).fetchone()
+        return row[0] if row else None
+
+    def uploaded_since(self, after, after_name, limit):
+        # Hashed uploads after (upload time, name) as (name, size, sha256,
+        # uploaded), in that order.
+        return self.connect().execute(
+            "SELECT name, size, sha256, uploaded FROM files WHERE uploaded IS NOT NULL AND sha256 IS NOT NULL "
+            "AND (uploaded > ? OR (uploaded = ? AND name > ?)) ORDER BY uploaded, name LIMIT ?",
+            (after, after, after_name, limit)).fetchall()
+
+    def get_meta(self, key):
+        row = self.connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        self.connect().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _queue(self, kind, names=()):
+        if self.pending is not None:
+            self.pending.put((kind, names))
+
+    def update(self, names):
+        self._queue("sync", names)
+
+    def start(self, interval):
+        try:
+            self.connect()
+        except sqlite3.Error:
+            return False
+        self.pending = queue.Queue()
+        self._queue("reconcile")
+
+        def run():
+            while True:
+                work = collections.defaultdict(set)
+                kind, names = self.pending.get()
+                work[kind].update(names)
+                count = len(names)
+                while count < CATALOG_BATCH_SIZE:
+                    try:
+                        kind, names = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    work[kind].update(names)
+                    count += len(names)
+                try:
+                    if "reconcile" in work or "full" in work:
+                        self.reconcile(full="full" in work)
+                    if work.get("walk"):
+                        self._walk(self.connect(), sorted(work["walk"]), recurse=False)
+                    if work.get("sync"):
+                        self.sync(work["sync"])
+                    if work.get("text"):
+                        self.index_text(work["text"])
+                    if work.get("accessed"):
+                        self._mark_accessed(work["accessed"])
+                    if self.pending.empty():
+                        self.hash_missing()
+                except STORAGE_ERRORS + (sqlite3.Error,):
+                    pass
+                METRICS.flush()
+
+        def schedule():
+            while True:
+                time.sleep(interval)
+                self._queue("full")
+
+        threading.Thread(target=run, name="catalog", daemon=True).start()
+        threading.Thread(target=schedule, name="catalog-reconcile", daemon=True).start()
+        return True
+
+    def search(self, query, file_type=None, directory="", min_size=None, max_size=None,
+               content=False, after=None, limit=API_PAGE_SIZE):
+        # Terms of three or more characters go through the trigram index
+        # (substring match on the file name) and, with content, the text
+        # index; shorter ones are a LIKE on the name, checked while walking
+        # the name index so a common term stops at the first page. Results
+        # are ordered by path.
+        clauses = []
+        params = []
+        terms = query.split()
+        indexed = [term for term in terms if len(term) >= 3]
+        if indexed:
+            source = "SELECT rowid FROM names WHERE names MATCH ?"
+            params.append(" ".join(fts_phrase(term) for term in indexed))
+            if content:
+                source += " UNION SELECT rowid FROM contents WHERE contents MATCH ?"
+                params.append(" ".join(fts_phrase(term, prefix=True) for term in indexed))
+            clauses.append("id IN (%s)" % source)
+        for term in terms:
+            if len(term) < 3:
+                clauses.append("substr(name, length(directory) + (directory != '') + 1) LIKE ? ESCAPE '\\'")
+                params.append("%" + re.sub(r"([\\%_])", r"\\\1", term) + "%")
+        if file_type:
+            clauses.append("type = ?")
+            params.append(file_type)
+        if directory:
+            clauses.append("name > ? AND name < ?")
+            params += [directory + "/", directory + "0"]
+        if min_size is not None:
+            clauses.append("size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            clauses.append("size <= ?")
+            params.append(max_size)
+        if after is not None:
+            clauses.append("name > ?")
+            params.append(after)
+        sql = "SELECT name, type, size, mtime FROM files"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        rows = self.connect().execute(sql + " ORDER BY name LIMIT ?", params + [limit + 1]).fetchall()
+        entries = [{'name': name, 'type': file_type, 'size': size, 'mtime': mtime}
+                   for name, file_type, size, mtime in rows[:limit]]
+        return entries, len(rows) > limit
+
+CATALOG = Catalog(CATALOG_DB, UPLOAD_FOLDER, SEARCH_CONTENT)
+
+def peer_request(url, payload=None, headers=None, method=None, timeout=PEER_TIMEOUT):
+    # A request to another node; HTTP errors come back as responses.
+    headers = dict(headers or {})
+    data = None
+    if payload is not None:
+        data = json.dumps(payload).encode()
+        headers["Content-Type"] = "application/json"
+    try:
+        return urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers, method=method),
+                                      timeout=timeout)
+    except urllib.error.HTTPError as error:
+        return error
+
+def peer_file_url(peer, name):
+    # replica=1 keeps the peer from passing the download on again.
+    return "%s/files/%s?replica=1" % (peer, urllib.parse.quote(name))
+
+def fetch_ranges(url, path, size):
+    # Downloads url into path with up to REPLICATION_STREAMS range requests
+    # of REPLICATION_CHUNK_SIZE in flight. Returns False if the source no
+    # longer has the file.
+    with open(path, "wb") as f:
+        f.truncate(size)
+    spans = [(start, min(start + REPLICATION_CHUNK_SIZE, size)) for start in range(0, size, REPLICATION_CHUNK_SIZE)]
+
+    def fetch(span):
+        start, stop = span
+        with peer_request(url, headers={"Range": "bytes=%d-%d" % (start, stop - 1)}) as response:
+            if response.status == 404:
+                return False
+            if response.status != 206 and not (response.status == 200 and span == (0, size)):
+                raise OSError("%s answered %d to a range request" % (url, response.status))
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                position = start
+                for block in iter(lambda: response.read(STREAM_CHUNK_SIZE), b""):
+                    os.pwrite(fd, block, position)
+                    position += len(block)
+            finally:
+                os.close(fd)
+        if position != stop:
+            raise OSError("%s ended at byte %d of %d" % (url, position, stop))
+        return True
+
+    if not spans:
+        return True
+    with concurrent.futures.ThreadPoolExecutor(min(REPLICATION_STREAMS, len(spans))) as pool:
+        return all(list(pool.map(fetch, spans)))
+
+# Transfers in progress across all worker processes; downloads are also
+# the load each node reports to its peers.
+ACTIVE_DOWNLOADS = multiprocessing.Value("i", 0)
+ACTIVE_UPLOADS = multiprocessing.Value("i", 0)
+
+class Replicator:
+    # Replication between nodes that each keep their own UPLOAD_FOLDER.
+    # New uploads are announced to every peer, and a peer pulls what it
+    # does not have yet in the background: from a local file with the same
+    # SHA-256 when there is one, else in parallel ranges from the node that
+    # announced it. A periodic pass over each peer's uploads catches what
+    # was missed while a node was down. Downloads can be sent to the least
+    # loaded peer holding the same file. Moves and deletions stay local.
+    # When nodes disagree about a name, the latest upload wins (the origin's
+    # upload time travels with every copy), the higher SHA-256 on a tie.
+    def __init__(self, node_url, peers):
+        self.node_url = node_url
+        self.peers = peers
+        self.loads = {}
+        self.misses = {}
+        self.outbox = None
+        self.lock = threading.Lock()
+        self.pulling = set()
+        self.executor = None
+        self.executor_pid = None
+
+    def announce(self, uploads):
+        if self.outbox is not None:
+            self.outbox.put(uploads)
+
+    def _send_announcements(self):
+        while True:
+            uploads = dict(self.outbox.get())
+            while len(uploads) < CATALOG_BATCH_SIZE:
+                try:
+                    uploads.update(self.outbox.get_nowait())
+                except queue.Empty:
+                    break
+            files = []
+            for name, digest in uploads.items():
+                path = os.path.join(UPLOAD_FOLDER, name)
+                record = CATALOG.lookup(name)
+                try:
+                    size = os.stat(path).st_size
+                    digest = digest or hash_file(path)
+                except STORAGE_ERRORS:
+                    continue
+                files.append({'name': name, 'size': size, 'sha256': digest, 'uploaded': record and record[4]})
+            for peer in self.peers:
+                try:
+                    peer_request(peer + "/api/replication/announce", {'origin': self.node_url, 'files': files}).close()
+                except OSError:
+                    pass
+
+    def has(self, name, digest):
+        record = CATALOG.lookup(name)
+        if record is None or record[3] != digest:
+            return False
+        try:
+            st = os.stat(os.path.join(UPLOAD_FOLDER, name))
+        except OSError:
+            return False
+        return (record[1], record[2]) == (st.st_size, st.st_mtime)
+
+    def wanted(self, name, digest, uploaded):
+        # Whether an announced version should replace what is here.
+        if self.has(name, digest):
+            return False
+        record = CATALOG.lookup(name)
+        if record is None:
+            return True
+        return record[0] != 'folder' and (uploaded, digest) > (record[4] or 0, record[3] or "")
+
+    def receive(self, origin, files):
+        # Queues what is missing here; returns how many were queued.
+        queued = 0
+        for item in files:
+            if not isinstance(item, dict):
+                continue
+            name = normalize_upload_name(str(item.get('name', '')))
+            digest = str(item.get('sha256', '')).lower()
+            size = item.get('size')
+            uploaded = item.get('uploaded') or 0
+            if name is None or not re.fullmatch(r"[0-9a-f]{64}", digest) or not isinstance(size, int):
+                continue
+            if isinstance(uploaded, bool) or not isinstance(uploaded, (int, float)):
+                continue
+            self.misses.pop(name, None)
+            if self.wanted(name, digest, uploaded) and self.schedule(origin, name, size, digest, uploaded):
+                queued += 1
+        return queued
+
+    def schedule(self, origin, name, size, digest, uploaded):
+        with self.lock:
+            if (name, digest) in self.pulling:
+                return False
+            if self.executor_pid != os.getpid():
+                self.executor = concurrent.futures.ThreadPoolExecutor(REPLICATION_WORKERS,
+                                                                      thread_name_prefix="replication")
+                self.executor_pid = os.getpid()
+            self.pulling.add((name, digest))
+        self.executor.submit(self._pull, origin, name, size, digest, uploaded)
+        return True
+
+    def _pull(self, origin, name, size, digest, uploaded):
+        try:
+            for attempt in range(3):
+                try:
+                    if self.wanted(name, digest, uploaded):
+                        self.pull(origin, name, size, digest, uploaded)
+                    return
+                except STORAGE_ERRORS:
+                    time.sleep(2 ** attempt)
+        finally:
+            with self.lock:
+                self.pulling.discard((name, digest))
+
+    def pull(self, origin, name, size, digest, uploaded):
+        # Builds the file in a temp file next to its destination, checks the
+        # hash and commits it like an upload (without announcing it again,
+        # and with the origin's upload time).
+        path = os.path.join(UPLOAD_FOLDER, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if STORAGE_MODE == "dedup" and CONTENT_STORE.has(digest, size):
+            CONTENT_STORE.link(digest, path)
+            uploads_finished({name: digest}, announce=False, uploaded=uploaded)
+            return
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=".part", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            source = CATALOG.find_digest(digest)
+            if source is not None:
+                with open_upload(os.path.join(UPLOAD_FOLDER, source)) as src, open(temp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+            if source is None or hash_file(temp_path) != digest:
+                if not fetch_ranges(peer_file_url(origin, name), temp_path, size):
+                    return
+                if hash_file(temp_path) != digest:
+                    raise OSError("%s from %s does not match its announced SHA-256" % (name, origin))
+            store_file(temp_path, path, digest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        uploads_finished({name: digest}, announce=False, uploaded=uploaded)
+
+    def sync(self):
+        # Uploads each peer has recorded since the last pass, paged by
+        # (upload time, name); the position is kept in the catalog.
+        for peer in self.peers:
+            key = "replicated:" + peer
+            after, after_name = CATALOG.get_meta(key) or (0, "")
+            while True:
+                query = urllib.parse.urlencode({'after': after, 'after_name': after_name})
+                with peer_request("%s/api/replication/manifest?%s" % (peer, query)) as response:
+                    if response.status != 200:
+                        break
+                    page = json.load(response)
+                if not page['files']:
+                    break
+                self.receive(peer, page['files'])
+                after, after_name = page['files'][-1]['uploaded'], page['files'][-1]['name']
+                CATALOG.set_meta(key, [after, after_name])
+                if not page['more']:
+                    break
+
+    def _poll_loads(self):
+        while True:
+            for peer in self.peers:
+                try:
+                    with peer_request(peer + "/api/replication/status", timeout=2) as response:
+                        self.loads[peer] = (json.load(response)['active_downloads'], time.time())
+                except (OSError, ValueError, KeyError):
+                    self.loads.pop(peer, None)
+            time.sleep(PEER_STATUS_INTERVAL)
+
+    def _sync_periodically(self):
+        while True:
+            with open(REPLICATION_LOCK, "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass
+                else:
+                    try:
+                        self.sync()
+                    except (OSError, ValueError, KeyError, sqlite3.Error):
+                        pass
+            time.sleep(REPLICATION_SYNC_INTERVAL)
+
+    def offload(self, name):
+        # The peer to send a download to, or None to serve it here: the
+        # least loaded live peer with an identical copy once this node has
+        # more than PEER_OFFLOAD_ABOVE downloads running, or any peer with
+        # the file while it has not arrived here yet. A name no peer could
+        # serve is not asked about again for PEER_STATUS_INTERVAL.
+        record = CATALOG.lookup(name)
+        local = os.path.isfile(os.path.join(UPLOAD_FOLDER, name))
+        active = ACTIVE_DOWNLOADS.value
+        if local and (active <= PEER_OFFLOAD_ABOVE or record is None or not record[3]):
+            return None
+        now = time.time()
+        if self.misses.get(name, 0) > now:
+            return None
+        fresh = now - 3 * PEER_STATUS_INTERVAL
+        candidates = sorted((load, peer) for peer, (load, seen) in list(self.loads.items())
+                            if seen > fresh and (not local or load < active - 1))
+        for _, peer in candidates[:3]:
+            try:
+                with peer_request(peer_file_url(peer, name), method="HEAD", timeout=2) as response:
+                    if response.status == 200 and (not local or response.headers.get("ETag") == '"%s"' % record[3]):
+                        return peer
+            except OSError:
+                continue
+        if candidates:
+            if len(self.misses) >= 100000:
+                self.misses.clear()
+            self.misses[name] = now + PEER_STATUS_INTERVAL
+        return None
+
+    def start(self):
+        # Also run in each worker after the fork; pulls the master had in
+        # flight then are not this process's.
+        self.pulling = set()
+        self.outbox = queue.Queue()
+        for target, thread_name in ((self._send_announcements, "replication-announce"),
+                                    (self._poll_loads, "replication-loads"),
+                                    (self._sync_periodically, "replication-sync")):
+            threading.Thread(target=target, name=thread_name, daemon=True).start()
+
+if PEERS and not NODE_URL:
+    raise SystemExit("PEERS needs NODE_URL, the address the peers reach this node at")
+REPLICATOR = Replicator(NODE_URL, PEERS) if PEERS else None
+
+def uploads_finished(uploads, announce=True, uploaded=None):
+    # uploads: name -> SHA-256 (None when it was not computed on the way in).
+    for filename in uploads:
+        MEMORY_CACHE.invalidate(os.path.join(UPLOAD_FOLDER, filename))
+    CATALOG.record(uploads, uploaded)
+    FILE_INDEX.refresh_many(list(uploads))
+    for filename in uploads:
+        entry = FILE_INDEX.entry(filename)
+        if entry is not None:
+            DERIVATIVES.schedule(entry, uploads[filename])
+    if announce and REPLICATOR is not None:
+        REPLICATOR.announce(uploads)
+    # The async engine and replication run this outside any Flask request.
+    METRICS.flush()
+
+def upload_finished(filename, digest=None):
+    uploads_finished({filename: digest})
+
+def normalize_upload_name(filename):
+    # Folder uploads arrive as relative paths (photos/2024/a.jpg). Keep the
+    # structure, but drop empty and "." parts and refuse anything that could
+    # climb out of UPLOAD_FOLDER or land on internal state.
+    parts = [part for part in re.split(r"[\\/]+", filename.strip()) if part not in ("", ".")]
+    if not parts or any(part == ".." or is_internal_name(part) for part in parts):
+        return None
+    name = "/".join(parts)
+    return name if safe_join(UPLOAD_FOLDER, name) is not None else None
+
+def upload_destination(filename):
+    # 409 when a file would land on a folder or under a file; os.replace()
+    # onto a folder would otherwise fail only after the whole body arrived.
+    path = safe_join(UPLOAD_FOLDER, filename)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        abort(409)
+    if os.path.isdir(path) and not os.path.islink(path):
+        abort(409)
+    return path
+
+def is_compressible_mimetype(mime_type):
+    return mime_type.startswith('text/') or mime_type in (
+        'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+def load_static_assets(folder):
+    # Everything under static/ is small, so it is read, fingerprinted and
+    # precompressed (gzip, plus brotli when available) once at startup.
+    assets = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            variants = {'identity': data}
+            if is_compressible_mimetype(mime_type):
+                variants['gzip'] = gzip.compress(data, 9, mtime=0)
+                if brotli is not None:
+                    variants['br'] = brotli.compress(data, quality=11)
+            assets[os.path.relpath(path, folder).replace(os.sep, "/")] = {
+                'mimetype': mime_type,
+                'version': hashlib.sha256(data).hexdigest()[:12],
+                'variants': {k: v for k, v in variants.items() if k == 'identity' or len(v) < len(data)},
+            }
+    return assets
+
+STATIC_ASSETS = load_static_assets(STATIC_FOLDER)
+
+def asset_url(name):
+    return url_for('static', filename=name, v=STATIC_ASSETS[name]['version'])
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.route("/static/<path:filename>", endpoint="static")
+def static_asset(filename):
+    asset = STATIC_ASSETS.get(filename)
+    if asset is None:
+        abort(404)
+    offered = [encoding for encoding in ('br', 'gzip') if encoding in asset['variants']]
+    encoding = request.accept_encodings.best_match(offered + ['identity'], default='identity')
+    response = app.response_class(asset['variants'][encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag('%s-%s' % (asset['version'], encoding))
+    if request.args.get('v') == asset['version']:
+        # Fingerprinted URLs change with their content, so they can be
+        # cached for good.
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+HTML_PAGE = """
+<!doctype html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <title>📂 File Transfer Hub</title>
+  <link href="{{ asset_url('vendor/bootstrap.min.css') }}" rel="stylesheet">
+  <link href="{{ asset_url('vendor/icons.css') }}" rel="stylesheet">
+  <link href="{{ asset_url('app.css') }}" rel="stylesheet">
+</head>
+<body>
+  <div class="container">
+    <div class="header">
+      <h1><i class="fas fa-cloud-upload-alt"></i> File Transfer Hub</h1>
+      <p>Seamlessly share files across your network</p>
+    </div>
+
+    <div class="glass-card">
+      <div class="card-title">
+        <i class="fas fa-upload"></i>
+        Upload Files
+      </div>
+      <form method="post" enctype="multipart/form-data" action="{{ url_for('upload_file', dir=directory or None) }}" class="upload-form" id="upload-form">
+        <input class="form-control" type="file" name="file" multiple>
+        <input class="form-control" type="file" name="file" webkitdirectory title="Upload a folder">
+        <button class="btn-upload" type="submit">
+          <i class="fas fa-paper-plane"></i>
+          Upload
+        </button>
+      </form>
+      <div class="upload-status" id="upload-status">
+        <div class="upload-progress"><div class="upload-progress-bar" id="upload-progress-bar"></div></div>
+        <p id="upload-message"></p>
+      </div>
+    </div>
+
+    <div class="glass-card">
+      <div class="card-title">
+        <i class="fas fa-folder-open"></i>
+        Your Files
+        {% if total %}
+          <span style="font-size: 0.9rem; color: #a0a0a0;">(<span id="file-total">{{ total }}</span>)</span>
+        {% endif %}
+      </div>
+      <nav class="breadcrumbs" aria-label="Folder">
+        {%- for label, url in breadcrumbs %}{% if not loop.first %}<span class="breadcrumb-separator">/</span>{% endif %}
+        {%- if loop.last %}<span>{{ label }}</span>{% else %}<a href="{{ url }}">{{ label }}</a>{% endif %}{% endfor %}
+        <input class="form-control search-input" type="search" id="search-input" placeholder="Search files" aria-label="Search files">
+        <button class="btn-preview" type="button" id="new-folder"><i class="fas fa-folder-plus"></i> New folder</button>
+      </nav>
+      {% if total %}
+        <div class="list-toolbar">
+          <select class="form-select" id="sort-select">
+            <option value="name:asc">Name (A-Z)</option>
+            <option value="name:desc">Name (Z-A)</option>
+            <option value="mtime:desc">Newest first</option>
+            <option value="mtime:asc">Oldest first</option>
+            <option value="size:desc">Largest first</option>
+            <option value="size:asc">Smallest first</option>
+          </select>
+          <select class="form-select" id="type-select">
+            <option value="">All types</option>
+            {% for file_type in file_types %}
+              <option value="{{ file_type }}">{{ file_type|capitalize }}</option>
+            {% endfor %}
+          </select>
+          <button class="btn-download" type="button" data-archive="zip" disabled><i class="fas fa-download"></i> ZIP</button>
+          <button class="btn-download" type="button" data-archive="tar" disabled><i class="fas fa-download"></i> TAR</button>
+        </div>
+        <ul class="file-list" id="file-list">
+          {% for file in file_data %}
+            {%- set thumbnail, preview = derivative_urls(file) %}
+            {%- set label = file.name.rsplit('/', 1)[-1] %}
+            <li class="file-item"><div class="file-header"><div class="file-name">
+              <input class="file-select" type="checkbox" value="{{ file.name }}" aria-label="Select {{ label }}">
+              {%- if thumbnail %}<img class="file-thumb" src="{{ thumbnail }}" alt="" loading="lazy">{% else %}<i class="fas {{ file_icons.get(file.type, 'fa-file') }} file-icon"></i>{% endif -%}
+              {% if file.type == 'folder' %}<a class="folder-link" href="{{ url_for('index', directory=file.name) }}">{{ label }}</a>{% else %}<span>{{ label }}</span>{% endif %}</div><div class="file-actions">
+              {%- if file.type in previewable %}<button class="btn-preview" data-name="{{ file.name }}" data-type="{{ file.type }}"{% if preview %} data-preview="{{ preview }}"{% endif %} onclick="togglePreview(this)"><i class="fas fa-eye"></i> Preview</button>{% endif -%}
+              <button class="btn-preview btn-move" type="button" data-name="{{ file.name }}"><i class="fas fa-arrows-alt"></i> Move</button>
+              {%- if file.type == 'folder' %}<a class="btn-download" href="{{ url_for('download_archive', archive_format='zip', path=file.name) }}"><i class="fas fa-download"></i> ZIP</a>
+              {%- else %}<a class="btn-download" href="{{ url_for('download_file', filename=file.name) }}"><i class="fas fa-download"></i> Download</a>{% endif %}</div></div><div class="preview-container"></div></li>
+          {% endfor %}
+        </ul>
+        <div class="list-sentinel" id="list-sentinel" data-cursor="{{ next_cursor or '' }}"></div>
+      {% else %}
+        <div class="empty-state">
+          <i class="fas fa-inbox"></i>
+          <p>{% if directory %}This folder is empty.{% else %}No files uploaded yet. Start by uploading your first file!{% endif %}</p>
+        </div>
+      {% endif %}
+    </div>
+  </div>
+
+  <script id="hub-config" type="application/json">{{ hub_config|tojson }}</script>
+  <script src="{{ asset_url('app.js') }}"></script>
+</body>
+</html>
+"""
+
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_PAGE)
+
+def encode_cursor(sort, order, file_type, directory, entry):
+    payload = json.dumps([sort, order, file_type, directory] + list(listing_key(entry, sort, order)),
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort, order, file_type, directory):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_sort, cursor_order, cursor_type, cursor_directory, group, value, name = payload
+    except (ValueError, TypeError):
+        abort(400)
+    if (cursor_sort, cursor_order, cursor_type, cursor_directory) != (sort, order, file_type, directory):
+        abort(400)
+    if not isinstance(name, str) or not isinstance(group, bool) or isinstance(value, str) != (sort == 'name'):
+        abort(400)
+    return (group, value, name)
+
+def listing_directory(directory):
+    # "" is the root; anything else must be an existing folder.
+    if not directory:
+        return ""
+    name = normalize_upload_name(directory)
+    if name is None or not os.path.isdir(os.path.join(UPLOAD_FOLDER, name)):
+        abort(404)
+    return name
+
+def breadcrumbs(directory):
+    crumbs = [('Home', url_for('index'))]
+    parts = directory.split("/") if directory else []
+    for depth, part in enumerate(parts, 1):
+        crumbs.append((part, url_for('index', directory="/".join(parts[:depth]))))
+    return crumbs
+
+def page_of(directory, sort='name', order='asc', file_type=None, after=None, limit=API_PAGE_SIZE):
+    try:
+        return FILE_INDEX.page(directory, sort, order, file_type, after, limit)
+    except (FileNotFoundError, NotADirectoryError):
+        abort(404)
+
+@app.route("/")
+@app.route("/browse/<path:directory>")
+def index(directory=""):
+    directory = listing_directory(directory)
+    file_data, more, total = page_of(directory)
+    next_cursor = encode_cursor('name', 'asc', None, directory, file_data[-1]) if more else None
+    hub_config = {
+        'directory': directory,
+        'file_icons': FILE_ICONS,
+        'previewable': PREVIEWABLE_TYPES,
+        'view_url': url_for('view_file', filename=''),
+        'preview_url': url_for('preview_text', filename=''),
+        'browse_url': url_for('index', directory=''),
+        'api_url': url_for('list_files_api'),
+        'search_url': url_for('search_files'),
+        'folders_url': url_for('create_folder'),
+        'move_url': url_for('move_entry'),
+        'chunked_url': url_for('create_chunked_upload'),
+        'chunk_concurrency': CHUNK_UPLOAD_CONCURRENCY,
+        'upload_url': url_for('upload_file'),
+        'archive_url': url_for('download_archive', archive_format='zip'),
+        'batch_max_bytes': UPLOAD_BATCH_BYTES,
+        'batch_max_files': UPLOAD_BATCH_FILES,
+        'precheck_url': url_for('precheck_upload'),
+        'precheck_min_size': PRECHECK_MIN_SIZE if STORAGE_MODE == "dedup" else None,
+    }
+    started = time.perf_counter()
+    page = INDEX_TEMPLATE.render(file_data=file_data, total=total, next_cursor=next_cursor, file_types=FILE_TYPES,
+                                 file_icons=FILE_ICONS, previewable=PREVIEWABLE_TYPES, hub_config=hub_config,
+                                 derivative_urls=DERIVATIVES.urls, directory=directory,
+                                 breadcrumbs=breadcrumbs(directory))
+    METRICS.observe("fth_render_seconds", time.perf_counter() - started)
+    return page
+
+def entry_json(e):
+    if e['type'] == 'folder':
+        return {
+            'name': e['name'],
+            'type': e['type'],
+            'mtime': e['mtime'],
+            'browse_url': url_for('index', directory=e['name']),
+            'download_url': url_for('download_archive', archive_format='zip', path=e['name']),
+        }
+    thumbnail_url, preview_url = DERIVATIVES.urls(e)
+    return {
+        'name': e['name'],
+        'type': e['type'],
+        'size': e['size'],
+        'mtime': e['mtime'],
+        'download_url': url_for('download_file', filename=e['name']),
+        'view_url': url_for('view_file', filename=e['name']),
+        'thumbnail_url': thumbnail_url,
+        'preview_url': preview_url,
+    }
+
+@app.route("/api/files")
+def list_files_api():
+    directory = listing_directory(request.args.get('dir', ''))
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    file_type = request.args.get('type') or None
+    if sort not in SORT_FIELDS or order not in ('asc', 'desc') or (file_type and file_type not in FILE_TYPES):
+        abort(400)
+    limit = min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, sort, order, file_type, directory) if cursor else None
+    items, more, total = page_of(directory, sort, order, file_type, after, limit)
+    return jsonify(
+        directory=directory,
+        files=[entry_json(e) for e in items],
+        next_cursor=encode_cursor(sort, order, file_type, directory, items[-1]) if more else None,
+        total=total,
+    )
+
+@app.route("/api/search")
+def search_files():
+    query = request.args.get('q', '').strip()
+    file_type = request.args.get('type') or None
+    directory = request.args.get('dir', '')
+    if directory:
+        directory = normalize_upload_name(directory)
+    if directory is None or (file_type and file_type not in FILE_TYPES + ['folder']):
+        abort(400)
+    min_size = request.args.get('min_size', type=int)
+    max_size = request.args.get('max_size', type=int)
+    content = request.args.get('content', '1' if SEARCH_CONTENT else '0') == '1'
+    limit = min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_query, after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, TypeError):
+            abort(400)
+        if cursor_query != query or not isinstance(after, str):
+            abort(400)
+    try:
+        items, more = CATALOG.search(query, file_type, directory, min_size, max_size, content, after, limit)
+    except sqlite3.OperationalError:
+        abort(503)
+    next_cursor = None
+    if more:
+        payload = json.dumps([query, items[-1]['name']], separators=(',', ':'))
+        next_cursor = base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+    return jsonify(query=query, files=[entry_json(e) for e in items], next_cursor=next_cursor)
+
+@app.route("/api/metadata/<path:filename>")
+def file_metadata(filename):
+    name = normalize_upload_name(filename)
+    record = CATALOG.lookup(name) if name else None
+    if record is None:
+        abort(404)
+    file_type, size, mtime, sha256, uploaded, accessed, cold = record
+    return jsonify(name=name, type=file_type, size=size, mtime=mtime, sha256=sha256, uploaded=uploaded,
+                   accessed=accessed, cold=bool(cold))
+
+@app.route("/api/folders", methods=["POST"])
+def create_folder():
+    payload = request.get_json(silent=True) or {}
+    name = normalize_upload_name(str(payload.get("path", "")))
+    if name is None:
+        abort(400)
+    try:
+        os.mkdir(upload_destination(name))
+    except FileExistsError:
+        abort(409)
+    FILE_INDEX.refresh(name)
+    return jsonify(name=name, browse_url=url_for('index', directory=name)), 201
+
+@app.route("/api/move", methods=["POST"])
+def move_entry():
+    payload = request.get_json(silent=True) or {}
+    source = normalize_upload_name(str(payload.get("source", "")))
+    destination = normalize_upload_name(str(payload.get("destination", "")))
+    if source is None or destination is None or destination == source or destination.startswith(source + "/"):
+        abort(400)
+    source_path = os.path.join(UPLOAD_FOLDER, source)
+    if not os.path.lexists(source_path):
+        abort(404)
+    destination_path = upload_destination(destination)
+    if os.path.lexists(destination_path):
+        abort(409)
+    try:
+        os.rename(source_path, destination_path)
+    except OSError:
+        abort(409)
+    MEMORY_CACHE.invalidate_tree(source_path)
+    FILE_INDEX.refresh_many([source, destination])
+    return jsonify(source=source, destination=destination)
+
+class StreamedFile:
+    # Part being written straight to a temp file next to its final path.
+    def __init__(self, filename):
+        self.filename = normalize_upload_name(filename)
+        if self.filename is None:
+            abort(400)
+        self.path = upload_destination(self.filename)
+        fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=".part", dir=os.path.dirname(self.path))
+        self.file = os.fdopen(fd, "wb")
+        self.digest = hashlib.sha256() if HASH_UPLOADS or STORAGE_MODE == "dedup" else None
+
+    def write(self, data):
+        self.file.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+
+    def commit(self):
+        self.file.close()
+        return store_file(self.temp_path, self.path, self.digest and self.digest.hexdigest())
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+class MultipartUploadParser:
+    # Sans-IO wrapper around MultipartDecoder that turns body chunks into
+    # ("file", filename), ("data", bytes) and ("end", None) steps, so the
+    # WSGI and ASGI upload paths share one parser.
+    def __init__(self, content_type, field="file"):
+        boundary = parse_options_header(content_type)[1].get("boundary")
+        if not boundary:
+            abort(400)
+        self.decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=2 * STREAM_CHUNK_SIZE)
+        self.field = field
+        self.in_file = False
+        self.received = 0
+        self.done = False
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if MAX_UPLOAD_SIZE and self.received > MAX_UPLOAD_SIZE:
+            abort(413)
+        try:
+            self.decoder.receive_data(chunk or None)
+            event = self.decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    self.in_file = event.name == self.field and bool(event.filename and event.filename.strip())
+                    if self.in_file:
+                        yield "file", event.filename
+                elif isinstance(event, Data) and self.in_file:
+                    yield "data", event.data
+                    if not event.more_data:
+                        self.in_file = False
+                        yield "end", None
+                event = self.decoder.next_event()
+        except ValueError:
+            abort(400)
+        if isinstance(event, Epilogue):
+            self.done = True
+        elif not chunk:
+            abort(400)
+
+def open_streamed_file(filename, skipped):
+    # A bad name or a clash with an existing file skips that one part
+    # instead of failing the rest of a folder upload.
+    try:
+        return StreamedFile(filename)
+    except HTTPException:
+        skipped.append(filename)
+        return None
+
+def commit_streamed_file(current, saved, skipped):
+    # Same for a folder of that name created while the part was arriving.
+    try:
+        saved[current.filename] = current.commit()
+    except IsADirectoryError:
+        current.discard()
+        skipped.append(current.filename)
+
+def stream_multipart_upload(stream, content_type, field="file", prefix=""):
+    # Incremental multipart parse of the request body; file parts never go
+    # through Werkzeug's spooled temp files.
+    parser = MultipartUploadParser(content_type, field)
+    current = None
+    saved = {}
+    skipped = []
+    try:
+        while not parser.done:
+            for step, value in parser.feed(stream.read(STREAM_CHUNK_SIZE)):
+                if step == "file":
+                    current = open_streamed_file(prefix + value, skipped)
+                elif current is None:
+                    continue
+                elif step == "data":
+                    current.write(value)
+                else:
+                    commit_streamed_file(current, saved, skipped)
+                    current = None
+        return saved, skipped
+    finally:
+        if current is not None:
+            current.discard()
+
+@app.route("/upload", methods=["POST"])
+def upload_file():
+    if MAX_UPLOAD_SIZE and (request.content_length or 0) > MAX_UPLOAD_SIZE:
+        abort(413)
+    # Plain form posts say which folder they were sent from; the page's
+    # script puts the folder into each file name instead.
+    directory = listing_directory(request.args.get("dir", ""))
+    prefix = directory + "/" if directory else ""
+    if STREAM_UPLOADS and request.mimetype == "multipart/form-data":
+        saved, skipped = stream_multipart_upload(request.stream, request.content_type, prefix=prefix)
+    else:
+        saved, skipped = {}, []
+        for file in request.files.getlist("file"):
+            filename = normalize_upload_name(prefix + file.filename) if file.filename else None
+            if filename is None:
+                if file.filename:
+                    skipped.append(file.filename)
+                continue
+            try:
+                filepath = upload_destination(filename)
+            except HTTPException:
+                skipped.append(filename)
+                continue
+            file.save(filepath)
+            saved[filename] = store_file(filepath, filepath)
+    # Any number of files (a whole folder) per request: one index update
+    # and one response at the end.
+    uploads_finished(saved)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(files=list(saved), count=len(saved), skipped=skipped)
+    return redirect(url_for("index", directory=directory or None))
+
+@app.route("/api/admin/storage")
+def storage_stats_api():
+    tiers = CATALOG.tier_stats() if COLD_TIER is not None else {}
+    return jsonify(mode=STORAGE_MODE, cold_storage=COLD_STORAGE or None, **CONTENT_STORE.stats(), **tiers)
+
+@app.route("/api/admin/cache")
+def memory_cache_api():
+    return jsonify(**MEMORY_CACHE.stats())
+
+@app.route("/api/replication/announce", methods=["POST"])
+def replication_announce_api():
+    payload = request.get_json(silent=True) or {}
+    if REPLICATOR is None:
+        abort(404)
+    if payload.get("origin") not in PEERS or not isinstance(payload.get("files"), list):
+        abort(403)
+    return jsonify(queued=REPLICATOR.receive(payload["origin"], payload["files"]))
+
+@app.route("/api/replication/status")
+def replication_status_api():
+    if REPLICATOR is None:
+        abort(404)
+    return jsonify(node=NODE_URL, active_downloads=ACTIVE_DOWNLOADS.value, pulling=len(REPLICATOR.pulling),
+                   peers={peer: load for peer, (load, _) in list(REPLICATOR.loads.items())})
+
+@app.route("/api/replication/manifest")
+def replication_manifest_api():
+    if REPLICATOR is None:
+        abort(404)
+    after = request.args.get("after", 0, type=float)
+    rows = CATALOG.uploaded_since(after, request.args.get("after_name", ""), CATALOG_BATCH_SIZE + 1)
+    files = [{'name': name, 'size': size, 'sha256': digest, 'uploaded': uploaded}
+             for name, size, digest, uploaded in rows[:CATALOG_BATCH_SIZE]]
+    return jsonify(files=files, more=len(rows) > CATALOG_BATCH_SIZE)
+
+@app.route("/api/precheck", methods=["POST"])
+def precheck_upload():
+    payload = request.get_json(silent=True) or {}
+    filename = normalize_upload_name(str(payload.get("filename", "")))
+    size = payload.get("size")
+    digest = str(payload.get("sha256", "")).lower()
+    if filename is None or not isinstance(size, int) or not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(400)
+    if STORAGE_MODE != "dedup" or not CONTENT_STORE.has(digest, size):
+        return jsonify(exists=False)
+    try:
+        CONTENT_STORE.link(digest, upload_destination(filename))
+    except FileNotFoundError:
+        return jsonify(exists=False)
+    upload_finished(filename, digest)
+    return jsonify(exists=True, name=filename, size=size)
+
+def upload_session_base(folder, upload_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        abort(404)
+    return os.path.join(folder, upload_id)
+
+def resumable_paths(upload_id):
+    base = upload_session_base(RESUMABLE_FOLDER, upload_id)
+    return base + ".json", base + ".part"
+
+def load_upload_session(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        abort(404)
+
+def save_upload_session(meta_path, session):
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(session, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+def parse_upload_metadata(header):
+    metadata = {}
+    for pair in filter(None, (item.strip() for item in header.split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ""
+        except ValueError:
+            abort(400)
+    return metadata
+
+def tus_headers(**headers):
+    return [("Tus-Resumable", TUS_VERSION), ("Cache-Control", "no-store")] + \
+        [(name.replace("_", "-"), str(value)) for name, value in headers.items()]
+
+def tus_response(status, **headers):
+    response = make_response("", status)
+    for name, value in tus_headers(**headers):
+        response.headers[name] = value
+    return response
+
+def finalize_resumable_upload(upload_id, session):
+    meta_path, part_path = resumable_paths(upload_id)
+    digest = store_file(part_path, upload_destination(session["filename"]))
+    os.remove(meta_path)
+    upload_finished(session["filename"], digest)
+
+def collect_stale_uploads(folder, max_age):
+    cutoff = time.time() - max_age
+    sessions = {}
+    for name in os.listdir(folder):
+        upload_id = name.partition(".")[0]
+        try:
+            mtime = os.stat(os.path.join(folder, name)).st_mtime
+        except FileNotFoundError:
+            continue
+        last_activity, names = sessions.get(upload_id, (0, []))
+        sessions[upload_id] = (max(last_activity, mtime), names + [name])
+    removed = 0
+    for last_activity, names in sessions.values():
+        if last_activity >= cutoff:
+            continue
+        for name in names:
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
+
+def start_upload_gc(interval, max_age):
+    def run():
+        while True:
+            for folder in (RESUMABLE_FOLDER, CHUNKED_FOLDER):
+                try:
+                    collect_stale_uploads(folder, max_age)
+                except OSError:
+                    pass
+            if STORAGE_MODE == "dedup":
+                try:
+                    CONTENT_STORE.collect_garbage(interval)
+                except OSError:
+                    pass
+            try:
+                prune_compressed_cache(COMPRESSED_CACHE_SIZE)
+            except OSError:
+                pass
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="resumable-gc", daemon=True).start()
+
+@app.route("/resumable", methods=["OPTIONS", "POST"])
+def create_resumable_upload():
+    if request.method == "OPTIONS":
+        return tus_response(204, Tus_Version=TUS_VERSION, Tus_Extension="creation,termination",
+                            **({"Tus_Max_Size": MAX_UPLOAD_SIZE} if MAX_UPLOAD_SIZE else {}))
+    length = request.headers.get("Upload-Length", type=int)
+    if length is None or length < 0:
+        abort(400)
+    if MAX_UPLOAD_SIZE and length > MAX_UPLOAD_SIZE:
+        abort(413)
+    filename = normalize_upload_name(parse_upload_metadata(request.headers.get("Upload-Metadata", "")).get("filename", ""))
+    if filename is None:
+        abort(400)
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path = resumable_paths(upload_id)
+    session = {"filename": filename, "length": length, "created": time.time()}
+    open(part_path, "xb").close()
+    save_upload_session(meta_path, session)
+    if length == 0:
+        finalize_resumable_upload(upload_id, session)
+    return tus_response(201, Location=url_for("resumable_upload", upload_id=upload_id), Upload_Offset=0)
+
+@app.route("/resumable/<upload_id>", methods=["HEAD", "PATCH", "DELETE"])
+def resumable_upload(upload_id):
+    meta_path, part_path = resumable_paths(upload_id)
+    session = load_upload_session(meta_path)
+    if request.method == "HEAD":
+        try:
+            committed = os.path.getsize(part_path)
+        except FileNotFoundError:
+            abort(404)
+        return tus_response(200, Upload_Offset=committed, Upload_Length=session["length"])
+    if request.method == "DELETE":
+        for path in (meta_path, part_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return tus_response(204)
+    if request.mimetype != "application/offset+octet-stream":
+        abort(415)
+    offset = request.headers.get("Upload-Offset", type=int)
+    if offset is None:
+        abort(400)
+    session, f, committed = open_resumable_append(upload_id, offset)
+    if f is None:
+        return tus_response(409, Upload_Offset=committed)
+    remaining = session["length"] - committed
+    try:
+        while True:
+            chunk = request.stream.read(min(STREAM_CHUNK_SIZE, remaining + 1))
+            if not chunk:
+                break
+            if len(chunk) > remaining:
+                abort(413)
+            f.write(chunk)
+            remaining -= len(chunk)
+    except ClientDisconnected:
+        pass
+    finally:
+        committed = close_resumable_append(upload_id, session, f)
+    return tus_response(204, Upload_Offset=committed)
+
+def open_resumable_append(upload_id, offset):
+    # (session, part file, committed size) for a PATCH at offset, with the
+    # part locked and positioned at its end; the file is None when the
+    # client is out of step and gets a 409 with the committed offset. A
+    # part that a finished upload has moved into place is a 404.
+    meta_path, part_path = resumable_paths(upload_id)
+    session = load_upload_session(meta_path)
+    try:
+        f = open(part_path, "r+b")
+    except FileNotFoundError:
+        abort(404)
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        abort(423)
+    try:
+        moved = not os.path.samestat(os.fstat(f.fileno()), os.stat(part_path))
+    except FileNotFoundError:
+        moved = True
+    if moved:
+        f.close()
+        abort(404)
+    committed = os.fstat(f.fileno()).st_size
+    if offset != committed:
+        f.close()
+        return session, None, committed
+    f.seek(committed)
+    return session, f, committed
+
+def close_resumable_append(upload_id, session, f):
+    # Makes what arrived durable, then finalizes a complete upload while
+    # the part is still locked.
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+        committed = f.tell()
+        if committed == session["length"]:
+            finalize_resumable_upload(upload_id, session)
+    finally:
+        f.close()
+    return committed
+
+def chunked_paths(upload_id):
+    base = upload_session_base(CHUNKED_FOLDER, upload_id)
+    return base + ".json", base + ".part", base + ".map"
+
+@app.route("/chunked", methods=["POST"])
+def create_chunked_upload():
+    payload = request.get_json(silent=True) or {}
+    filename = normalize_upload_name(str(payload.get("filename", "")))
+    size = payload.get("size")
+    if filename is None or not isinstance(size, int) or size < 0:
+        abort(400)
+    if MAX_UPLOAD_SIZE and size > MAX_UPLOAD_SIZE:
+        abort(413)
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path, map_path = chunked_paths(upload_id)
+    chunk_count = max(1, -(-size // CHUNK_UPLOAD_SIZE))
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        if size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    with open(map_path, "wb") as f:
+        f.write(b"\0" * chunk_count)
+    session = {"filename": filename, "size": size, "chunk_size": CHUNK_UPLOAD_SIZE,
+               "chunk_count": chunk_count, "created": time.time()}
+    save_upload_session(meta_path, session)
+    return jsonify(id=upload_id, chunk_size=CHUNK_UPLOAD_SIZE, chunk_count=chunk_count,
+                   concurrency=CHUNK_UPLOAD_CONCURRENCY), 201
+
+def chunk_target(upload_id, index, content_length):
+    # (part path, map path, offset, expected length) for one chunk PUT.
+    meta_path, part_path, map_path = chunked_paths(upload_id)
+    session = load_upload_session(meta_path)
+    if index >= session["chunk_count"]:
+        abort(404)
+    offset = index * session["chunk_size"]
+    expected = min(session["chunk_size"], session["size"] - offset)
+    if content_length is not None and content_length != expected:
+        abort(400)
+    return part_path, map_path, offset, expected
+
+def mark_chunk_received(map_path, index):
+    fd = os.open(map_path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, b"\1", index)
+    finally:
+        os.close(fd)
+
+@app.route("/chunked/<upload_id>/<int:index>", methods=["PUT"])
+def upload_chunk(upload_id, index):
+    part_path, map_path, offset, expected = chunk_target(upload_id, index, request.content_length)
+    written = 0
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        while written < expected:
+            chunk = request.stream.read(min(STREAM_CHUNK_SIZE, expected - written))
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset + written)
+            written += len(chunk)
+    finally:
+        os.close(fd)
+    if written != expected or request.stream.read(1):
+        abort(400)
+    mark_chunk_received(map_path, index)
+    return "", 204
+
+@app.route("/chunked/<upload_id>/complete", methods=["POST"])
+def complete_chunked_upload(upload_id):
+    # Completes of one session (a client retrying after a lost response)
+    # run one at a time under the map's lock; those after the first find
+    # the session gone and get a 404.
+    meta_path, part_path, map_path = chunked_paths(upload_id)
+    session = load_upload_session(meta_path)
+    try:
+        f = open(map_path, "rb")
+    except FileNotFoundError:
+        abort(404)
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if not os.path.samestat(os.fstat(f.fileno()), os.stat(map_path)):
+                abort(404)
+        except FileNotFoundError:
+            abort(404)
+        received = f.read()
+        missing = [i for i, flag in enumerate(received) if not flag]
+        if missing:
+            return jsonify(error="missing chunks", missing=missing[:100]), 409
+        try:
+            fd = os.open(part_path, os.O_RDONLY)
+        except FileNotFoundError:
+            abort(404)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        digest = store_file(part_path, upload_destination(session["filename"]))
+        os.remove(map_path)
+        os.remove(meta_path)
+    upload_finished(session["filename"], digest)
+    elapsed = max(time.time() - session["created"], 1e-6)
+    return jsonify(name=session["filename"], size=session["size"], seconds=round(elapsed, 3),
+                   bytes_per_second=round(session["size"] / elapsed))
+
+def read_file_range(path, start, stop):
+    with open_upload(path) as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining:
+            data = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+def byteranges_response(response, path, ranges, size):
+    spans = []
+    for start, stop in ranges.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            spans.append((start, stop))
+    if not spans:
+        raise RequestedRangeNotSatisfiable(length=size)
+    boundary = uuid.uuid4().hex
+    content_type = response.headers["Content-Type"]
+    parts = [("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+              % (boundary, content_type, start, stop - 1, size)).encode() for start, stop in spans]
+    closing = ("\r\n--%s--\r\n" % boundary).encode()
+
+    def generate():
+        for header, (start, stop) in zip(parts, spans):
+            yield header
+            yield from read_file_range(path, start, stop)
+        yield closing
+
+    partial = app.response_class(generate(), status=206, mimetype="multipart/byteranges")
+    partial.headers["Content-Type"] = "multipart/byteranges; boundary=%s" % boundary
+    partial.content_length = sum(len(h) + stop - start for h, (start, stop) in zip(parts, spans)) + len(closing)
+    for header in ("ETag", "Last-Modified", "Cache-Control", "Content-Disposition", "Vary"):
+        if header in response.headers:
+            partial.headers[header] = response.headers[header]
+    partial.accept_ranges = "bytes"
+    response.close()
+    return partial
+
+class BrotliCompressObj:
+    # zlib-style compress()/flush() interface over brotli.Compressor.
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def download_encodings():
+    encodings = []
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings + ['gzip']
+
+def make_compressor(encoding):
+    # Levels favour speed: a variant is compressed once and then cached.
+    if encoding == 'br':
+        return BrotliCompressObj(5)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+def is_compressible_upload(filename, mime_type):
+    return get_file_type(filename) == 'text' or is_compressible_mimetype(mime_type or '')
+
+def compressed_cache_path(path, st, encoding):
+    key = hashlib.sha1(os.path.relpath(path, UPLOAD_FOLDER).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(COMPRESSED_FOLDER, "%s-%d-%d.%s" % (key, st.st_mtime_ns, st.st_size, encoding))
+
+def stream_compressed(path, cache_path, encoding):
+    # Compresses while sending and keeps the result only if the whole file
+    # made it through, so an aborted download never leaves a partial variant.
+    compressor = make_compressor(encoding)
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=COMPRESSED_FOLDER)
+    try:
+        with os.fdopen(fd, "wb") as cache, open_upload(path) as source:
+            while True:
+                block = source.read(STREAM_CHUNK_SIZE)
+                data = compressor.compress(block) if block else compressor.flush()
+                if data:
+                    cache.write(data)
+                    yield data
+                if not block:
+                    break
+        os.replace(temp_path, cache_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def compressed_response(response, path, encoding):
+    st = os.stat(path)
+    cache_path = compressed_cache_path(path, st, encoding)
+    try:
+        cached = MEMORY_CACHE.get(cache_path, os.stat(cache_path))
+        if cached is not None:
+            compressed = app.response_class(cached[0])
+        else:
+            compressed = send_file(cache_path, conditional=False, etag=False)
+        os.utime(cache_path)
+    except FileNotFoundError:
+        # direct_passthrough keeps make_conditional() from reading the whole
+        # generator to compute a Content-Length.
+        compressed = app.response_class(stream_compressed(path, cache_path, encoding), direct_passthrough=True)
+    for header in ("Content-Type", "Content-Disposition", "Last-Modified", "Cache-Control"):
+        if header in response.headers:
+            compressed.headers[header] = response.headers[header]
+    compressed.content_encoding = encoding
+    compressed.vary.add('Accept-Encoding')
+    compressed.set_etag('%s-%s' % (response.get_etag()[0], encoding))
+    response.close()
+    return compressed.make_conditional(request)
+
+def prune_compressed_cache(max_bytes):
+    # Drops the least recently served variants (hits touch their mtime),
+    # along with variants of files that have since changed.
+    entries = []
+    with os.scandir(COMPRESSED_FOLDER) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+class MemoryCache:
+    # Contents of small files, least recently used out first once max_bytes
+    # is reached. Entries are kept per path and served only while mtime and
+    # size still match the file; uploads and moves drop them straight away.
+    def __init__(self, max_bytes, max_file):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, st):
+        # (contents, memo) of the file, read and kept on a miss; None when
+        # it is too big to cache. memo is a dict that lives as long as the
+        # entry, for callers to keep whatever they derive from the contents.
+        if not self.max_bytes or st.st_size > min(self.max_file, self.max_bytes):
+            return None
+        version = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1:]
+            self.misses += 1
+        with open_upload(path) as f:
+            data = f.read(st.st_size + 1)
+        if len(data) != st.st_size:
+            return None
+        entry = (version, data, {})
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+            self.entries[path] = entry
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+        return entry[1:]
+
+    def invalidate(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.bytes -= len(entry[1])
+
+    def invalidate_tree(self, path):
+        with self.lock:
+            for name in [p for p in self.entries if p == path or p.startswith(path + os.sep)]:
+                self.bytes -= len(self.entries.pop(name)[1])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'max_file_bytes': self.max_file,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+MEMORY_CACHE = MemoryCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_MAX_FILE)
+
+def cached_upload(path, as_attachment):
+    # The response send_from_directory would make (same headers and ETag)
+    # for a small file, from MEMORY_CACHE; None if it is not cacheable.
+    if path is None or not MEMORY_CACHE.max_bytes:
+        return None
+    try:
+        st = os.stat(path)
+        cached = MEMORY_CACHE.get(path, st) if stat.S_ISREG(st.st_mode) else None
+    except STORAGE_ERRORS:
+        return None
+    if cached is None:
+        return None
+    data, memo = cached
+    # Building the headers costs about as much as reading the file, so
+    # they are kept with it.
+    headers = memo.get(as_attachment)
+    if headers is None:
+        etag = "%s-%s-%s" % (st.st_mtime, st.st_size, zlib.adler32(path.encode()) & 0xFFFFFFFF)
+        response = send_file(io.BytesIO(data), download_name=os.path.basename(path), as_attachment=as_attachment,
+                             conditional=False, etag=etag, last_modified=st.st_mtime)
+        headers = memo[as_attachment] = list(response.headers.items())
+    return app.response_class([data], headers=headers, direct_passthrough=True)
+
+def set_content_digest(response, filename, path):
+    # A catalog hash that still matches the file on disk makes a strong,
+    # content-based ETag (unchanged by moves and identical re-uploads).
+    record = CATALOG.lookup(normalize_upload_name(filename) or filename)
+    if record is None or not record[3]:
+        return
+    st = os.stat(path)
+    if (record[1], record[2]) == (st.st_size, st.st_mtime):
+        response.set_etag(record[3])
+        response.headers["Repr-Digest"] = "sha-256=:%s:" % base64.b64encode(bytes.fromhex(record[3])).decode()
+
+def send_upload(filename, as_attachment=False):
+    # send_from_directory only understands single ranges and lets Range win
+    # over If-None-Match; evaluate preconditions in RFC 9110 order and add
+    # multipart/byteranges responses on top.
+    filename = normalize_upload_name(filename)
+    if filename is None:
+        # .hub state and in-flight temp files are never served.
+        abort(404)
+    path = safe_join(UPLOAD_FOLDER, filename)
+    response = cached_upload(path, as_attachment)
+    cached = response is not None
+    cold = None
+    if not cached:
+        response = send_from_directory(UPLOAD_FOLDER, filename, as_attachment=as_attachment, conditional=False)
+        cold = demoted_digest(path)
+    size = response.content_length
+    CATALOG.touch(filename)
+    if cold is not None:
+        # Streamed from the cold tier as it is read, never copied back. The
+        # wrapper is seekable, so a range fetches only the bytes it covers.
+        response.close()
+        if COLD_TIER is None:
+            abort(503)
+        response.response = FileWrapper(open_cold(cold, size), STREAM_CHUNK_SIZE)
+    set_content_digest(response, filename, path)
+    etag = response.headers.get("ETag")
+    last_modified = response.last_modified
+    if request.if_match and not request.if_match.contains_raw(etag or "") and not request.if_match.star_tag:
+        response.close()
+        abort(412)
+    if request.if_unmodified_since and last_modified and last_modified > request.if_unmodified_since:
+        response.close()
+        abort(412)
+    compressible = COMPRESS_DOWNLOADS and is_compressible_upload(filename, response.mimetype)
+    if compressible:
+        response.vary.add('Accept-Encoding')
+        # Ranges address the identity bytes, so ranged requests are never
+        # compressed; that keeps resume and seeking correct.
+        encoding = request.accept_encodings.best_match(download_encodings())
+        if encoding and not request.range and (size or 0) >= COMPRESS_MIN_SIZE:
+            return compressed_response(response, path, encoding)
+    environ = request.environ
+    if not is_resource_modified(environ, etag, last_modified=last_modified) or (
+            request.range and len(request.range.ranges) > MAX_BYTE_RANGES):
+        environ = dict(environ)
+        environ.pop("HTTP_RANGE", None)
+    elif request.range and len(request.range.ranges) > 1 and size and (
+            "HTTP_IF_RANGE" not in environ or
+            not is_resource_modified(environ, etag, last_modified=last_modified, ignore_if_range=False)):
+        return byteranges_response(response, path, request.range, size)
+    response.make_conditional(environ, accept_ranges=True, complete_length=size)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if response.status_code == 206 and file_wrapper is not None and not cached and cold is None:
+        # Werkzeug serves ranges through an iterator, which defeats the
+        # server's sendfile; hand it a pre-seeked file instead.
+        f = open(path, "rb")
+        f.seek(response.content_range.start)
+        response.close()
+        response.response = file_wrapper(f, STREAM_CHUNK_SIZE)
+    return response
+
+@app.route("/files/<path:filename>")
+def download_file(filename):
+    if REPLICATOR is not None and PEER_DOWNLOADS != "off" and "replica" not in request.args:
+        peer = REPLICATOR.offload(normalize_upload_name(filename) or filename)
+        if peer is not None:
+            try:
+                return peer_download(peer, filename)
+            except OSError:
+                pass
+    return track_download(send_upload(filename, as_attachment=True))
+
+@app.route("/view/<path:filename>")
+def view_file(filename):
+    return track_download(send_upload(filename))
+
+PROXIED_REQUEST_HEADERS = ["Range", "If-Range", "If-Match", "If-None-Match", "If-Modified-Since",
+                           "If-Unmodified-Since", "Accept-Encoding"]
+PROXIED_RESPONSE_HEADERS = ["Content-Type", "Content-Length", "Content-Range", "Content-Disposition",
+                            "Content-Encoding", "Accept-Ranges", "ETag", "Last-Modified", "Repr-Digest", "Vary"]
+
+def peer_download(peer, filename):
+    # The same download from a peer: a redirect, or relayed through this
+    # node for clients that cannot reach the peer directly.
+    url = peer_file_url(peer, filename)
+    if PEER_DOWNLOADS == "redirect":
+        return redirect(url, code=307)
+    upstream = peer_request(url, headers={name: request.headers[name] for name in PROXIED_REQUEST_HEADERS
+                                          if name in request.headers})
+    if upstream.status >= 500:
+        upstream.close()
+        raise OSError("%s answered %d" % (peer, upstream.status))
+    response = app.response_class(iter(lambda: upstream.read(STREAM_CHUNK_SIZE), b""), status=upstream.status,
+                                  headers=[(name, upstream.headers[name]) for name in PROXIED_RESPONSE_HEADERS
+                                           if name in upstream.headers])
+    response.call_on_close(upstream.close)
+    return track_download(response)
+
+def track_download(response):
+    with ACTIVE_DOWNLOADS.get_lock():
+        ACTIVE_DOWNLOADS.value += 1
+
+    def finished():
+        with ACTIVE_DOWNLOADS.get_lock():
+            ACTIVE_DOWNLOADS.value -= 1
+
+    when_sent(response, finished)
+    return response
+
+def when_sent(response, callback):
+    # Calls callback once the server has closed the body. Werkzeug hands
+    # passthrough bodies (files, possibly in the server's sendfile wrapper)
+    # straight to the server and never calls Response.close for them, so
+    # the body's own close is hooked instead.
+    body = response.response
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return
+    close = getattr(body, "close", None)
+
+    def closed():
+        try:
+            close()
+        finally:
+            callback()
+
+    try:
+        if close is None:
+            raise AttributeError
+        body.close = closed
+    except AttributeError:
+        response.response = ClosingIterator(body, callback)
+
+def detect_encoding(sample):
+    # BOMs first, then a strict UTF-8 decode of the sample (a character
+    # cut off at the end of the sample is fine); NULs elsewhere mean binary.
+    for bom, encoding in ((b"\xef\xbb\xbf", "utf-8-sig"), (b"\xff\xfe", "utf-16-le"), (b"\xfe\xff", "utf-16-be")):
+        if sample.startswith(bom):
+            return encoding, len(bom)
+    if b"\x00" in sample:
+        return None, 0
+    try:
+        sample.decode("utf-8")
+        return "utf-8", 0
+    except UnicodeDecodeError as error:
+        if error.start >= len(sample) - 3 and error.reason == "unexpected end of data":
+            return "utf-8", 0
+    return "cp1252", 0
+
+class LineIndex:
+    # Sparse map of line number -> byte offset (every LINE_INDEX_STEP lines),
+    # extended only as far as a request needs, so a jump to line n scans at
+    # most LINE_INDEX_STEP lines once the index has reached it.
+    def __init__(self, path, start):
+        self.path = path
+        self.checkpoints = [start]
+        self.scanned_lines = 0
+        self.scanned_to = start
+        self.complete = False
+        self.lock = threading.Lock()
+
+    def _extend(self, line):
+        with open_upload(self.path) as f:
+            f.seek(self.scanned_to)
+            while not self.complete and len(self.checkpoints) * LINE_INDEX_STEP <= line:
+                block = f.read(STREAM_CHUNK_SIZE)
+                if not block:
+                    self.complete = True
+                    break
+                position = 0
+                while True:
+                    position = block.find(b"\n", position) + 1
+                    if not position:
+                        break
+                    self.scanned_lines += 1
+                    if self.scanned_lines % LINE_INDEX_STEP == 0:
+                        self.checkpoints.append(self.scanned_to + position)
+                self.scanned_to += len(block)
+
+    def offset(self, line):
+        with self.lock:
+            self._extend(line)
+            checkpoint = min(line // LINE_INDEX_STEP, len(self.checkpoints) - 1)
+            offset = self.checkpoints[checkpoint]
+        skip = line - checkpoint * LINE_INDEX_STEP
+        with open_upload(self.path) as f:
+            f.seek(offset)
+            while skip:
+                block = f.read(STREAM_CHUNK_SIZE)
+                if not block:
+                    return None
+                position = 0
+                while skip:
+                    found = block.find(b"\n", position)
+                    if found < 0:
+                        break
+                    position = found + 1
+                    skip -= 1
+                offset += position if not skip else len(block)
+        return offset
+
+LINE_INDEXES = collections.OrderedDict()
+LINE_INDEXES_LOCK = threading.Lock()
+
+def line_index(path, st, start):
+    key = (path, st.st_mtime_ns, st.st_size)
+    with LINE_INDEXES_LOCK:
+        index = LINE_INDEXES.pop(key, None) or LineIndex(path, start)
+        LINE_INDEXES[key] = index
+        while len(LINE_INDEXES) > LINE_INDEX_CACHE_SIZE:
+            LINE_INDEXES.popitem(last=False)
+    return index
+
+def align_offset(data, encoding):
+    # Number of leading bytes to drop so decoding starts on a character.
+    skip = 0
+    if encoding.startswith("utf-8"):
+        while skip < min(len(data), 3) and 0x80 <= data[skip] < 0xc0:
+            skip += 1
+    return skip
+
+def line_ends(data, newline):
+    # Offsets just past each newline; UTF-16 newlines must be aligned.
+    position = data.find(newline)
+    while position >= 0:
+        if position % len(newline) == 0:
+            yield position + len(newline)
+        position = data.find(newline, position + 1)
+
+def trim_partial_character(data, encoding):
+    if encoding.startswith("utf-16"):
+        return data[:len(data) - len(data) % 2]
+    if not encoding.startswith("utf-8"):
+        return data
+    for back in range(1, min(len(data), 4) + 1):
+        byte = data[-back]
+        if byte < 0x80:
+            return data
+        if byte >= 0xc0:
+            width = 2 if byte < 0xe0 else 3 if byte < 0xf0 else 4
+            return data[:-back] if width > back else data
+    return data
+
+@app.route("/api/preview/<path:filename>")
+def preview_text(filename):
+    name = normalize_upload_name(filename)
+    path = name and safe_join(UPLOAD_FOLDER, name)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    st = os.stat(path)
+    with open_upload(path) as f:
+        encoding, bom = detect_encoding(f.read(PREVIEW_SNIFF_SIZE))
+    if encoding is None:
+        abort(415)
+    limit = min(max(request.args.get("limit", PREVIEW_CHUNK_SIZE, type=int), 1), PREVIEW_MAX_CHUNK_SIZE)
+    line = request.args.get("line", type=int)
+    if line is not None:
+        if line < 0 or encoding.startswith("utf-16"):
+            abort(400)
+        offset = line_index(path, st, bom).offset(line)
+        if offset is None:
+            offset = st.st_size
+    else:
+        offset = max(request.args.get("offset", bom, type=int), bom)
+        if encoding.startswith("utf-16"):
+            offset -= (offset - bom) % 2
+    lines = request.args.get("lines", type=int)
+    with open_upload(path) as f:
+        f.seek(offset)
+        data = f.read(limit)
+    skip = align_offset(data, encoding) if line is None else 0
+    data = data[skip:]
+    offset += skip
+    codec = encoding.replace("-sig", "")
+    ends = list(line_ends(data, "\n".encode(codec)))
+    if lines is not None and lines > 0 and len(ends) >= lines:
+        data = data[:ends[lines - 1]]
+    elif offset + len(data) < st.st_size:
+        # End pages on a line boundary when there is one, so the next page
+        # starts at the beginning of a line.
+        data = data[:ends[-1]] if ends else trim_partial_character(data, encoding)
+    end = offset + len(data)
+    text = data.decode(codec, errors="replace")
+    response = jsonify(name=filename, size=st.st_size, encoding=encoding, offset=offset, end=end,
+                       eof=end >= st.st_size, line=line, text=text)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route("/derivatives/<digest>/<kind>.jpg")
+def derivative_file(digest, kind):
+    if not re.fullmatch(r"[0-9a-f]{64}", digest) or kind not in ('thumb', 'preview'):
+        abort(404)
+    try:
+        response = send_file(derivatives.derivative_path(DERIVATIVES_FOLDER, digest, kind), mimetype='image/jpeg',
+                             max_age=ASSET_MAX_AGE)
+    except FileNotFoundError:
+        abort(404)
+    # Keyed by content hash, so a URL never changes meaning.
+    response.cache_control.no_cache = None
+    response.cache_control.immutable = True
+    return response
+
+def is_precompressed(name):
+    mime_type = mimetypes.guess_type(name)[0] or ''
+    if is_compressible_mimetype(mime_type) or mime_type in UNCOMPRESSED_MEDIA_TYPES:
+        return False
+    return get_file_type(name) in ('image', 'video', 'audio', 'word', 'excel', 'powerpoint') or \
+        os.path.splitext(name)[1].lower() in PRECOMPRESSED_EXTENSIONS
+
+def walk_upload_files(name):
+    # Files below a folder in sorted order, so an archive of the same
+    # content always has the same layout.
+    with os.scandir(os.path.join(UPLOAD_FOLDER, name)) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if is_internal_name(entry.name):
+            continue
+        child = name + "/" + entry.name
+        if entry.is_dir() and not entry.is_symlink():
+            yield from walk_upload_files(child)
+        elif entry.is_file():
+            yield child
+
+def archive_members(paths):
+    # (path, name inside the archive, stat) for each selected file, with
+    # folders expanded; names are relative to the selection's parent.
+    members = []
+    seen = set()
+    for raw in paths:
+        name = normalize_upload_name(raw)
+        path = name and safe_join(UPLOAD_FOLDER, name)
+        if not path or not os.path.exists(path):
+            abort(404)
+        base = posixpath.dirname(name)
+        for selected in walk_upload_files(name) if os.path.isdir(path) else [name]:
+            if selected in seen:
+                continue
+            seen.add(selected)
+            try:
+                st = os.stat(os.path.join(UPLOAD_FOLDER, selected))
+            except FileNotFoundError:
+                continue
+            members.append((os.path.join(UPLOAD_FOLDER, selected), selected[len(base) + 1:] if base else selected, st))
+    if not members:
+        abort(404)
+    return members
+
+class ArchiveSink:
+    # Unseekable write target for zipfile; the generator drains it after
+    # every block, so memory stays at about one block per download.
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(members):
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, "w", compresslevel=6) as archive:
+        for path, arcname, st in members:
+            info = zipfile.ZipInfo(arcname, date_time=max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            info.file_size = st.st_size
+            info.compress_type = zipfile.ZIP_STORED if is_precompressed(arcname) else zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open_upload(path) as source, archive.open(info, "w") as target:
+                while True:
+                    block = source.read(STREAM_CHUNK_SIZE)
+                    if not block:
+                        break
+                    target.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
+
+def tar_layout(members):
+    # A tar stream is a fixed sequence of header, file data and zero
+    # padding, so its length and any byte offset are known before sending.
+    pieces = []
+    for path, arcname, st in members:
+        info = tarfile.TarInfo(arcname)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+        pieces.append(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        pieces.append((path, st.st_size))
+        if st.st_size % tarfile.BLOCKSIZE:
+            pieces.append(tarfile.NUL * (tarfile.BLOCKSIZE - st.st_size % tarfile.BLOCKSIZE))
+    pieces.append(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    return pieces
+
+def piece_length(piece):
+    return piece[1] if isinstance(piece, tuple) else len(piece)
+
+def stream_tar(pieces, start, stop):
+    position = 0
+    for piece in pieces:
+        length = piece_length(piece)
+        begin, end = max(start - position, 0), min(stop - position, length)
+        position += length
+        if begin >= end:
+            continue
+        if not isinstance(piece, tuple):
+            yield piece[begin:end]
+            continue
+        sent = begin
+        for data in read_file_range(piece[0], begin, end):
+            sent += len(data)
+            yield data
+        if sent < end:
+            # The file shrank after the headers were laid out; keep the
+            # promised length so the archive stays well-formed.
+            yield tarfile.NUL * (end - sent)
+
+@app.route("/archive.<any(zip, tar):archive_format>", methods=["GET", "POST"])
+def download_archive(archive_format):
+    paths = request.values.getlist("path")
+    if not paths:
+        abort(400)
+    members = archive_members(paths)
+    if len(paths) == 1:
+        download_name = "%s.%s" % (posixpath.basename(normalize_upload_name(paths[0])), archive_format)
+    else:
+        download_name = "files.%s" % archive_format
+    layout = json.dumps([[arcname, st.st_size, st.st_mtime_ns] for _, arcname, st in members])
+    etag = hashlib.sha256((archive_format + layout).encode("utf-8", "surrogateescape")).hexdigest()[:32]
+    if archive_format == "zip":
+        # direct_passthrough keeps make_conditional() from buffering the
+        # whole generator to compute a Content-Length.
+        response = app.response_class(stream_zip(members), mimetype="application/zip", direct_passthrough=True)
+    else:
+        pieces = tar_layout(members)
+        total = sum(piece_length(piece) for piece in pieces)
+        response = app.response_class(stream_tar(pieces, 0, total), mimetype="application/x-tar")
+        response.content_length = total
+    response.headers["Content-Disposition"] = "attachment; filename*=UTF-8''%s" % urllib.parse.quote(download_name)
+    response.set_etag(etag)
+    if archive_format == "zip":
+        return response.make_conditional(request)
+    response.make_conditional(request, accept_ranges=True, complete_length=total)
+    if response.status_code == 206:
+        # Werkzeug would skip to the range by reading everything before it.
+        response.response = stream_tar(pieces, response.content_range.start, response.content_range.stop)
+    return response
+
+class AsyncFileWrapper:
+    # wsgi.file_wrapper for the ASGI engine: lets a Flask response hand its
+    # open file back so the body is streamed with thread-offloaded reads.
+    def __init__(self, filelike, block_size=STREAM_CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b"")
+
+    def close(self):
+        self.filelike.close()
+
+class AsgiInput:
+    # Blocking wsgi.input fed from the ASGI receive channel, for routes that
+    # run through the Flask app in a worker thread.
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.finished = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        self.buffer += message.get("body", b"")
+        self.finished = not message.get("more_body", False)
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while not self.finished and b"\n" not in self.buffer and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        return self.read(end if size < 0 else min(end, size))
+
+def asgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": AsyncFileWrapper,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1])
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ else value
+    if "CONTENT_LENGTH" not in environ:
+        environ["wsgi.input_terminated"] = True
+    return environ
+
+async def asgi_send_simple(send, status, headers=(), body=b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers] +
+                           ([] if status in (204, 304) else [(b"content-length", str(len(body)).encode())])})
+    await send({"type": "http.response.body", "body": body})
+
+async def asgi_wsgi_bridge(scope, receive, send):
+    # Runs the Flask view in a worker thread only long enough to build the
+    # response; file bodies are then streamed from the event loop.
+    loop = asyncio.get_running_loop()
+    environ = asgi_environ(scope, AsgiInput(receive, loop))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+        return lambda data: None
+
+    app_iter = await asyncio.to_thread(app, environ, start_response)
+    try:
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        if isinstance(app_iter, AsyncFileWrapper):
+            length = dict(started["headers"]).get(b"content-length")
+            remaining = int(length) if length is not None else None
+            while remaining is None or remaining > 0:
+                size = app_iter.block_size if remaining is None else min(app_iter.block_size, remaining)
+                data = await asyncio.to_thread(app_iter.filelike.read, size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+        else:
+            iterator = iter(app_iter)
+            while True:
+                data = await asyncio.to_thread(next, iterator, None)
+                if data is None:
+                    break
+                if data:
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(app_iter, "close"):
+            await asyncio.to_thread(app_iter.close)
+
+async def asgi_upload(scope, receive, send, headers):
+    # Native async counterpart of upload_file(): the body is parsed as it
+    # arrives and only the disk writes are offloaded to threads.
+    if MAX_UPLOAD_SIZE and int(headers.get("content-length") or 0) > MAX_UPLOAD_SIZE:
+        abort(413)
+    parser = MultipartUploadParser(headers["content-type"])
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    directory = listing_directory(query.get("dir", [""])[0])
+    prefix = directory + "/" if directory else ""
+    current = None
+    pending = bytearray()
+    saved = {}
+    skipped = []
+    try:
+        while not parser.done:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            chunks = [message.get("body", b"")]
+            if not message.get("more_body", False):
+                chunks.append(b"")
+            for chunk in chunks:
+                if parser.done or (not chunk and len(chunks) == 1):
+                    continue
+                for step, value in parser.feed(chunk):
+                    if step == "file":
+                        current = await asyncio.to_thread(open_streamed_file, prefix + value, skipped)
+                    elif current is None:
+                        continue
+                    elif step == "data":
+                        pending += value
+                        if len(pending) >= STREAM_CHUNK_SIZE:
+                            await asyncio.to_thread(current.write, bytes(pending))
+                            pending.clear()
+                    else:
+                        await asyncio.to_thread(current.write, bytes(pending))
+                        pending.clear()
+                        await asyncio.to_thread(commit_streamed_file, current, saved, skipped)
+                        current = None
+    finally:
+        if current is not None:
+            await asyncio.to_thread(current.discard)
+    await asyncio.to_thread(uploads_finished, saved)
+    accept = dict(scope["headers"]).get(b"accept", b"").decode("latin-1")
+    if accept.split(",")[0].split(";")[0].strip() == "application/json":
+        await asgi_send_simple(send, 200, [("content-type", "application/json")],
+                               json.dumps({"files": list(saved), "count": len(saved), "skipped": skipped}).encode())
+        return
+    location = "/browse/" + urllib.parse.quote(directory) if directory else "/"
+    await asgi_send_simple(send, 302, [("location", scope.get("root_path", "") + location)])
+
+async def asgi_body_blocks(receive):
+    # The request body in blocks of about STREAM_CHUNK_SIZE, as it arrives.
+    pending = bytearray()
+    more = True
+    while more:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        pending += message.get("body", b"")
+        more = message.get("more_body", False)
+        if len(pending) >= STREAM_CHUNK_SIZE or (pending and not more):
+            yield bytes(pending)
+            pending.clear()
+
+async def asgi_upload_chunk(scope, receive, send, headers, upload_id, index):
+    # Native counterpart of upload_chunk(): waiting on a slow client costs
+    # no thread, only each pwrite does.
+    length = headers.get("content-length", "")
+    part_path, map_path, offset, expected = await asyncio.to_thread(
+        chunk_target, upload_id, index, int(length) if length.isdigit() else None)
+    written = 0
+    fd = await asyncio.to_thread(os.open, part_path, os.O_WRONLY)
+    try:
+        async for block in asgi_body_blocks(receive):
+            if written + len(block) > expected:
+                abort(400)
+            await asyncio.to_thread(os.pwrite, fd, block, offset + written)
+            written += len(block)
+    finally:
+        os.close(fd)
+    if written != expected:
+        abort(400)
+    await asyncio.to_thread(mark_chunk_received, map_path, index)
+    await asgi_send_simple(send, 204)
+
+async def asgi_resumable_patch(scope, receive, send, headers, upload_id):
+    # Native counterpart of a tus PATCH to resumable_upload().
+    if parse_options_header(headers.get("content-type", ""))[0] != "application/offset+octet-stream":
+        abort(415)
+    offset = headers.get("upload-offset", "")
+    if not offset.isdigit():
+        abort(400)
+    session, f, committed = await asyncio.to_thread(open_resumable_append, upload_id, int(offset))
+    if f is None:
+        await asgi_send_simple(send, 409, tus_headers(Upload_Offset=committed))
+        return
+    remaining = session["length"] - committed
+    try:
+        async for block in asgi_body_blocks(receive):
+            if len(block) > remaining:
+                abort(413)
+            await asyncio.to_thread(f.write, block)
+            remaining -= len(block)
+    except ClientDisconnected:
+        pass
+    finally:
+        committed = await asyncio.to_thread(close_resumable_append, upload_id, session, f)
+    await asgi_send_simple(send, 204, tus_headers(Upload_Offset=committed))
+
+def asgi_native_handler(scope, headers):
+    # (handler, route, view arguments) for the requests the async engine
+    # serves itself, or (None, None, {}). Upload bodies are received on the
+    # event loop; a slow client must not hold one of the few bridge threads
+    # for the whole transfer.
+    if scope["method"] not in ("POST", "PUT", "PATCH"):
+        return None, None, {}
+    try:
+        rule, args = app.url_map.bind("localhost").match(scope["path"], scope["method"], return_rule=True)
+    except HTTPException:
+        return None, None, {}
+    if rule.endpoint == "upload_file" and STREAM_UPLOADS and \
+            parse_options_header(headers.get("content-type", ""))[0] == "multipart/form-data":
+        return asgi_upload, rule.rule, args
+    if rule.endpoint == "upload_chunk":
+        return asgi_upload_chunk, rule.rule, args
+    if rule.endpoint == "resumable_upload" and scope["method"] == "PATCH":
+        return asgi_resumable_patch, rule.rule, args
+    return None, None, {}
+
+async def asgi_native(handler, route, scope, receive, send, headers, args):
+    # Runs a native handler, counted the way the Flask request hooks count
+    # the requests that go through the bridge.
+    if not METRICS.enabled:
+        route = None
+    started = time.perf_counter()
+    status = [None]
+    sent = [0]
+
+    async def counted_send(message):
+        if message["type"] == "http.response.start":
+            status[0] = message["status"]
+        else:
+            sent[0] += len(message.get("body", b""))
+        await send(message)
+
+    if route is not None:
+        with ACTIVE_UPLOADS.get_lock():
+            ACTIVE_UPLOADS.value += 1
+    try:
+        await handler(scope, receive, counted_send, headers, **args)
+    except ClientDisconnected:
+        status[0] = status[0] or ClientDisconnected.code
+    except HTTPException as error:
+        await asgi_send_simple(counted_send, error.code, [("content-type", "text/plain; charset=utf-8")],
+                               error.description.encode())
+    finally:
+        if route is not None:
+            with ACTIVE_UPLOADS.get_lock():
+                ACTIVE_UPLOADS.value -= 1
+            received = headers.get("content-length", "")
+            METRICS.update([("fth_http_requests_total", (route, "%dxx" % ((status[0] or 500) // 100)), 1),
+                            ("fth_http_request_bytes_total", (route,), int(received) if received.isdigit() else 0),
+                            ("fth_http_response_bytes_total", (route,), sent[0])],
+                           [("fth_http_request_duration_seconds", (route,), time.perf_counter() - started)])
+
+async def asgi_app(scope, receive, send):
+    # Optional asyncio engine with the same routes and UPLOAD_FOLDER layout as
+    # the Flask app. Run with --server async or `uvicorn <module>:asgi_app`.
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                start_background_tasks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    handler, route, args = asgi_native_handler(scope, headers)
+    if handler is not None:
+        await asgi_native(handler, route, scope, receive, send, headers, args)
+        return
+    try:
+        await asgi_wsgi_bridge(scope, receive, send)
+    except ClientDisconnected:
+        pass
+    except HTTPException as error:
+        await asgi_send_simple(send, error.code, [("content-type", "text/plain; charset=utf-8")],
+                               error.description.encode())
+
+background_pid = None
+background_lock = threading.Lock()
+
+def start_background_tasks():
+    # Threads do not survive a fork, so each worker process starts its own
+    # watcher and GC and rescans the folder it inherited from the master.
+    global background_pid
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        if background_pid is not None:
+            FILE_INDEX.rebuild()
+        background_pid = os.getpid()
+    start_watcher(FILE_INDEX)
+    if CATALOG.start(CATALOG_RECONCILE_INTERVAL):
+        FILE_INDEX.changed = CATALOG.update
+        FILE_INDEX.source = CATALOG.listing
+    start_upload_gc(RESUMABLE_GC_INTERVAL, RESUMABLE_EXPIRY)
+    if COLD_TIER is not None and CATALOG.pending is not None:
+        start_tiering(TIERING_INTERVAL)
+    if REPLICATOR is not None and CATALOG.pending is not None:
+        REPLICATOR.start()
+
+@app.before_request
+def ensure_background_tasks():
+    if background_pid != os.getpid():
+        start_background_tasks()
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS.enabled:
+        abort(404)
+    usage = shutil.disk_usage(UPLOAD_FOLDER)
+    lines = (gauge_lines("fth_active_uploads", "Upload requests in progress.", ACTIVE_UPLOADS.value) +
+             gauge_lines("fth_active_downloads", "Downloads in progress.", ACTIVE_DOWNLOADS.value) +
+             gauge_lines("fth_disk_free_bytes", "Free space on the upload filesystem.", usage.free) +
+             gauge_lines("fth_disk_total_bytes", "Size of the upload filesystem.", usage.total))
+    return app.response_class(METRICS.render() + "\n".join(lines) + "\n",
+                              content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Requests that carry file content, for the active uploads gauge.
+UPLOAD_ENDPOINTS = {'upload_file', 'create_resumable_upload', 'resumable_upload', 'upload_chunk'}
+ROUTES = sorted({rule.rule for rule in app.url_map.iter_rules()}) + ["unmatched"]
+METRICS.define("fth_http_requests_total", "counter", "Requests by route and status class.",
+               [(route, code) for route in ROUTES for code in ("1xx", "2xx", "3xx", "4xx", "5xx")],
+               ("route", "code"))
+METRICS.define("fth_http_request_duration_seconds", "histogram",
+               "Time from the start of a request until its response body was sent.",
+               [(route,) for route in ROUTES], ("route",), REQUEST_BUCKETS)
+METRICS.define("fth_http_request_bytes_total", "counter", "Request body bytes received.",
+               [(route,) for route in ROUTES], ("route",))
+METRICS.define("fth_http_response_bytes_total", "counter", "Response body bytes sent.",
+               [(route,) for route in ROUTES], ("route",))
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS.enabled:
+        return
+    environ = request.environ
+    environ["hub.started"] = time.perf_counter()
+    if environ["REQUEST_METHOD"] in ("POST", "PUT", "PATCH") and request.endpoint in UPLOAD_ENDPOINTS:
+        environ["hub.uploading"] = True
+        with ACTIVE_UPLOADS.get_lock():
+            ACTIVE_UPLOADS.value += 1
+
+@app.teardown_request
+def finish_upload_metrics(error=None):
+    if request.environ.pop("hub.uploading", False):
+        with ACTIVE_UPLOADS.get_lock():
+            ACTIVE_UPLOADS.value -= 1
+    METRICS.flush()
+
+@app.after_request
+def record_request_metrics(response):
+    # Runs on every request, so it reads the environ and headers directly:
+    # each request.* lookup goes through a context-local proxy.
+    environ = request.environ
+    started = environ.get("hub.started")
+    if started is None:
+        return response
+    rule = request.url_rule
+    route = rule.rule if rule is not None else "unmatched"
+    code = "%dxx" % (response.status_code // 100)
+    received = environ.get("CONTENT_LENGTH", "")
+    received = int(received) if received.isdigit() else 0
+    sent = [0 if environ["REQUEST_METHOD"] == "HEAD" else response.headers.get("Content-Length", type=int)]
+    if sent[0] is None:
+        # Streamed without a length (archives, compression on the fly):
+        # count the bytes as they go out.
+        response.response = counted_body(response.response, sent)
+        sent[0] = 0
+
+    def finished():
+        METRICS.update([("fth_http_requests_total", (route, code), 1),
+                        ("fth_http_request_bytes_total", (route,), received),
+                        ("fth_http_response_bytes_total", (route,), sent[0])],
+                       [("fth_http_request_duration_seconds", (route,), time.perf_counter() - started)])
+
+    when_sent(response, finished)
+    return response
+
+def counted_body(body, sent):
+    try:
+        for chunk in body:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+def run_production(host, port, workers, threads):
+    # Background threads start in each worker after the fork; a master that
+    # forked mid-reconcile would leave its catalog flock held by every worker.
+    if BaseApplication is None:
+        raise SystemExit("Production mode needs gunicorn: pip install gunicorn")
+
+    class HubApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "%s:%d" % (host, port))
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("timeout", 0)
+            self.cfg.set("post_fork", lambda server, worker: start_background_tasks())
+
+        def load(self):
+            return app
+
+    HubApplication().run()
+
+def run_async(host, port):
+    if uvicorn is None:
+        raise SystemExit("Async mode needs uvicorn: pip install uvicorn")
+    uvicorn.run(asgi_app, host=host, port=port, lifespan="on")
+
+# Not when run as a script (the server mode decides below) or re-imported
+# as __mp_main__ by a derivative worker.
+if __name__ not in ("__main__", "__mp_main__"):
+    start_background_tasks()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File Transfer Hub")
+    parser.add_argument("--server", choices=["dev", "production", "async"], default="dev")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=2 * (os.cpu_count() or 1) + 1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--debug", action="store_true",
+                        help="dev server only: Werkzeug debugger and reloader; keep it off a public --host")
+    args = parser.parse_args()
+    if args.server == "production":
+        run_production(args.host, args.port, args.workers, args.threads)
+    elif args.server == "async":
+        run_async(args.host, args.port)
+    else:
+        # The reloader's supervisor never serves; only the child it runs
+        # (WERKZEUG_RUN_MAIN set) starts the background tasks.
+        if not args.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            start_background_tasks()
+        app.run(host=args.host, port=args.port, debug=args.debug)
\ No newline at end of file
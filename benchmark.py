@@ -0,0 +1,952 @@
+import hashlib
+import http.client
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+BENCH_FOLDER = tempfile.mkdtemp(prefix="fth-bench-")
+os.environ["UPLOAD_FOLDER"] = BENCH_FOLDER
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+server = importlib.import_module("Upload_Download_file_latest2")
+
+EXTENSIONS = [".jpg", ".pdf", ".docx", ".xlsx", ".mp4", ".mp3", ".txt", ".bin"]
+
+def populate(folder, count):
+    existing = len(os.listdir(folder))
+    for i in range(existing, count):
+        with open(os.path.join(folder, "file%06d%s" % (i, EXTENSIONS[i % len(EXTENSIONS)])), "wb") as f:
+            f.write(b"x" * (i % 512))
+
+def legacy_listing(folder):
+    return [{'name': name, 'type': server.get_file_type(name)} for name in os.listdir(folder)]
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+def bench_listing(sizes=(1000, 10000, 100000), repeat=5):
+    print("%-10s %16s %16s" % ("files", "listdir (ms)", "index (ms)"))
+    for count in sizes:
+        populate(BENCH_FOLDER, count)
+        server.FILE_INDEX.rebuild()
+        before = timed(lambda: legacy_listing(BENCH_FOLDER), repeat)
+        after = timed(lambda: server.FILE_INDEX.list(), repeat)
+        print("%-10d %16.2f %16.4f" % (count, before, after))
+
+def start_server():
+    httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def upload_bytes(port, name, data):
+    boundary = "benchboundary%d" % time.time_ns()
+    body = ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode()
+    body += data + ("\r\n--%s--\r\n" % boundary).encode()
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", "/upload", body, {"Content-Type": "multipart/form-data; boundary=%s" % boundary})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+def upload(port, name, size, block=1024 * 1024):
+    boundary = "benchboundary%d" % time.time_ns()
+    head = ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode()
+    tail = ("\r\n--%s--\r\n" % boundary).encode()
+    payload = os.urandom(block)
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.putrequest("POST", "/upload")
+    conn.putheader("Content-Type", "multipart/form-data; boundary=%s" % boundary)
+    conn.putheader("Content-Length", str(len(head) + size + len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    remaining = size
+    while remaining:
+        conn.send(payload[:min(block, remaining)])
+        remaining -= min(block, remaining)
+    conn.send(tail)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+def bench_upload(size=1024 * 1024 * 1024):
+    httpd = start_server()
+    port = httpd.server_port
+    print("%-12s %12s %12s" % ("upload path", "seconds", "MB/s"))
+    try:
+        for label, streaming in (("spooled", False), ("streaming", True)):
+            server.STREAM_UPLOADS = streaming
+            start = time.perf_counter()
+            status = upload(port, "bench-%s.bin" % label, size)
+            elapsed = time.perf_counter() - start
+            assert status == 302, status
+            print("%-12s %12.2f %12.1f" % (label, elapsed, size / elapsed / 1e6))
+            os.remove(os.path.join(BENCH_FOLDER, "bench-%s.bin" % label))
+    finally:
+        httpd.shutdown()
+
+def process_stats():
+    # pid -> (parent pid, utime + stime in ticks)
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    return stats
+
+def process_tree(pid, stats=None):
+    stats = stats or process_stats()
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (parent, _) in stats.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return tree
+
+def process_tree_cpu(pid):
+    # utime + stime (seconds) of pid and all of its descendants.
+    stats = process_stats()
+    return sum(stats[p][1] for p in process_tree(pid, stats) if p in stats) / os.sysconf("SC_CLK_TCK")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def spawn_server(*args, port=None, **environ):
+    port = port or free_port()
+    env = dict(os.environ, UPLOAD_FOLDER=BENCH_FOLDER)
+    env.update(environ)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Upload_Download_file_latest2.py")
+    proc = subprocess.Popen([sys.executable, script, "--host", "127.0.0.1", "--port", str(port)] + list(args),
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not start: %s" % (args,))
+
+def download(port, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    received = 0
+    while True:
+        data = response.read(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+    conn.close()
+    return received
+
+def bench_download(size=256 * 1024 * 1024, clients=8, rounds=2):
+    with open(os.path.join(BENCH_FOLDER, "download.bin"), "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size // len(block)):
+            f.write(block)
+    print("%-12s %12s %16s" % ("server", "MB/s", "CPU s per GB"))
+    for label, args in (("dev", ["--server", "dev"]), ("production", ["--server", "production", "--workers", "2"])):
+        proc, port = spawn_server(*args)
+        try:
+            download(port, "/files/download.bin")
+            cpu_before = process_tree_cpu(proc.pid)
+            start = time.perf_counter()
+            totals = []
+            workers = [threading.Thread(target=lambda: [totals.append(download(port, "/files/download.bin"))
+                                                        for _ in range(rounds)]) for _ in range(clients)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            cpu = process_tree_cpu(proc.pid) - cpu_before
+            served = sum(totals)
+            print("%-12s %12.1f %16.3f" % (label, served / elapsed / 1e6, cpu / (served / 1e9)))
+        finally:
+            proc.terminate()
+            proc.wait()
+    os.remove(os.path.join(BENCH_FOLDER, "download.bin"))
+
+def bench_page(count=1000, repeat=200):
+    populate(BENCH_FOLDER, count)
+    server.FILE_INDEX.rebuild()
+    client = server.app.test_client()
+    response = client.get("/")
+    page_bytes = len(response.data)
+    assets = {}
+    for url in set(re.findall(r'(?:href|src)="(/static/[^"]+)"', response.get_data(as_text=True))):
+        asset = client.get(url)
+        assets[url] = (len(asset.data), asset.headers.get("Cache-Control", ""))
+    render = timed(lambda: client.get("/"), repeat)
+    print("%-28s %10d" % ("HTML bytes per pageview", page_bytes))
+    for url, (size, cache_control) in sorted(assets.items()):
+        print("%-28s %10d  %s" % (url.split("?")[0], size, cache_control))
+    print("%-28s %10.3f" % ("GET / (ms, best of %d)" % repeat, render))
+
+def fetch(port, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+def bench_firstpaint(repeat=20):
+    # Time until the HTML and every render-blocking stylesheet in <head>
+    # have arrived, fetched the way a browser does (stylesheets in parallel).
+    httpd = start_server()
+    port = httpd.server_port
+    headers = {"Accept-Encoding": "br, gzip"}
+    try:
+        _, html = fetch(port, "/", headers)
+        head = html.decode().split("</head>")[0]
+        stylesheets = re.findall(r'<link href="([^"]+)" rel="stylesheet">', head)
+        external = [url for url in re.findall(r'(?:href|src)="(https?://[^"]+)"', html.decode())]
+        wire_bytes = len(html)
+
+        def first_paint():
+            results = []
+            fetch(port, "/", headers)
+            workers = [threading.Thread(target=lambda u=url: results.append(fetch(port, u, headers)[1]))
+                       for url in stylesheets]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            return results
+
+        wire_bytes += sum(len(body) for body in first_paint())
+        elapsed = timed(first_paint, repeat)
+    finally:
+        httpd.shutdown()
+    print("%-34s %10d" % ("external (CDN) requests", len(external)))
+    print("%-34s %10d" % ("render-blocking stylesheets", len(stylesheets)))
+    print("%-34s %10d" % ("bytes on the wire to first paint", wire_bytes))
+    print("%-34s %10.2f" % ("time to first paint inputs (ms)", elapsed))
+
+def bench_compression(lines=500000):
+    # A server log is the typical large, highly compressible download.
+    with open(os.path.join(BENCH_FOLDER, "server.log"), "w") as f:
+        for i in range(lines):
+            f.write("2024-05-01 12:%02d:%02d INFO request %d served /files/report-%d.pdf in %d ms\n"
+                    % (i // 60 % 60, i % 60, i, i % 977, i % 89))
+    size = os.path.getsize(os.path.join(BENCH_FOLDER, "server.log"))
+    httpd = start_server()
+    port = httpd.server_port
+    print("%-22s %14s %12s" % ("encoding", "bytes", "ms"))
+    try:
+        for encoding in ["identity", "gzip"] + (["br"] if server.brotli else []) + (["zstd"] if server.zstandard else []):
+            for label in ("first", "cached") if encoding != "identity" else ("",):
+                start = time.perf_counter()
+                received = download(port, "/files/server.log", {"Accept-Encoding": encoding})
+                elapsed = (time.perf_counter() - start) * 1000
+                print("%-22s %14d %12.1f" % (("%s %s" % (encoding, label)).strip(), received, elapsed))
+    finally:
+        httpd.shutdown()
+    print("%-22s %14d" % ("file size", size))
+    os.remove(os.path.join(BENCH_FOLDER, "server.log"))
+
+def bench_preview(count=8):
+    # Camera-sized photos: bytes a preview costs before (the original) and
+    # after (the derivative), and whether uploads wait for thumbnailing.
+    from PIL import Image
+    photo = os.path.join(tempfile.mkdtemp(prefix="fth-photo-"), "photo.jpg")
+    Image.frombytes("RGB", (6000, 4000), os.urandom(6000 * 4000 * 3)).save(photo, "JPEG", quality=95)
+    httpd = start_server()
+    port = httpd.server_port
+    client = server.app.test_client()
+    try:
+        with open(photo, "rb") as f:
+            data = f.read()
+        start = time.perf_counter()
+        for i in range(count):
+            upload_bytes(port, "photo%02d.jpg" % i, data)
+        upload_ms = (time.perf_counter() - start) * 1000 / count
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            files = client.get("/api/files?type=image").get_json()["files"]
+            if all(f["thumbnail_url"] for f in files):
+                break
+            time.sleep(0.2)
+        ready = time.time() < deadline
+        thumb = len(client.get(files[0]["thumbnail_url"]).data)
+        preview = len(client.get(files[0]["preview_url"]).data)
+    finally:
+        httpd.shutdown()
+        shutil.rmtree(os.path.dirname(photo), ignore_errors=True)
+    print("%-30s %12d" % ("original (preview before)", len(data)))
+    print("%-30s %12d" % ("preview derivative", preview))
+    print("%-30s %12d" % ("list thumbnail", thumb))
+    print("%-30s %12.1f" % ("upload ms per photo", upload_ms))
+    print("%-30s %12s" % ("all thumbnails ready", ready))
+
+def bench_textpreview(sizes=(1, 64, 512), repeat=5):
+    # Cost of opening a text preview: the whole file through /view before,
+    # one page of /api/preview after, plus a jump deep into the file.
+    client = server.app.test_client()
+    line = b"2024-05-01 12:00:00 INFO request served /files/report.pdf in 12 ms\n"
+    print("%-8s %14s %12s %14s %12s %14s" % ("MB", "view bytes", "view ms", "preview bytes", "preview ms",
+                                             "line jump ms"))
+    for megabytes in sizes:
+        path = os.path.join(BENCH_FOLDER, "preview.log")
+        with open(path, "wb") as f:
+            f.write(line * (megabytes * 1024 * 1024 // len(line)))
+        lines = os.path.getsize(path) // len(line)
+        view_bytes = len(client.get("/view/preview.log", headers={"Accept-Encoding": "identity"}).data)
+        view = timed(lambda: client.get("/view/preview.log", headers={"Accept-Encoding": "identity"}).data, repeat)
+        preview_bytes = len(client.get("/api/preview/preview.log").data)
+        preview = timed(lambda: client.get("/api/preview/preview.log").data, repeat)
+        jump = timed(lambda: client.get("/api/preview/preview.log?line=%d&lines=50" % (lines * 9 // 10)).data, repeat)
+        print("%-8d %14d %12.2f %14d %12.2f %14.2f" % (megabytes, view_bytes, view, preview_bytes, preview, jump))
+        os.remove(path)
+
+def upload_many(port, names, data):
+    boundary = "benchboundary%d" % time.time_ns()
+    parts = [('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+              'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode() + data + b"\r\n"
+             for name in names]
+    body = b"".join(parts) + ("--%s--\r\n" % boundary).encode()
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", "/upload", body, {"Content-Type": "multipart/form-data; boundary=%s" % boundary,
+                                           "Accept": "application/json"})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+def bench_manyfiles(count=2000, size=16 * 1024, batch=500):
+    # A folder of small files: one form POST (plus the redirect back to the
+    # page) per file, as the single-file form did, against batched requests.
+    data = os.urandom(size)
+    httpd = start_server()
+    port = httpd.server_port
+    print("%-22s %8s %10s %10s" % ("upload mode", "files", "seconds", "files/s"))
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            assert upload_bytes(port, "single/%05d.bin" % i, data) == 302
+            fetch(port, "/")
+        elapsed = time.perf_counter() - start
+        print("%-22s %8d %10.2f %10.0f" % ("one file per request", count, elapsed, count / elapsed))
+        start = time.perf_counter()
+        names = ["folder/sub%d/%05d.bin" % (i % 10, i) for i in range(count)]
+        for i in range(0, count, batch):
+            assert upload_many(port, names[i:i + batch], data) == 200
+        fetch(port, "/")
+        elapsed = time.perf_counter() - start
+        print("%-22s %8d %10.2f %10.0f" % ("batched (%d/request)" % batch, count, elapsed, count / elapsed))
+    finally:
+        httpd.shutdown()
+    shutil.rmtree(os.path.join(BENCH_FOLDER, "single"), ignore_errors=True)
+    shutil.rmtree(os.path.join(BENCH_FOLDER, "folder"), ignore_errors=True)
+    server.FILE_INDEX.rebuild()
+
+def peak_rss_mb(pid):
+    # Largest peak RSS of any process in the tree (the reloader or master
+    # is not the process serving requests).
+    peak = 0
+    for member in process_tree(pid):
+        try:
+            with open("/proc/%d/status" % member) as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except OSError:
+            pass
+    return peak / 1024
+
+def bench_archive(files=32, size=16 * 1024 * 1024):
+    # Archive downloads stream: the server's peak RSS should not move with
+    # the archive size.
+    folder = os.path.join(BENCH_FOLDER, "archive")
+    os.makedirs(folder, exist_ok=True)
+    block = os.urandom(1024 * 1024)
+    text = b"2024-05-01 12:00:00 INFO request served in 12 ms\n" * (1024 * 1024 // 50)
+    for i in range(files):
+        with open(os.path.join(folder, "part%03d%s" % (i, ".mp4" if i % 2 else ".log")), "wb") as f:
+            for _ in range(size // len(block)):
+                f.write(block if i % 2 else text[:len(block)])
+    proc, port = spawn_server("--server", "dev")
+    print("%-8s %12s %12s %10s %16s" % ("format", "MB in", "MB out", "MB/s", "server RSS (MB)"))
+    try:
+        baseline = peak_rss_mb(proc.pid)
+        for archive_format in ("zip", "tar"):
+            start = time.perf_counter()
+            received = download(port, "/archive.%s?path=archive" % archive_format)
+            elapsed = time.perf_counter() - start
+            print("%-8s %12.0f %12.1f %10.1f %16.1f" % (archive_format, files * size / 1e6, received / 1e6,
+                                                        files * size / elapsed / 1e6, peak_rss_mb(proc.pid)))
+        print("%-8s %52.1f" % ("idle", baseline))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_tree(folders=200, per_folder=500, repeat=5):
+    # Cold listing of one folder against walking the whole tree, which is
+    # what a flat, recursive index has to do after every rebuild.
+    root = os.path.join(BENCH_FOLDER, "tree")
+    for i in range(folders):
+        os.makedirs(os.path.join(root, "dir%04d" % i))
+        populate(os.path.join(root, "dir%04d" % i), per_folder)
+
+    def cold_page():
+        server.FILE_INDEX.rebuild()
+        server.FILE_INDEX.page("tree/dir0042")
+
+    walk = timed(lambda: sum(len(files) for _, _, files in os.walk(root)), repeat)
+    lazy = timed(cold_page, repeat)
+    print("%-10s %16s %20s" % ("files", "walk tree (ms)", "cold folder (ms)"))
+    print("%-10d %16.2f %20.2f" % (folders * per_folder, walk, lazy))
+    shutil.rmtree(root, ignore_errors=True)
+    server.FILE_INDEX.rebuild()
+
+def bench_search(folders=300, per_folder=1000, repeat=20):
+    root = os.path.join(BENCH_FOLDER, "search")
+    for i in range(folders):
+        os.makedirs(os.path.join(root, "dir%04d" % i))
+        populate(os.path.join(root, "dir%04d" % i), per_folder)
+    for i in range(20):
+        with open(os.path.join(root, "dir%04d" % i, "notes%02d.txt" % i), "w") as f:
+            f.write("meeting minutes about the quarterly forecast %d\n" % i * 200)
+    index = server.Catalog(os.path.join(BENCH_FOLDER, "catalog-search.db"), root, True)
+    start = time.perf_counter()
+    index.reconcile()
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    index.reconcile(full=True)
+    rescan = time.perf_counter() - start
+    print("%d files: initial index %.1f s, full reconcile %.1f s" % (folders * per_folder + 20, build, rescan))
+    queries = [
+        ("exact name", dict(query="file000120.jpg")),
+        ("substring", dict(query="e00012")),
+        ("short term", dict(query="07")),
+        ("type + size", dict(query="", file_type="video", min_size=500)),
+        ("name in folder", dict(query="file0004", directory="dir0042")),
+        ("content", dict(query="quarterly forecast", content=True)),
+        ("no match", dict(query="nothing-like-this")),
+    ]
+    print("%-22s %10s %10s" % ("query", "results", "ms"))
+    for label, kwargs in queries:
+        results = index.search(limit=100, **kwargs)[0]
+        print("%-22s %10d %10.2f" % (label, len(results), timed(lambda: index.search(limit=100, **kwargs), repeat)))
+    shutil.rmtree(root, ignore_errors=True)
+
+def bench_catalog(folders=100, per_folder=1000, big=20000, repeat=5):
+    # Startup reconcile and cold folder listings, with and without the
+    # catalog behind the file index.
+    root = os.path.join(BENCH_FOLDER, "catalog")
+    for i in range(folders):
+        os.makedirs(os.path.join(root, "dir%04d" % i))
+        populate(os.path.join(root, "dir%04d" % i), per_folder)
+    os.makedirs(os.path.join(root, "big"))
+    populate(os.path.join(root, "big"), big)
+    catalog = server.Catalog(os.path.join(BENCH_FOLDER, "catalog.db"), root, False)
+    print("%-34s %10s" % ("files: %d" % (folders * per_folder + big), "seconds"))
+    for label, full in (("first reconcile", False), ("startup reconcile, nothing changed", False),
+                        ("full reconcile", True)):
+        start = time.perf_counter()
+        catalog.reconcile(full)
+        print("%-34s %10.2f" % (label, time.perf_counter() - start))
+    index = server.FileIndex(root)
+
+    def cold_page():
+        index.rebuild()
+        index.page("big")
+
+    scanned = timed(cold_page, repeat)
+    index.source = catalog.listing
+    cataloged = timed(cold_page, repeat)
+    print("cold listing of %d files: scandir %.1f ms, catalog %.1f ms" % (big, scanned, cataloged))
+    shutil.rmtree(root, ignore_errors=True)
+
+def bench_tiering(size=256 * 1024 * 1024, tail=1024 * 1024):
+    # A demoted file against a local one: full downloads stream from the
+    # cold tier (server RSS stays flat) and a range fetches only its bytes.
+    # Uses COLD_STORAGE (e.g. s3://bucket with COLD_STORAGE_ENDPOINT pointing
+    # at a local MinIO) when set, else a folder.
+    url = os.environ.get("COLD_STORAGE") or "file://" + os.path.join(BENCH_FOLDER, ".cold")
+    server.COLD_TIER = server.open_storage(url)
+    folder = os.path.join(BENCH_FOLDER, "tier")
+    os.makedirs(folder, exist_ok=True)
+    for name in ("hot.bin", "cold.bin"):
+        with open(os.path.join(folder, name), "wb") as f:
+            for _ in range(size // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+    path = os.path.join(folder, "cold.bin")
+    st = os.stat(path)
+    start = time.perf_counter()
+    server.demote("tier/cold.bin", server.hash_file(path), st.st_size, st.st_mtime)
+    print("demoted %d MB to %s in %.1f s" % (size // 1e6, url, time.perf_counter() - start))
+    proc, port = spawn_server("--server", "dev", COLD_STORAGE=url)
+    # Let the catalog hash the hot file first, off the clock.
+    while True:
+        response, body = fetch(port, "/api/metadata/tier/hot.bin")
+        if response.status == 200 and json.loads(body)["sha256"]:
+            break
+        time.sleep(0.2)
+    print("%-10s %10s %10s %18s %16s" % ("file", "TTFB (ms)", "MB/s", "1 MB at end (ms)", "server RSS (MB)"))
+    try:
+        for name in ("hot.bin", "cold.bin"):
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            start = time.perf_counter()
+            conn.request("GET", "/files/tier/" + name)
+            response = conn.getresponse()
+            response.read(64 * 1024)
+            first = time.perf_counter() - start
+            received = 64 * 1024
+            while True:
+                data = response.read(1024 * 1024)
+                if not data:
+                    break
+                received += len(data)
+            elapsed = time.perf_counter() - start
+            conn.close()
+            ranged = timed(lambda: download(port, "/files/tier/" + name,
+                                            {"Range": "bytes=%d-%d" % (size - tail, size - 1)}), 5)
+            print("%-10s %10.1f %10.1f %18.1f %16.1f" % (name, first * 1000, received / elapsed / 1e6, ranged,
+                                                          peak_rss_mb(proc.pid)))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+        server.COLD_TIER = server.open_storage(server.COLD_STORAGE)
+
+def bench_tiering_s3():
+    # bench_tiering against moto's S3 server on a local port, for when there
+    # is no MinIO at hand (pip install "moto[server]" boto3).
+    from moto.server import ThreadedMotoServer
+    port = free_port()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    s3 = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    s3.start()
+    environ = {'AWS_ACCESS_KEY_ID': "bench", 'AWS_SECRET_ACCESS_KEY': "bench", 'AWS_DEFAULT_REGION': "us-east-1",
+               'COLD_STORAGE': "s3://bench", 'COLD_STORAGE_ENDPOINT': "http://127.0.0.1:%d" % port}
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    server.COLD_STORAGE_ENDPOINT = environ['COLD_STORAGE_ENDPOINT']
+    try:
+        server.boto3.client("s3", endpoint_url=server.COLD_STORAGE_ENDPOINT).create_bucket(Bucket="bench")
+        bench_tiering()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name)
+            else:
+                os.environ[name] = value
+        server.COLD_STORAGE_ENDPOINT = os.environ.get("COLD_STORAGE_ENDPOINT") or None
+        s3.stop()
+
+def bench_hotfile(size=64 * 1024, clients=16, seconds=5):
+    # One small file requested over and over, as when a link is shared with
+    # a whole class, with and without the memory cache.
+    folder = os.path.join(BENCH_FOLDER, "hot")
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "handout.pdf"), "wb") as f:
+        f.write(os.urandom(size))
+    print("%-8s %10s %18s %10s %10s %10s" % ("cache", "req/s", "server CPU us/req", "hits", "misses", "evictions"))
+    for label, environ in (("off", {"MEMORY_CACHE_SIZE": "0"}), ("on", {})):
+        proc, port = spawn_server("--server", "production", "--workers", "1", **environ)
+        try:
+            download(port, "/files/hot/handout.pdf")
+            cpu_before = process_tree_cpu(proc.pid)
+            counts = []
+            deadline = time.perf_counter() + seconds
+
+            def client():
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                count = 0
+                while time.perf_counter() < deadline:
+                    conn.request("GET", "/files/hot/handout.pdf")
+                    conn.getresponse().read()
+                    count += 1
+                conn.close()
+                counts.append(count)
+
+            workers = [threading.Thread(target=client) for _ in range(clients)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            cpu = process_tree_cpu(proc.pid) - cpu_before
+            stats = json.loads(fetch(port, "/api/admin/cache")[1])
+            print("%-8s %10.0f %18.0f %10d %10d %10d" % (label, sum(counts) / elapsed, cpu / sum(counts) * 1e6,
+                                                         stats["hits"], stats["misses"], stats["evictions"]))
+        finally:
+            proc.terminate()
+            proc.wait()
+    shutil.rmtree(folder, ignore_errors=True)
+
+def bench_replication(size=256 * 1024 * 1024, nodes=3):
+    # Time from an upload finishing on one node until every peer holds a
+    # verified copy, with one and with several range streams per pull, and
+    # for the same content under a new name (copied locally, not fetched).
+    data = os.urandom(size)
+    digest = hashlib.sha256(data).hexdigest()
+    print("%-10s %8s %14s %10s" % ("upload", "streams", "replicated (s)", "MB/s"))
+    for streams in (1, 4):
+        ports = [free_port() for _ in range(nodes)]
+        urls = ["http://127.0.0.1:%d" % port for port in ports]
+        procs = []
+        try:
+            for i, port in enumerate(ports):
+                folder = os.path.join(BENCH_FOLDER, "node%d" % i)
+                os.makedirs(folder, exist_ok=True)
+                procs.append(spawn_server("--server", "dev", port=port, UPLOAD_FOLDER=folder, NODE_URL=urls[i],
+                                          PEERS=",".join(urls[:i] + urls[i + 1:]),
+                                          REPLICATION_STREAMS=str(streams))[0])
+            for label in ("new", "duplicate"):
+                name = "%s-%d.bin" % (label, streams)
+                upload_bytes(ports[0], name, data)
+                start = time.perf_counter()
+                waiting = set(ports[1:])
+                while waiting:
+                    for port in list(waiting):
+                        response, body = fetch(port, "/api/metadata/" + name)
+                        if response.status == 200 and json.loads(body)["sha256"] == digest:
+                            waiting.discard(port)
+                    time.sleep(0.05)
+                elapsed = time.perf_counter() - start
+                print("%-10s %8d %14.2f %10.1f" % (label, streams, elapsed, size * (nodes - 1) / elapsed / 1e6))
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+            for i in range(nodes):
+                shutil.rmtree(os.path.join(BENCH_FOLDER, "node%d" % i), ignore_errors=True)
+
+def bench_metrics(files=2000, rounds=3000):
+    # Cost of the /metrics instrumentation, in process so that socket noise
+    # does not drown it: requests alternate between METRICS off and on and
+    # the medians are compared. Then a cold scan of a large folder, which
+    # calls get_file_type() for every entry, with and without its timing.
+    folder = os.path.join(BENCH_FOLDER, "metrics")
+    os.makedirs(folder, exist_ok=True)
+    populate(folder, files)
+    with open(os.path.join(BENCH_FOLDER, "small.txt"), "wb") as f:
+        f.write(os.urandom(4096))
+    client = server.app.test_client()
+    print("%-24s %12s %12s %14s" % ("request", "off (us)", "on (us)", "overhead"))
+    for path in ("/files/small.txt", "/browse/metrics", "/api/files?dir=metrics"):
+        samples = {False: [], True: []}
+        for i in range(2 * rounds):
+            server.METRICS.enabled = bool(i % 2)
+            start = time.perf_counter()
+            client.get(path).close()
+            samples[bool(i % 2)].append(time.perf_counter() - start)
+        off, on = (statistics.median(samples[enabled]) * 1e6 for enabled in (False, True))
+        print("%-24s %12.1f %12.1f %8.1f us %4.1f%%" % (path, off, on, on - off, (on - off) / off * 100))
+    server.METRICS.enabled = server.METRICS_ENABLED
+    index = server.FileIndex(BENCH_FOLDER)
+    instrumented = server.get_file_type
+    for label, classify in (("off", instrumented.__wrapped__), ("on", instrumented)):
+        server.get_file_type = classify
+        print("scan of %d files, metrics %-3s %8.2f ms" % (files, label,
+                                                         timed(lambda: index._scan("metrics", {}), 10)))
+    server.get_file_type = instrumented
+    shutil.rmtree(folder, ignore_errors=True)
+
+def make_population(folder, rng, small, folders, huge, huge_size):
+    # Seeded, so every run (and every commit) serves the same tree: many
+    # small files of 1-64 KB spread over folders, and a few huge ones.
+    small_names = []
+    for i in range(small):
+        name = "d%02d/file%05d%s" % (i % folders, i, EXTENSIONS[i % len(EXTENSIONS)])
+        os.makedirs(os.path.join(folder, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(rng.randbytes(rng.randint(1024, 64 * 1024)))
+        small_names.append(name)
+    huge_names = []
+    os.makedirs(os.path.join(folder, "huge"), exist_ok=True)
+    for i in range(huge):
+        name = "huge/huge%d.bin" % i
+        with open(os.path.join(folder, name), "wb") as f:
+            for _ in range(huge_size // (8 * 1024 * 1024)):
+                f.write(rng.randbytes(8 * 1024 * 1024))
+        huge_names.append(name)
+    return small_names, huge_names
+
+def reset_peak_rss(pid):
+    # Writing 5 to clear_refs restarts VmHWM, so each scenario gets its own
+    # peak; older kernels leave the lifetime peak.
+    for member in process_tree(pid):
+        try:
+            with open("/proc/%d/clear_refs" % member, "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+def run_load(port, clients, seconds, send, seed):
+    # Each client keeps one connection and calls send(conn, rng, client,
+    # count) back to back, which returns the body bytes moved; returns the
+    # sorted latencies, the bytes, the number of failures and the time
+    # until the last request finished.
+    latencies = []
+    moved = [0]
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(index):
+        rng = random.Random("%s-%d" % (seed, index))
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        mine = []
+        size = count = failed = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                size += send(conn, rng, index, count)
+                mine.append(time.perf_counter() - start)
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            count += 1
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            moved[0] += size
+            errors[0] += failed
+
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(latencies), moved[0], errors[0], time.perf_counter() - start
+
+def checked(response, expected=(200,)):
+    body = response.read()
+    if response.status not in expected:
+        raise http.client.HTTPException("HTTP %d" % response.status)
+    return len(body)
+
+def multipart_head(boundary, name):
+    return ('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name)).encode()
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_load(clients=8, seconds=10, warmup=1, small=5000, folders=50, huge=2, huge_size=256 * 1024 * 1024,
+               small_upload=16 * 1024, huge_upload=64 * 1024 * 1024, seed=1, workers=None):
+    # The whole server under concurrent load, one scenario at a time:
+    # listings, small and huge downloads, ranged reads and uploads against
+    # a seeded file population, through gunicorn. Prints a table on stderr
+    # and the results as JSON on stdout, e.g.
+    #   python benchmark.py load > before.json
+    #   python benchmark.py compare before.json after.json
+    folder = os.path.join(BENCH_FOLDER, "load")
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    small_names, huge_names = make_population(folder, rng, small, folders, huge, huge_size)
+    populated = time.perf_counter() - start
+    upload_data = rng.randbytes(huge_upload)
+    quote = server.urllib.parse.quote
+
+    def list_api(conn, rng, client, count):
+        conn.request("GET", "/api/files?dir=d%02d" % rng.randrange(folders))
+        return checked(conn.getresponse())
+
+    def list_page(conn, rng, client, count):
+        conn.request("GET", "/browse/d%02d" % rng.randrange(folders))
+        return checked(conn.getresponse())
+
+    def download_small(conn, rng, client, count):
+        conn.request("GET", "/files/" + quote(rng.choice(small_names)))
+        return checked(conn.getresponse())
+
+    def download_huge(conn, rng, client, count):
+        conn.request("GET", "/files/" + quote(rng.choice(huge_names)))
+        response = conn.getresponse()
+        size = 0
+        for block in iter(lambda: response.read(1024 * 1024), b""):
+            size += len(block)
+        if response.status != 200:
+            raise http.client.HTTPException("HTTP %d" % response.status)
+        return size
+
+    def ranged_read(conn, rng, client, count):
+        length = rng.choice((4096, 64 * 1024, 1024 * 1024))
+        offset = rng.randrange(huge_size - length)
+        conn.request("GET", "/files/" + quote(rng.choice(huge_names)),
+                     headers={"Range": "bytes=%d-%d" % (offset, offset + length - 1)})
+        return checked(conn.getresponse(), (206,))
+
+    def upload_file(size):
+        def send(conn, rng, client, count):
+            boundary = "loadboundary%d" % time.time_ns()
+            head = multipart_head(boundary, "uploads/c%d-%06d.bin" % (client, count))
+            tail = ("\r\n--%s--\r\n" % boundary).encode()
+            conn.putrequest("POST", "/upload")
+            conn.putheader("Content-Type", "multipart/form-data; boundary=%s" % boundary)
+            conn.putheader("Content-Length", str(len(head) + size + len(tail)))
+            conn.putheader("Accept", "application/json")
+            conn.endheaders()
+            conn.send(head)
+            for offset in range(0, size, 1024 * 1024):
+                conn.send(upload_data[offset:min(offset + 1024 * 1024, size)])
+            conn.send(tail)
+            checked(conn.getresponse())
+            return size
+        return send
+
+    scenarios = [
+        ("list_api", clients, list_api),
+        ("list_page", clients, list_page),
+        ("download_small", clients, download_small),
+        ("download_huge", max(1, clients // 2), download_huge),
+        ("ranged_read", clients, ranged_read),
+        ("upload_small", clients, upload_file(small_upload)),
+        ("upload_huge", max(1, clients // 4), upload_file(huge_upload)),
+    ]
+    args = ["--server", "production"] + (["--workers", str(workers)] if workers else [])
+    proc, port = spawn_server(*args, UPLOAD_FOLDER=folder)
+    results = []
+    try:
+        # Let the catalog hash the population first, off the clock.
+        for name in huge_names + small_names[-1:]:
+            while True:
+                response, body = fetch(port, "/api/metadata/" + quote(name))
+                if response.status == 200 and json.loads(body)["sha256"]:
+                    break
+                time.sleep(0.5)
+        print("%-16s %8s %10s %10s %10s %10s %8s %10s %12s" % (
+            "scenario", "clients", "req/s", "MB/s", "p50 (ms)", "p99 (ms)", "errors", "CPU (s)", "peak RSS (MB)"),
+            file=sys.stderr)
+        for index, (name, concurrency, send) in enumerate(scenarios):
+            run_load(port, concurrency, warmup, send, "%s-warmup-%d" % (seed, index))
+            reset_peak_rss(proc.pid)
+            cpu_before = process_tree_cpu(proc.pid)
+            latencies, moved, errors, elapsed = run_load(port, concurrency, seconds, send, "%s-%d" % (seed, index))
+            result = {
+                'scenario': name,
+                'clients': concurrency,
+                'requests': len(latencies),
+                'errors': errors,
+                'seconds': elapsed,
+                'requests_per_second': len(latencies) / elapsed,
+                'mb_per_second': moved / elapsed / 1e6,
+                'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+                'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+                'max_ms': latencies[-1] * 1000 if latencies else None,
+                'server_cpu_seconds': process_tree_cpu(proc.pid) - cpu_before,
+                'peak_rss_mb': peak_rss_mb(proc.pid),
+            }
+            results.append(result)
+            print("%-16s %8d %10.1f %10.1f %10.2f %10.2f %8d %10.2f %12.1f" % (
+                name, concurrency, result['requests_per_second'], result['mb_per_second'], result['p50_ms'] or 0,
+                result['p99_ms'] or 0, errors, result['server_cpu_seconds'], result['peak_rss_mb']), file=sys.stderr)
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+    json.dump({
+        'commit': git_commit(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {'clients': clients, 'seconds': seconds, 'warmup': warmup, 'small_files': small,
+                       'folders': folders, 'huge_files': huge, 'huge_size': huge_size,
+                       'small_upload': small_upload, 'huge_upload': huge_upload, 'seed': seed,
+                       'workers': workers, 'population_seconds': populated},
+        'scenarios': results,
+    }, sys.stdout, indent=2)
+    print()
+
+def compare_results(before_path, after_path):
+    # Relative change per scenario between two bench_load JSON files.
+    with open(before_path) as f:
+        before = {result['scenario']: result for result in json.load(f)['scenarios']}
+    with open(after_path) as f:
+        after = json.load(f)['scenarios']
+    fields = ('requests_per_second', 'mb_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+    print("%-16s" % "scenario" + "".join("%16s" % field.replace("requests_per_second", "req/s") for field in fields))
+    for result in after:
+        old = before.get(result['scenario'])
+        if old is None:
+            continue
+        changes = []
+        for field in fields:
+            if old[field] and result[field] is not None:
+                changes.append("%+15.1f%%" % ((result[field] - old[field]) / old[field] * 100))
+            else:
+                changes.append("%16s" % "-")
+        print("%-16s" % result['scenario'] + "".join(changes))
+
+BENCHMARKS = {
+    "listing": bench_listing,
+    "upload": bench_upload,
+    "download": bench_download,
+    "page": bench_page,
+    "firstpaint": bench_firstpaint,
+    "compression": bench_compression,
+    "preview": bench_preview,
+    "textpreview": bench_textpreview,
+    "manyfiles": bench_manyfiles,
+    "archive": bench_archive,
+    "tree": bench_tree,
+    "search": bench_search,
+    "catalog": bench_catalog,
+    "tiering": bench_tiering,
+    "tiering-s3": bench_tiering_s3,
+    "hotfile": bench_hotfile,
+    "replication": bench_replication,
+    "metrics": bench_metrics,
+    "load": bench_load,
+}
+
+if __name__ == "__main__":
+    try:
+        if sys.argv[1:2] == ["compare"]:
+            compare_results(*sys.argv[2:4])
+        else:
+            for name in sys.argv[1:] or BENCHMARKS:
+                BENCHMARKS[name]()
+    finally:
+        shutil.rmtree(BENCH_FOLDER, ignore_errors=True)
@@ -0,0 +1,148 @@
+import argparse
+import os
+import re
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCES = [os.path.join(ROOT, "Upload_Download_file_latest2.py"), os.path.join(ROOT, "static", "app.js")]
+VENDOR_FOLDER = os.path.join(ROOT, "static", "vendor")
+ICON_ALIASES = {
+    'arrows-alt': 'up-down-left-right',
+    'cloud-upload-alt': 'cloud-arrow-up',
+    'file-alt': 'file-lines',
+}
+FONTAWESOME_NOTICE = ("/*! Icons: Font Awesome Free 6.4.0 by @fontawesome - https://fontawesome.com "
+                      "License - https://fontawesome.com/license/free (Icons: CC BY 4.0) Copyright 2023 Fonticons, Inc. */")
+
+def used_words():
+    words = set()
+    for path in SOURCES:
+        with open(path, encoding="utf-8") as f:
+            words.update(re.findall(r"[A-Za-z][\w-]*", f.read()))
+    return words
+
+def parse_css(css, i=0):
+    # Returns ([(prelude, body_or_children)], end). Nested at-rule blocks
+    # are parsed recursively; declaration blocks are kept as raw text.
+    rules = []
+    start = i
+    while i < len(css):
+        ch = css[i]
+        if css.startswith("/*", i):
+            end = css.index("*/", i + 2) + 2
+            if start == i:
+                start = end
+            i = end
+        elif ch in "\"'":
+            i = css.index(ch, i + 1) + 1
+        elif ch == ";":
+            rules.append((css[start:i].strip(), None))
+            i += 1
+            start = i
+        elif ch == "{":
+            prelude = css[start:i].strip()
+            if prelude.startswith("@") and not prelude.startswith(("@font-face", "@page")) \
+                    and not prelude.startswith(("@keyframes", "@-webkit-keyframes")):
+                children, i = parse_css(css, i + 1)
+                rules.append((prelude, children))
+            else:
+                end = i + 1
+                while css[end] != "}":
+                    if css[end] in "\"'":
+                        end = css.index(css[end], end + 1)
+                    end += 1
+                rules.append((prelude, css[i + 1:end]))
+                i = end
+            i += 1
+            start = i
+        elif ch == "}":
+            return rules, i
+        else:
+            i += 1
+    return rules, i
+
+def selector_used(selector, words):
+    bare = re.sub(r"\[[^\]]*\]", "", selector)
+    while re.search(r"\([^()]*\)", bare):
+        bare = re.sub(r"\([^()]*\)", "", bare)
+    names = re.findall(r"[.#]([\w-]+)", bare)
+    tags = re.findall(r"(?:^|[\s>+~])([a-zA-Z][\w-]*)", bare)
+    return all(name in words for name in names + tags)
+
+def shake(rules, words):
+    kept = []
+    for prelude, body in rules:
+        if body is None:
+            if prelude.startswith("@charset"):
+                kept.append((prelude, None))
+        elif isinstance(body, list):
+            children = shake(body, words)
+            if children:
+                kept.append((prelude, children))
+        elif prelude.startswith("@"):
+            kept.append((prelude, body))
+        else:
+            selectors = [s.strip() for s in prelude.split(",") if selector_used(s.strip(), words)]
+            if selectors:
+                kept.append((",".join(selectors), body))
+    return kept
+
+def drop_unused_keyframes(rules, text):
+    result = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            body = drop_unused_keyframes(body, text)
+        elif prelude.startswith(("@keyframes", "@-webkit-keyframes")) and prelude.split()[-1] not in text:
+            continue
+        result.append((prelude, body))
+    return result
+
+def serialize(rules):
+    out = []
+    for prelude, body in rules:
+        if body is None:
+            out.append(prelude + ";")
+        elif isinstance(body, list):
+            out.append("%s{%s}" % (prelude, serialize(body)))
+        else:
+            out.append("%s{%s}" % (prelude, body))
+    return "".join(out)
+
+def build_bootstrap(source, words):
+    with open(source, encoding="utf-8") as f:
+        css = f.read()
+    notice = re.search(r"/\*!.*?\*/", css, re.S).group(0)
+    rules = shake(parse_css(css)[0], words)
+    declarations = serialize([r for r in rules if not r[0].startswith(("@keyframes", "@-webkit-keyframes"))])
+    rules = drop_unused_keyframes(rules, declarations)
+    return notice + "\n" + serialize(rules) + "\n"
+
+def build_icons(fontawesome, words):
+    rules = [
+        ".fas{display:inline-block;width:1em;height:1em;vertical-align:-.125em;background-color:currentColor;"
+        "-webkit-mask:var(--fa-icon) center/contain no-repeat;mask:var(--fa-icon) center/contain no-repeat}"
+    ]
+    for word in sorted(words):
+        if not word.startswith("fa-"):
+            continue
+        name = ICON_ALIASES.get(word[3:], word[3:])
+        path = os.path.join(fontawesome, "svgs", "solid", name + ".svg")
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            svg = re.sub(r"<!--.*?-->", "", f.read()).strip()
+        rules.append('.%s{--fa-icon:url("data:image/svg+xml,%s")}' % (word, urllib.parse.quote(svg, safe=" /=:;,'")))
+    return FONTAWESOME_NOTICE + "\n" + "\n".join(rules) + "\n"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the self-hosted, tree-shaken vendor CSS in static/vendor")
+    parser.add_argument("--bootstrap", required=True, help="path to bootstrap.min.css (5.3.x)")
+    parser.add_argument("--fontawesome", required=True, help="Font Awesome Free 6.x folder containing svgs/solid")
+    args = parser.parse_args()
+    words = used_words()
+    os.makedirs(VENDOR_FOLDER, exist_ok=True)
+    for name, content in (("bootstrap.min.css", build_bootstrap(args.bootstrap, words)),
+                          ("icons.css", build_icons(args.fontawesome, words))):
+        with open(os.path.join(VENDOR_FOLDER, name), "w", encoding="utf-8") as f:
+            f.write(content)
+        print("%-20s %8d bytes" % (name, len(content.encode())))
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Runs inside the derivative worker processes, so it must not import the
+# Flask app (that would start watchers and rescans in every worker).
+
+THUMBNAIL_SIZE = 256
+PREVIEW_SIZE = 1280
+JPEG_QUALITY = 82
+TOOL_TIMEOUT = 120
+
+def lower_priority():
+    os.nice(10)
+
+def supported_types():
+    types = []
+    if Image is not None:
+        types.append('image')
+        if shutil.which("pdftoppm"):
+            types.append('pdf')
+        if shutil.which("ffmpeg"):
+            types.append('video')
+    return types
+
+def derivative_path(folder, digest, kind):
+    return os.path.join(folder, digest[:2], "%s-%s.jpg" % (digest, kind))
+
+def hash_source(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_jpeg(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if image.mode not in ("RGB", "L"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    fd, temp_path = tempfile.mkstemp(suffix=".jpg", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            image.save(f, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def render_frame(source, file_type, work_dir):
+    # First page of a PDF or a poster frame of a video, rendered by the
+    # external tool into a still image Pillow can open.
+    target = os.path.join(work_dir, "frame")
+    if file_type == 'pdf':
+        subprocess.run(["pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-scale-to", str(PREVIEW_SIZE),
+                        "-png", source, target], check=True, timeout=TOOL_TIMEOUT, capture_output=True)
+        return target + ".png"
+    for offset in ("1", "0"):
+        subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-ss", offset, "-i", source,
+                        "-frames:v", "1", "-vf", "scale=%d:-2" % PREVIEW_SIZE, target + ".png"],
+                       check=True, timeout=TOOL_TIMEOUT, capture_output=True)
+        if os.path.exists(target + ".png"):
+            return target + ".png"
+    raise OSError("no frame decoded from %s" % source)
+
+def make_derivatives(source, file_type, folder, digest=None):
+    # Returns the content digest once the thumbnail (and, for images, the
+    # downscaled preview) exist in folder, or None if none can be made.
+    if Image is None:
+        return None
+    digest = digest or hash_source(source)
+    thumbnail = derivative_path(folder, digest, "thumb")
+    if os.path.exists(thumbnail):
+        return digest
+    with tempfile.TemporaryDirectory(dir=folder) as work_dir:
+        try:
+            still = source if file_type == 'image' else render_frame(source, file_type, work_dir)
+            with Image.open(still) as image:
+                image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+                if file_type == 'image':
+                    save_jpeg(image, derivative_path(folder, digest, "preview"))
+                image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                save_jpeg(image, thumbnail)
+        except (OSError, ValueError, Image.DecompressionBombError, subprocess.SubprocessError):
+            return None
+    return digest
@@ -0,0 +1,486 @@
+const HUB = JSON.parse(document.getElementById('hub-config').textContent);
+const DIRECTORY = HUB.directory;
+const BROWSE_URL = HUB.browse_url;
+const FOLDERS_URL = HUB.folders_url;
+const MOVE_URL = HUB.move_url;
+const FILE_ICONS = HUB.file_icons;
+const PREVIEWABLE = HUB.previewable;
+const VIEW_URL = HUB.view_url;
+const PREVIEW_URL = HUB.preview_url;
+const API_URL = HUB.api_url;
+const SEARCH_URL = HUB.search_url;
+const CHUNKED_URL = HUB.chunked_url;
+const CHUNK_CONCURRENCY = HUB.chunk_concurrency;
+const UPLOAD_URL = HUB.upload_url;
+const ARCHIVE_URL = HUB.archive_url;
+const BATCH_MAX_BYTES = HUB.batch_max_bytes;
+const BATCH_MAX_FILES = HUB.batch_max_files;
+const PRECHECK_URL = HUB.precheck_url;
+const PRECHECK_MIN_SIZE = HUB.precheck_min_size;
+const HASH_SLICE_SIZE = 4 * 1024 * 1024;
+const CHUNK_RETRIES = 4;
+const CHUNK_RETRY_DELAY = 500;
+const SHA256_K = new Int32Array([
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+  0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+  0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+  0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+  0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+  0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]);
+let activePreview = null;
+let listState = {sort: 'name', order: 'asc', type: '', search: '', cursor: null, loading: null};
+
+function togglePreview(button) {
+  const filename = button.dataset.name;
+  const type = button.dataset.type;
+  const previewContainer = button.closest('.file-item').querySelector('.preview-container');
+
+  if (activePreview === previewContainer && previewContainer.classList.contains('active')) {
+    previewContainer.classList.remove('active');
+    previewContainer.innerHTML = '';
+    activePreview = null;
+    return;
+  }
+
+  if (activePreview && activePreview !== previewContainer) {
+    activePreview.classList.remove('active');
+    activePreview.innerHTML = '';
+  }
+
+  if (!previewContainer.classList.contains('active')) {
+    const url = VIEW_URL + encodeURIComponent(filename);
+
+    if (type === 'image') {
+      const img = document.createElement('img');
+      img.src = button.dataset.preview || url;
+      img.alt = filename;
+      previewContainer.replaceChildren(img);
+    } else if (type === 'pdf') {
+      const frame = document.createElement('iframe');
+      frame.src = url;
+      previewContainer.replaceChildren(frame);
+    } else if (type === 'text') {
+      const pre = document.createElement('div');
+      pre.className = 'preview-text';
+      previewContainer.replaceChildren(pre);
+      loadTextPreview(filename, 0, pre);
+    }
+
+    previewContainer.classList.add('active');
+    activePreview = previewContainer;
+  }
+}
+
+// Text previews come from the paged preview endpoint, one bounded page at
+// a time, so a multi-gigabyte log costs the same as a small file.
+function loadTextPreview(filename, offset, pre) {
+  const previewContainer = pre.parentNode;
+  fetch(`${PREVIEW_URL}${encodeURIComponent(filename)}?offset=${offset}`)
+    .then(response => {
+      if (!response.ok) throw new Error(response.status);
+      return response.json();
+    })
+    .then(page => {
+      pre.append(page.text);
+      previewContainer.querySelector('.preview-more')?.remove();
+      if (!page.eof) {
+        const more = document.createElement('button');
+        more.className = 'btn-preview preview-more';
+        more.textContent = `Show more (${Math.round(page.end / page.size * 100)}% shown)`;
+        more.onclick = () => loadTextPreview(filename, page.end, pre);
+        previewContainer.appendChild(more);
+      }
+    })
+    .catch(error => {
+      previewContainer.innerHTML = `<p style="color: #ff6b6b;">Error loading preview</p>`;
+    });
+}
+
+function renderFileItem(file) {
+  const item = document.createElement('li');
+  item.className = 'file-item';
+  item.innerHTML = `
+    <div class="file-header">
+      <div class="file-name"><input class="file-select" type="checkbox"><i class="fas file-icon"></i><span></span></div>
+      <div class="file-actions"></div>
+    </div>
+    <div class="preview-container"></div>`;
+  if (file.thumbnail_url) {
+    const thumbnail = document.createElement('img');
+    thumbnail.className = 'file-thumb';
+    thumbnail.src = file.thumbnail_url;
+    thumbnail.alt = '';
+    thumbnail.loading = 'lazy';
+    item.querySelector('.file-icon').replaceWith(thumbnail);
+  } else {
+    item.querySelector('.file-icon').classList.add(FILE_ICONS[file.type] || 'fa-file');
+  }
+  const label = file.name.split('/').pop();
+  if (file.type === 'folder') {
+    const link = document.createElement('a');
+    link.className = 'folder-link';
+    link.href = file.browse_url;
+    link.textContent = label;
+    item.querySelector('.file-name span').replaceWith(link);
+  } else {
+    item.querySelector('.file-name span').textContent = label;
+  }
+  item.querySelector('.file-select').value = file.name;
+  item.querySelector('.file-select').setAttribute('aria-label', `Select ${label}`);
+  const actions = item.querySelector('.file-actions');
+  if (PREVIEWABLE.includes(file.type)) {
+    const button = document.createElement('button');
+    button.className = 'btn-preview';
+    button.dataset.name = file.name;
+    button.dataset.type = file.type;
+    if (file.preview_url) button.dataset.preview = file.preview_url;
+    button.innerHTML = '<i class="fas fa-eye"></i> Preview';
+    button.onclick = () => togglePreview(button);
+    actions.appendChild(button);
+  }
+  const move = document.createElement('button');
+  move.className = 'btn-preview btn-move';
+  move.type = 'button';
+  move.dataset.name = file.name;
+  move.innerHTML = '<i class="fas fa-arrows-alt"></i> Move';
+  actions.appendChild(move);
+  const link = document.createElement('a');
+  link.className = 'btn-download';
+  link.href = file.download_url;
+  link.innerHTML = file.type === 'folder' ? '<i class="fas fa-download"></i> ZIP' : '<i class="fas fa-download"></i> Download';
+  actions.appendChild(link);
+  return item;
+}
+
+function loadMore(reset) {
+  // A reset (new sort, filter or query) replaces a page fetch in flight
+  // rather than waiting behind it; further pages just wait their turn.
+  if (!reset && (listState.loading || !listState.cursor)) return;
+  if (listState.loading) listState.loading.abort();
+  const loading = new AbortController();
+  listState.loading = loading;
+  // Searches cover this folder and everything below it, ordered by path.
+  const params = listState.search ? new URLSearchParams({q: listState.search})
+                                  : new URLSearchParams({sort: listState.sort, order: listState.order});
+  if (DIRECTORY) params.set('dir', DIRECTORY);
+  if (listState.type) params.set('type', listState.type);
+  if (!reset) params.set('cursor', listState.cursor);
+  fetch(`${listState.search ? SEARCH_URL : API_URL}?${params}`, {signal: loading.signal})
+    .then(response => response.json())
+    .then(page => {
+      if (loading.signal.aborted) return;
+      const list = document.getElementById('file-list');
+      if (reset) list.replaceChildren();
+      page.files.forEach(file => list.appendChild(renderFileItem(file)));
+      listState.cursor = page.next_cursor;
+      if (page.total !== undefined) document.getElementById('file-total').textContent = page.total;
+    })
+    .catch(error => { if (error.name !== 'AbortError') throw error; })
+    .finally(() => { if (listState.loading === loading) listState.loading = null; });
+}
+
+function showUploadStatus(fraction, message) {
+  document.getElementById('upload-status').classList.add('active');
+  document.getElementById('upload-progress-bar').style.width = `${Math.round(fraction * 100)}%`;
+  document.getElementById('upload-message').textContent = message;
+}
+
+// Incremental SHA-256: crypto.subtle.digest() cannot hash a file in
+// pieces and is missing entirely on plain-http LAN origins.
+class Sha256 {
+  constructor() {
+    this.h = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+                             0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+    this.w = new Int32Array(64);
+    this.block = new Uint8Array(64);
+    this.blockLength = 0;
+    this.length = 0;
+  }
+
+  update(data) {
+    let offset = 0;
+    this.length += data.length;
+    if (this.blockLength) {
+      offset = Math.min(64 - this.blockLength, data.length);
+      this.block.set(data.subarray(0, offset), this.blockLength);
+      this.blockLength += offset;
+      if (this.blockLength < 64) return;
+      this.compress(this.block, 0);
+      this.blockLength = 0;
+    }
+    for (; offset + 64 <= data.length; offset += 64) this.compress(data, offset);
+    this.block.set(data.subarray(offset), 0);
+    this.blockLength = data.length - offset;
+  }
+
+  compress(bytes, offset) {
+    const w = this.w;
+    for (let i = 0; i < 16; i++) {
+      const j = offset + i * 4;
+      w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+    }
+    for (let i = 16; i < 64; i++) {
+      const x = w[i - 15], y = w[i - 2];
+      const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+      const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+      w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+    }
+    let [a, b, c, d, e, f, g, h] = this.h;
+    for (let i = 0; i < 64; i++) {
+      const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+      const t1 = (h + S1 + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) | 0;
+      const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+      const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+      h = g; g = f; f = e; e = (d + t1) | 0;
+      d = c; c = b; b = a; a = (t1 + t2) | 0;
+    }
+    const H = this.h;
+    H[0] += a; H[1] += b; H[2] += c; H[3] += d;
+    H[4] += e; H[5] += f; H[6] += g; H[7] += h;
+  }
+
+  hexdigest() {
+    const bits = this.length * 8;
+    const padding = this.blockLength < 56 ? 56 - this.blockLength : 120 - this.blockLength;
+    const tail = new Uint8Array(padding + 8);
+    const view = new DataView(tail.buffer);
+    tail[0] = 0x80;
+    view.setUint32(padding, Math.floor(bits / 0x100000000));
+    view.setUint32(padding + 4, bits >>> 0);
+    this.update(tail);
+    return Array.from(this.h, x => (x >>> 0).toString(16).padStart(8, '0')).join('');
+  }
+}
+
+async function hashFile(file) {
+  const hash = new Sha256();
+  for (let start = 0; start < file.size; start += HASH_SLICE_SIZE) {
+    const slice = file.slice(start, Math.min(start + HASH_SLICE_SIZE, file.size));
+    hash.update(new Uint8Array(await slice.arrayBuffer()));
+    showUploadStatus(Math.min(start + HASH_SLICE_SIZE, file.size) / file.size, `Checking ${file.name}...`);
+  }
+  return hash.hexdigest();
+}
+
+function uploadName(file) {
+  const name = file.webkitRelativePath || file.name;
+  return DIRECTORY ? `${DIRECTORY}/${name}` : name;
+}
+
+async function precheckUpload(file) {
+  if (PRECHECK_MIN_SIZE === null || file.size < PRECHECK_MIN_SIZE) return null;
+  const sha256 = await hashFile(file);
+  const response = await fetch(PRECHECK_URL, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({filename: uploadName(file), size: file.size, sha256}),
+  });
+  if (!response.ok) return null;
+  const result = await response.json();
+  return result.exists ? result : null;
+}
+
+// A 4xx will not get better by resending; server errors and dropped
+// connections are retried with exponential backoff before giving up.
+async function putChunk(uploadId, index, blob) {
+  for (let attempt = 0; ; attempt++) {
+    let response;
+    let failure;
+    try {
+      response = await fetch(`${CHUNKED_URL}/${uploadId}/${index}`, {method: 'PUT', body: blob});
+    } catch (error) {
+      failure = error;
+    }
+    if (response?.ok) return;
+    if (response && response.status < 500) throw new Error(`chunk ${index} rejected (${response.status})`);
+    if (attempt >= CHUNK_RETRIES) throw failure || new Error(`chunk ${index} failed (${response.status})`);
+    await new Promise(resolve => setTimeout(resolve, CHUNK_RETRY_DELAY * 2 ** attempt));
+  }
+}
+
+async function uploadChunked(file) {
+  const created = await fetch(CHUNKED_URL, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({filename: uploadName(file), size: file.size}),
+  });
+  if (!created.ok) throw new Error(`upload rejected (${created.status})`);
+  const session = await created.json();
+  let next = 0;
+  let sent = 0;
+  const worker = async () => {
+    while (next < session.chunk_count) {
+      const index = next++;
+      const start = index * session.chunk_size;
+      const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+      await putChunk(session.id, index, blob);
+      sent += blob.size;
+      showUploadStatus(file.size ? sent / file.size : 1, `Uploading ${file.name}...`);
+    }
+  };
+  const workers = Math.min(session.concurrency || CHUNK_CONCURRENCY, session.chunk_count);
+  await Promise.all(Array.from({length: workers}, worker));
+  const completed = await fetch(`${CHUNKED_URL}/${session.id}/complete`, {method: 'POST'});
+  if (!completed.ok) throw new Error(`upload incomplete (${completed.status})`);
+  return completed.json();
+}
+
+// Files up to BATCH_MAX_BYTES travel many to a multipart request, so a
+// folder of photos costs a few round-trips and one index update per batch;
+// larger files go through the parallel chunked upload.
+async function uploadBatch(files) {
+  const form = new FormData();
+  files.forEach(file => form.append('file', file, uploadName(file)));
+  const response = await fetch(UPLOAD_URL, {method: 'POST', body: form, headers: {Accept: 'application/json'}});
+  if (!response.ok) throw new Error(`upload rejected (${response.status})`);
+  return response.json();
+}
+
+async function uploadFiles(files) {
+  const total = files.reduce((sum, file) => sum + file.size, 0);
+  let sentBytes = 0;
+  let sentFiles = 0;
+  let linked = 0;
+  let batch = [];
+  let batchBytes = 0;
+  const progress = () => showUploadStatus(total ? sentBytes / total : sentFiles / files.length,
+                                          `Uploaded ${sentFiles} of ${files.length} files...`);
+  const flush = async () => {
+    if (!batch.length) return;
+    const result = await uploadBatch(batch);
+    sentFiles += result.count;
+    sentBytes += batchBytes;
+    batch = [];
+    batchBytes = 0;
+    progress();
+  };
+  for (const file of files) {
+    if (await precheckUpload(file)) {
+      linked++;
+      sentFiles++;
+      sentBytes += file.size;
+      progress();
+    } else if (file.size > BATCH_MAX_BYTES) {
+      await uploadChunked(file);
+      sentFiles++;
+      sentBytes += file.size;
+      progress();
+    } else {
+      if (batch.length >= BATCH_MAX_FILES || batchBytes + file.size > BATCH_MAX_BYTES) await flush();
+      batch.push(file);
+      batchBytes += file.size;
+    }
+  }
+  await flush();
+  return {files: sentFiles, bytes: sentBytes, linked};
+}
+
+document.getElementById('upload-form').addEventListener('submit', event => {
+  const files = Array.from(event.target.elements.file).flatMap(input => Array.from(input.files));
+  if (!files.length || !window.fetch) return;
+  event.preventDefault();
+  const started = performance.now();
+  showUploadStatus(0, `Uploading ${files.length} file${files.length === 1 ? '' : 's'}...`);
+  uploadFiles(files)
+    .then(result => {
+      const seconds = (performance.now() - started) / 1000;
+      const rate = (result.bytes / seconds / (1024 * 1024)).toFixed(1);
+      const linked = result.linked ? `, ${result.linked} already on the server` : '';
+      showUploadStatus(1, `Uploaded ${result.files} files in ${seconds.toFixed(1)}s (${rate} MB/s${linked})`);
+      setTimeout(() => window.location.reload(), 1500);
+    })
+    .catch(error => showUploadStatus(0, `Upload failed: ${error.message}`));
+});
+
+function selectedFiles() {
+  return Array.from(document.querySelectorAll('.file-select:checked'), input => input.value);
+}
+
+// GET keeps the archive URL resumable; selections too long for a URL are
+// posted instead.
+function downloadArchive(format) {
+  const url = ARCHIVE_URL.replace(/\.zip$/, `.${format}`);
+  const query = new URLSearchParams(selectedFiles().map(name => ['path', name])).toString();
+  if (query.length < 2000) {
+    window.location.href = `${url}?${query}`;
+    return;
+  }
+  const form = document.createElement('form');
+  form.method = 'post';
+  form.action = url;
+  selectedFiles().forEach(name => {
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = 'path';
+    input.value = name;
+    form.appendChild(input);
+  });
+  document.body.appendChild(form);
+  form.submit();
+  form.remove();
+}
+
+document.getElementById('file-list')?.addEventListener('change', event => {
+  if (!event.target.classList.contains('file-select')) return;
+  const empty = selectedFiles().length === 0;
+  document.querySelectorAll('[data-archive]').forEach(button => { button.disabled = empty; });
+});
+document.querySelectorAll('[data-archive]').forEach(button => {
+  button.addEventListener('click', () => downloadArchive(button.dataset.archive));
+});
+
+function postJson(url, payload) {
+  return fetch(url, {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify(payload)})
+    .then(response => {
+      if (response.status === 409) throw new Error('something with that name already exists');
+      if (!response.ok) throw new Error(`request failed (${response.status})`);
+      return response.json();
+    });
+}
+
+document.getElementById('new-folder').addEventListener('click', () => {
+  const name = window.prompt('New folder name');
+  if (!name) return;
+  postJson(FOLDERS_URL, {path: DIRECTORY ? `${DIRECTORY}/${name}` : name})
+    .then(() => window.location.reload())
+    .catch(error => window.alert(`Could not create the folder: ${error.message}`));
+});
+
+// Moves and renames take a path relative to the upload root.
+document.getElementById('file-list')?.addEventListener('click', event => {
+  const button = event.target.closest('.btn-move');
+  if (!button) return;
+  const destination = window.prompt('Move to (path from the top folder)', button.dataset.name);
+  if (!destination || destination === button.dataset.name) return;
+  postJson(MOVE_URL, {source: button.dataset.name, destination})
+    .then(() => window.location.reload())
+    .catch(error => window.alert(`Could not move: ${error.message}`));
+});
+
+const sentinel = document.getElementById('list-sentinel');
+if (sentinel) {
+  listState.cursor = sentinel.dataset.cursor || null;
+  new IntersectionObserver(entries => {
+    if (entries.some(entry => entry.isIntersecting)) loadMore(false);
+  }, {rootMargin: '400px'}).observe(sentinel);
+
+  document.getElementById('sort-select').addEventListener('change', event => {
+    [listState.sort, listState.order] = event.target.value.split(':');
+    loadMore(true);
+  });
+  document.getElementById('type-select').addEventListener('change', event => {
+    listState.type = event.target.value;
+    loadMore(true);
+  });
+  let searchTimer = null;
+  document.getElementById('search-input').addEventListener('input', event => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+      listState.search = event.target.value.trim();
+      loadMore(true);
+    }, 250);
+  });
+}
@@ -0,0 +1,39 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+UPLOAD_FOLDER = tempfile.mkdtemp(prefix="fth-test-")
+os.environ["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+server = importlib.import_module("Upload_Download_file_latest2")
+
+def pytest_unconfigure(config):
+    shutil.rmtree(UPLOAD_FOLDER, ignore_errors=True)
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+@pytest.fixture
+def make_upload():
+    # Writes a file straight into UPLOAD_FOLDER and removes it afterwards.
+    created = []
+
+    def make(name, data):
+        path = os.path.join(UPLOAD_FOLDER, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        created.append(path)
+        return path
+
+    yield make
+    for path in created:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from conftest import UPLOAD_FOLDER, server
+
+INTERNAL_PATHS = [
+    server.STATE_DIR_NAME + "/catalog.db",
+    server.STATE_DIR_NAME + "/resumable/session.json",
+    "docs/" + server.STATE_DIR_NAME + "/note.txt",
+    server.TEMP_PREFIX + "inflight.txt",
+    "docs/../" + server.STATE_DIR_NAME + "/catalog.db",
+]
+
+@pytest.fixture
+def internal_files(make_upload):
+    for name in INTERNAL_PATHS[:-1]:
+        if not os.path.exists(os.path.join(UPLOAD_FOLDER, name)):
+            make_upload(name, b"internal state\n")
+
+@pytest.mark.parametrize("name", INTERNAL_PATHS)
+@pytest.mark.parametrize("route", ["/files/", "/view/", "/api/preview/"])
+def test_internal_paths_are_not_served(client, internal_files, route, name):
+    response = client.get(route + name)
+    assert response.status_code == 404
+    assert b"internal state" not in response.data
+
+def test_regular_files_are_still_served(client, make_upload):
+    make_upload("docs/readme.txt", b"hello\n")
+    assert client.get("/files/docs/readme.txt").data == b"hello\n"
+    assert client.get("/view/docs/readme.txt").data == b"hello\n"
+    assert client.get("/api/preview/docs/readme.txt").get_json()["text"] == "hello\n"
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+import struct
+
+import pytest
+
+from conftest import server
+
+@pytest.fixture
+def metrics(tmp_path):
+    metrics = server.Metrics(str(tmp_path))
+    metrics.define("test_total", "counter", "Test counter.")
+    metrics.define("test_seconds", "histogram", "Test histogram.", buckets=[0.1, 1.0])
+    return metrics
+
+def count(metrics, amount=1):
+    metrics.update([("test_total", (), amount)], [("test_seconds", (), 0.5)])
+
+def in_child(target, *args):
+    context = multiprocessing.get_context("fork")
+    child = context.Process(target=target, args=args)
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+
+def test_exited_processes_are_folded_into_retired(metrics, tmp_path):
+    for amount in (2, 3):
+        in_child(count, metrics, amount)
+    count(metrics)
+    assert metrics.totals()[0] == 6
+    # Both children's files are gone; this process's and the retired one remain.
+    assert sorted(path.name.split("-")[0] for path in tmp_path.glob("*.bin")) == [str(os.getpid()), "retired"]
+    in_child(count, metrics, 4)
+    assert metrics.totals()[0] == 10
+    assert metrics.totals()[0] == 10
+    assert "test_seconds_count 4.0" in metrics.render()
+
+def test_reused_pid_continues_the_old_file(metrics):
+    # A dead worker's file under this process's pid: it is continued, not
+    # truncated, so the total never goes backwards.
+    path = metrics._path(os.getpid())
+    with open(path, "wb") as f:
+        f.write(struct.pack("d", 7.0) + bytes(server.METRICS_SLOTS * 8 - 8))
+    count(metrics)
+    assert metrics.totals()[0] == 8
+
+def test_files_of_another_layout_are_ignored(metrics, tmp_path):
+    stale = tmp_path / "12345-000000000000.bin"
+    stale.write_bytes(struct.pack("d", 99.0) * 16)
+    count(metrics)
+    assert metrics.totals()[0] == 1
+    assert not stale.exists()
+
+def test_timed_counts_every_call(tmp_path):
+    metrics = server.Metrics(str(tmp_path))
+    metrics.define("test_calls_seconds", "summary", "Test summary.")
+    classify = metrics.timed("test_calls_seconds", flush_every=4)(lambda name: name.upper())
+    for i in range(5):
+        classify("x")
+    # Four are flushed by the fourth call; the fifth waits for flush().
+    assert metrics.totals()[0] == 4
+    metrics.flush()
+    assert metrics.totals()[0] == 5
+    assert metrics.totals()[1] > 0
+
+def file_type_count(client):
+    for line in client.get("/metrics").get_data(as_text=True).splitlines():
+        if line.startswith("fth_get_file_type_seconds_count"):
+            return float(line.split()[1])
+
+def test_request_flushes_file_type_timing(client, make_upload):
+    if not server.METRICS.enabled:
+        pytest.skip("METRICS is off")
+    make_upload("timed/a.txt", b"a")
+    make_upload("timed/b.jpg", b"b")
+    before = file_type_count(client)
+    assert client.get("/api/files", query_string={"dir": "timed"}).status_code == 200
+    assert file_type_count(client) >= before + 2
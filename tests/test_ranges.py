@@ -0,0 +1,78 @@
+import email
+import email.policy
+
+import pytest
+
+DATA = bytes(range(256)) * 16
+
+@pytest.fixture(params=["/files/", "/view/"])
+def url(request, make_upload):
+    make_upload("ranges/data.bin", DATA)
+    return request.param + "ranges/data.bin"
+
+def byteranges(response):
+    # [(Content-Range, body)] for each part of a multipart/byteranges body.
+    message = email.message_from_bytes(b"Content-Type: %s\r\n\r\n" % response.headers["Content-Type"].encode() +
+                                       response.data, policy=email.policy.HTTP)
+    return [(part["Content-Range"], part.get_payload(decode=True)) for part in message.iter_parts()]
+
+def test_single_range(client, url):
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 100-199/%d" % len(DATA)
+    assert response.data == DATA[100:200]
+
+def test_suffix_range(client, url):
+    response = client.get(url, headers={"Range": "bytes=-300"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes %d-%d/%d" % (len(DATA) - 300, len(DATA) - 1, len(DATA))
+    assert response.data == DATA[-300:]
+
+def test_multiple_ranges(client, url):
+    response = client.get(url, headers={"Range": "bytes=0-9,1000-1099,-5"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert byteranges(response) == [
+        ("bytes 0-9/%d" % len(DATA), DATA[0:10]),
+        ("bytes 1000-1099/%d" % len(DATA), DATA[1000:1100]),
+        ("bytes %d-%d/%d" % (len(DATA) - 5, len(DATA) - 1, len(DATA)), DATA[-5:]),
+    ]
+
+def test_unsatisfiable_range(client, url):
+    response = client.get(url, headers={"Range": "bytes=%d-" % (len(DATA) + 10)})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */%d" % len(DATA)
+
+def test_if_range_match_honours_range(client, url):
+    etag = client.get(url).headers["ETag"]
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.data == DATA[:10]
+
+@pytest.mark.parametrize("ranges", ["bytes=0-9", "bytes=0-9,20-29"])
+def test_if_range_mismatch_sends_whole_file(client, url, ranges):
+    response = client.get(url, headers={"Range": ranges, "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.data == DATA
+
+def test_if_none_match(client, url):
+    etag = client.get(url).headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+def test_if_none_match_wins_over_range(client, url):
+    etag = client.get(url).headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag, "Range": "bytes=0-9,20-29"})
+    assert response.status_code == 304
+
+def test_if_modified_since(client, url):
+    last_modified = client.get(url).headers["Last-Modified"]
+    assert client.get(url, headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}).status_code == 200
+
+def test_if_match_mismatch(client, url):
+    assert client.get(url, headers={"If-Match": '"other"'}).status_code == 412
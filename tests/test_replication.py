@@ -0,0 +1,56 @@
+import contextlib
+import hashlib
+import os
+import time
+
+import pytest
+
+from conftest import UPLOAD_FOLDER, server
+
+@pytest.fixture
+def replicator():
+    return server.Replicator("http://node-a", ["http://node-b"])
+
+def uploaded(name, data, when=None):
+    with open(os.path.join(UPLOAD_FOLDER, name), "wb") as f:
+        f.write(data)
+    digest = hashlib.sha256(data).hexdigest()
+    server.CATALOG.record({name: digest}, when)
+    return digest
+
+@pytest.fixture
+def local_file():
+    name = "replicated.txt"
+    yield name
+    os.remove(os.path.join(UPLOAD_FOLDER, name))
+
+def test_pulled_copy_keeps_origin_upload_time(local_file):
+    uploaded(local_file, b"pulled\n", 1000.0)
+    assert server.CATALOG.lookup(local_file)[4] == 1000.0
+
+def test_only_newer_versions_are_wanted(replicator, local_file):
+    digest = uploaded(local_file, b"local\n", 2000.0)
+    other = hashlib.sha256(b"remote\n").hexdigest()
+    assert not replicator.wanted(local_file, digest, 3000.0)
+    assert not replicator.wanted(local_file, other, 1000.0)
+    assert replicator.wanted(local_file, other, 3000.0)
+    assert replicator.wanted(local_file, other, 2000.0) == (other > digest)
+    assert replicator.wanted("not-here.txt", other, 0)
+
+def test_peer_misses_are_cached(replicator, monkeypatch):
+    asked = []
+
+    @contextlib.contextmanager
+    def peer_request(url, **kwargs):
+        asked.append(url)
+        raise OSError("not there")
+        yield
+
+    monkeypatch.setattr(server, "peer_request", peer_request)
+    replicator.loads["http://node-b"] = (0, time.time())
+    assert replicator.offload("missing.txt") is None
+    assert replicator.offload("missing.txt") is None
+    assert len(asked) == 1
+    monkeypatch.setattr(replicator, "schedule", lambda *args: False)
+    replicator.receive("http://node-b", [{'name': "missing.txt", 'size': 1, 'sha256': "0" * 64}])
+    assert "missing.txt" not in replicator.misses
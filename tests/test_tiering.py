@@ -0,0 +1,85 @@
+import hashlib
+import os
+import uuid
+
+import pytest
+
+from conftest import UPLOAD_FOLDER, server
+from test_ranges import byteranges
+
+DATA = os.urandom(256 * 1024)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+@pytest.fixture
+def file_tier(tmp_path):
+    return server.open_storage("file://%s" % tmp_path)
+
+@pytest.fixture
+def s3_tier(monkeypatch):
+    # A real bucket when COLD_STORAGE names one (with COLD_STORAGE_ENDPOINT
+    # for MinIO), else moto's in-process stand-in.
+    if server.COLD_STORAGE.startswith("s3://"):
+        yield server.open_storage(server.COLD_STORAGE + "/fth-test-" + uuid.uuid4().hex)
+        return
+    if server.boto3 is None:
+        pytest.skip("boto3 is not installed")
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        tier = server.S3Storage("fth-test", "cold/")
+        tier.client.create_bucket(Bucket="fth-test")
+        yield tier
+
+@pytest.fixture(params=["file_tier", "s3_tier"])
+def demoted(request, monkeypatch, make_upload):
+    tier = request.getfixturevalue(request.param)
+    monkeypatch.setattr(server, "COLD_TIER", tier)
+    path = make_upload("tier/cold.bin", DATA)
+    st = os.stat(path)
+    server.FILE_INDEX.refresh_many(["tier/cold.bin"])
+    listed = listing("tier")
+    try:
+        assert server.demote("tier/cold.bin", DIGEST, st.st_size, st.st_mtime)
+    except OSError as e:
+        pytest.skip("no sparse files or user xattrs here: %s" % e)
+    yield listed
+    tier.delete(server.cold_key(DIGEST))
+
+def listing(directory):
+    response = server.app.test_client().get("/api/files", query_string={"dir": directory})
+    return {item["name"]: (item["size"], item["mtime"]) for item in response.get_json()["files"]}
+
+def test_file_is_replaced_by_a_placeholder(demoted):
+    path = os.path.join(UPLOAD_FOLDER, "tier/cold.bin")
+    st = os.stat(path)
+    assert st.st_size == len(DATA)
+    assert st.st_blocks * 512 < len(DATA)
+    assert server.demoted_digest(path) == DIGEST
+    with server.open_upload(path) as f:
+        f.seek(1000)
+        assert f.read(100) == DATA[1000:1100]
+
+def test_listing_is_unchanged(demoted):
+    server.FILE_INDEX.refresh_many(["tier/cold.bin"])
+    assert "tier/cold.bin" in demoted
+    assert listing("tier") == demoted
+
+def test_full_download(client, demoted):
+    response = client.get("/files/tier/cold.bin")
+    assert response.status_code == 200
+    assert response.data == DATA
+
+def test_single_range(client, demoted):
+    response = client.get("/files/tier/cold.bin", headers={"Range": "bytes=-1000"})
+    assert response.status_code == 206
+    assert response.data == DATA[-1000:]
+
+def test_multiple_ranges(client, demoted):
+    response = client.get("/files/tier/cold.bin", headers={"Range": "bytes=0-9,100000-100099"})
+    assert response.status_code == 206
+    assert byteranges(response) == [
+        ("bytes 0-9/%d" % len(DATA), DATA[0:10]),
+        ("bytes 100000-100099/%d" % len(DATA), DATA[100000:100100]),
+    ]
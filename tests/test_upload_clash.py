@@ -0,0 +1,68 @@
+import base64
+import io
+import os
+
+import pytest
+
+from conftest import UPLOAD_FOLDER, server
+
+@pytest.fixture
+def folder(make_upload):
+    make_upload("clash/inside.txt", b"keep me\n")
+    yield "clash"
+    for name in ("clash", "other.txt"):
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+def leftovers():
+    return [name for name in os.listdir(os.path.join(UPLOAD_FOLDER, "clash")) if name != "inside.txt"]
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_multipart_upload_skips_folder_clash(client, folder, monkeypatch, streaming):
+    monkeypatch.setattr(server, "STREAM_UPLOADS", streaming)
+    response = client.post("/upload", headers={"Accept": "application/json"}, content_type="multipart/form-data",
+                           data={"file": [(io.BytesIO(b"clash\n"), folder), (io.BytesIO(b"other\n"), "other.txt")]})
+    assert response.status_code == 200
+    assert response.get_json()["files"] == ["other.txt"]
+    assert response.get_json()["skipped"] == [folder]
+    assert os.path.isdir(os.path.join(UPLOAD_FOLDER, folder))
+    with open(os.path.join(UPLOAD_FOLDER, "other.txt"), "rb") as f:
+        assert f.read() == b"other\n"
+
+def test_streamed_part_skipped_when_folder_appears(folder):
+    saved, skipped = {}, []
+    part = server.StreamedFile("late")
+    part.write(b"late\n")
+    os.mkdir(part.path)
+    try:
+        server.commit_streamed_file(part, saved, skipped)
+        assert saved == {} and skipped == ["late"]
+        assert not os.path.exists(part.temp_path)
+    finally:
+        os.rmdir(part.path)
+
+def test_chunked_complete_on_folder_is_conflict(client, folder):
+    created = client.post("/chunked", json={"filename": folder, "size": 6}).get_json()
+    assert client.put("/chunked/%s/0" % created["id"], data=b"clash\n").status_code == 204
+    assert client.post("/chunked/%s/complete" % created["id"]).status_code == 409
+    assert leftovers() == []
+
+def test_resumable_finalize_on_folder_is_conflict(client, folder):
+    metadata = "filename " + base64.b64encode(folder.encode()).decode()
+    created = client.post("/resumable", headers={"Tus-Resumable": "1.0.0", "Upload-Length": "6",
+                                                 "Upload-Metadata": metadata})
+    response = client.patch(created.headers["Location"], data=b"clash\n",
+                            headers={"Tus-Resumable": "1.0.0", "Upload-Offset": "0",
+                                     "Content-Type": "application/offset+octet-stream"})
+    assert response.status_code == 409
+    assert leftovers() == []
+
+def test_precheck_on_folder_is_conflict(client, folder, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "STORAGE_MODE", "dedup")
+    blob = tmp_path / "blob"
+    blob.write_bytes(b"clash\n")
+    digest = server.store_file(str(blob), str(tmp_path / "stored"))
+    response = client.post("/api/precheck", json={"filename": folder, "size": 6, "sha256": digest})
+    assert response.status_code == 409
+    assert leftovers() == []
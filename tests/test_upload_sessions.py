@@ -0,0 +1,73 @@
+import base64
+import concurrent.futures
+import os
+
+import pytest
+
+from conftest import UPLOAD_FOLDER, server
+
+@pytest.fixture
+def uploaded_name():
+    names = []
+    yield names.append
+    for name in names:
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def chunked_session(client, name, data):
+    created = client.post("/chunked", json={"filename": name, "size": len(data)}).get_json()
+    assert client.put("/chunked/%s/0" % created["id"], data=data).status_code == 204
+    return created["id"]
+
+def test_repeated_chunked_complete_is_not_found(client, uploaded_name):
+    uploaded_name("repeat.txt")
+    upload_id = chunked_session(client, "repeat.txt", b"repeat\n")
+    assert client.post("/chunked/%s/complete" % upload_id).status_code == 200
+    assert client.post("/chunked/%s/complete" % upload_id).status_code == 404
+
+def test_concurrent_chunked_completes_commit_once(uploaded_name):
+    for attempt in range(10):
+        name = "concurrent-%d.txt" % attempt
+        uploaded_name(name)
+        upload_id = chunked_session(server.app.test_client(), name, b"concurrent\n")
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            statuses = sorted(pool.map(lambda _: server.app.test_client().post(
+                "/chunked/%s/complete" % upload_id).status_code, range(4)))
+        assert statuses == [200, 404, 404, 404]
+        with open(os.path.join(UPLOAD_FOLDER, name), "rb") as f:
+            assert f.read() == b"concurrent\n"
+
+TUS = {"Tus-Resumable": "1.0.0"}
+
+def resumable_session(client, name, length):
+    created = client.post("/resumable", headers=dict(TUS, **{"Upload-Length": str(length),
+                                                             "Upload-Metadata": "filename " + base64.b64encode(
+                                                                 name.encode()).decode()}))
+    return created.headers["Location"]
+
+def patch(client, location, offset, data):
+    return client.patch(location, data=data, headers=dict(TUS, **{"Upload-Offset": str(offset),
+                                                                  "Content-Type": "application/offset+octet-stream"}))
+
+def test_repeated_final_patch_is_not_found(client, uploaded_name):
+    uploaded_name("resent.txt")
+    location = resumable_session(client, "resent.txt", 7)
+    assert patch(client, location, 0, b"resent\n").status_code == 204
+    assert patch(client, location, 7, b"").status_code == 404
+
+def test_final_patch_racing_resends(uploaded_name):
+    for attempt in range(40):
+        name = "racing-%d.txt" % attempt
+        uploaded_name(name)
+        location = resumable_session(server.app.test_client(), name, 7)
+        bodies = [(0, b"racing\n")] + [(7, b"")] * 3
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            statuses = list(pool.map(lambda body: patch(server.app.test_client(), location, *body).status_code,
+                                     bodies))
+        assert set(statuses) <= {204, 404, 409, 423}
+        if statuses[0] == 423:
+            # A resend held the part for a moment; the client tries again.
+            assert patch(server.app.test_client(), location, 0, b"racing\n").status_code == 204
+        with open(os.path.join(UPLOAD_FOLDER, name), "rb") as f:
+            assert f.read() == b"racing\n"